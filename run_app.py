@@ -12,7 +12,6 @@ import sys
 import tkinter as tk
 from tkinter import filedialog, messagebox, ttk
 from PIL import Image, ImageTk
-from ultralytics import YOLO
 import cv2
 import numpy as np
 
@@ -0,0 +1,191 @@
+import numpy as np
+
+
+class AlmacenAnotaciones:
+    # Puntos y recuadros guardados en arrays paralelos indexados por id. Cada id es fijo
+    # durante la vida de la anotación, así que eliminar es O(1) (se marca como inactiva y se
+    # quita de su celda) y el orden de inserción se conserva para los recortes guardados.
+    # Una rejilla uniforme en coordenadas de la imagen original acelera la búsqueda del punto
+    # más cercano al clic. Cada anotación guarda su puntuación de detección (1.0 para las
+    # manuales) y las que quedan por debajo de self.umbral se ocultan sin borrarlas.
+    def __init__(self, tamano_celda=32, capacidad=256):
+        self.tamano_celda = tamano_celda
+        self._capacidad = capacidad
+        self.umbral = 0.0
+        self.limpiar()
+
+    def limpiar(self):
+        self._n = 0
+        self.centros_x = np.zeros(self._capacidad, dtype=np.int64)
+        self.centros_y = np.zeros(self._capacidad, dtype=np.int64)
+        self._cajas = np.zeros((self._capacidad, 4), dtype=np.int64)
+        self.puntuaciones = np.ones(self._capacidad, dtype=np.float32)
+        self.ids_punto = np.full(self._capacidad, -1, dtype=np.int64)
+        self.ids_recuadro = np.full(self._capacidad, -1, dtype=np.int64)
+        self.activo = np.zeros(self._capacidad, dtype=bool)
+        self._celdas = {}
+
+    def __len__(self):
+        return len(self.ids())
+
+    def _crecer(self):
+        nueva = len(self.activo) * 2
+
+        def ampliar(array, relleno):
+            ampliado = np.full((nueva,) + array.shape[1:], relleno, dtype=array.dtype)
+            ampliado[:len(array)] = array
+            return ampliado
+
+        self.centros_x = ampliar(self.centros_x, 0)
+        self.centros_y = ampliar(self.centros_y, 0)
+        self._cajas = ampliar(self._cajas, 0)
+        self.puntuaciones = ampliar(self.puntuaciones, 1.0)
+        self.ids_punto = ampliar(self.ids_punto, -1)
+        self.ids_recuadro = ampliar(self.ids_recuadro, -1)
+        self.activo = ampliar(self.activo, False)
+
+    def _celda(self, x, y):
+        return int(x) // self.tamano_celda, int(y) // self.tamano_celda
+
+    def agregar(self, x_orig, y_orig, puntuacion=1.0):
+        if self._n == len(self.activo):
+            self._crecer()
+
+        id_anotacion = self._n
+        self._n += 1
+
+        self.centros_x[id_anotacion] = x_orig
+        self.centros_y[id_anotacion] = y_orig
+        self.puntuaciones[id_anotacion] = puntuacion
+        self.ids_punto[id_anotacion] = -1
+        self.ids_recuadro[id_anotacion] = -1
+        self.activo[id_anotacion] = True
+        self._celdas.setdefault(self._celda(x_orig, y_orig), set()).add(id_anotacion)
+        return id_anotacion
+
+    def agregar_varios(self, centros, puntuaciones):
+        # Inserción en bloque de detecciones; devuelve los ids asignados
+        cantidad = len(centros)
+        while self._n + cantidad > len(self.activo):
+            self._crecer()
+
+        ids = np.arange(self._n, self._n + cantidad)
+        self._n += cantidad
+
+        self.centros_x[ids] = centros[:, 0]
+        self.centros_y[ids] = centros[:, 1]
+        self.puntuaciones[ids] = puntuaciones
+        self.ids_punto[ids] = -1
+        self.ids_recuadro[ids] = -1
+        self.activo[ids] = True
+        for id_anotacion, (x, y) in zip(ids.tolist(), centros.tolist()):
+            self._celdas.setdefault(self._celda(x, y), set()).add(id_anotacion)
+        return ids
+
+    def eliminar(self, id_anotacion):
+        # Devuelve los ids de canvas del punto y del recuadro para que se borren del canvas
+        if not self.activo[id_anotacion]:
+            return None
+
+        self.activo[id_anotacion] = False
+        celda = self._celda(self.centros_x[id_anotacion], self.centros_y[id_anotacion])
+        ids_celda = self._celdas.get(celda)
+        if ids_celda is not None:
+            ids_celda.discard(id_anotacion)
+            if not ids_celda:
+                del self._celdas[celda]
+        return int(self.ids_punto[id_anotacion]), int(self.ids_recuadro[id_anotacion])
+
+    def instantanea(self):
+        # Estado completo para guardarlo: número de ids usados y, de las activas, id, centro,
+        # puntuación y recuadro (también las ocultas por el umbral)
+        n = self._n
+        ids = np.flatnonzero(self.activo[:n])
+        return (n, ids, np.stack([self.centros_x[ids], self.centros_y[ids]], axis=1),
+                self.puntuaciones[ids], self._cajas[ids])
+
+    def restaurar(self, n, ids, centros, puntuaciones, cajas):
+        # Inverso de instantanea(): los ids se conservan para que las operaciones posteriores sigan valiendo
+        self.limpiar()
+        while n > len(self.activo):
+            self._crecer()
+        self._n = n
+        self.centros_x[ids] = centros[:, 0]
+        self.centros_y[ids] = centros[:, 1]
+        self.puntuaciones[ids] = puntuaciones
+        self._cajas[ids] = cajas
+        self.activo[ids] = True
+        for id_anotacion, (x, y) in zip(ids.tolist(), centros.tolist()):
+            self._celdas.setdefault(self._celda(x, y), set()).add(id_anotacion)
+
+    def establecer_recuadro(self, id_anotacion, caja):
+        self._cajas[id_anotacion] = caja
+
+    def establecer_cajas(self, ids, cajas):
+        self._cajas[ids] = cajas
+
+    def establecer_items(self, id_anotacion, punto_id, rect_id):
+        self.ids_punto[id_anotacion] = punto_id
+        self.ids_recuadro[id_anotacion] = rect_id
+
+    def olvidar_items(self):
+        # Las anotaciones fuera de la vista no tienen elementos en el canvas
+        self.ids_punto[:self._n] = -1
+        self.ids_recuadro[:self._n] = -1
+
+    def cajas_de(self, id_anotacion):
+        return self._cajas[id_anotacion]
+
+    def mas_cercano(self, x_orig, y_orig, radio_orig):
+        # Busca solo en las celdas que cubren el círculo de radio radio_orig alrededor del clic
+        cx_min, cy_min = self._celda(max(0.0, x_orig - radio_orig), max(0.0, y_orig - radio_orig))
+        cx_max, cy_max = self._celda(x_orig + radio_orig, y_orig + radio_orig)
+
+        candidatos = []
+        for cx in range(cx_min, cx_max + 1):
+            for cy in range(cy_min, cy_max + 1):
+                ids_celda = self._celdas.get((cx, cy))
+                if ids_celda:
+                    candidatos.extend(ids_celda)
+        if not candidatos:
+            return None
+
+        candidatos = np.asarray(candidatos, dtype=np.int64)
+        candidatos = candidatos[self.puntuaciones[candidatos] >= self.umbral]
+        if not len(candidatos):
+            return None
+        distancias = np.hypot(self.centros_x[candidatos] - x_orig, self.centros_y[candidatos] - y_orig)
+        mejor = int(np.argmin(distancias))
+        if distancias[mejor] > radio_orig:
+            return None
+        return int(candidatos[mejor])
+
+    def ids_en_region(self, x0, y0, x1, y1):
+        ids = self.ids()
+        x = self.centros_x[ids]
+        y = self.centros_y[ids]
+        return ids[(x >= x0) & (x <= x1) & (y >= y0) & (y <= y1)]
+
+    def ids(self):
+        # Ids activos y por encima del umbral, en orden de inserción
+        n = self._n
+        return np.flatnonzero(self.activo[:n] & (self.puntuaciones[:n] >= self.umbral))
+
+    def ids_activos(self):
+        # Ids activos, también los ocultos por el umbral, en orden de inserción
+        return np.flatnonzero(self.activo[:self._n])
+
+    def ids_con_items(self):
+        # Ids que tienen un recuadro dibujado en el canvas
+        return np.flatnonzero(self.activo[:self._n] & (self.ids_recuadro[:self._n] >= 0))
+
+    def centros(self, ids=None):
+        if ids is None:
+            ids = self.ids()
+        return np.stack([self.centros_x[ids], self.centros_y[ids]], axis=1)
+
+    def cajas(self):
+        return self._cajas[self.ids()]
+
+    def lista_recuadros(self):
+        return [tuple(int(v) for v in caja) for caja in self.cajas()]
@@ -1,12 +1,29 @@
 import tkinter as tk
 from tkinter import filedialog, messagebox, ttk
-from PIL import Image, ImageTk
 import os
-import cv2
-import numpy as np
-import csv
-import torch
-from ultralytics import YOLO
+import sys
+import threading
+import time
+
+# Permite importar los módulos hermanos tanto con "python src/app.py" como desde run_app.py
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from anotaciones import AlmacenAnotaciones
+from cache_detecciones import CacheDetecciones
+from dataset import actualizar_dataset
+from deteccion import detectar_en_memoria, detectar_por_teselas
+from diario import DiarioSesion
+from duplicados import IndiceDuplicados
+from exportacion import (calcular_recuadro, calcular_recuadros, convertir_csv_a_yolo, escribir_recortes,
+                         escribir_recortes_fragmentos, exportar_imagen_yolo, huella_archivo)
+from imagen import ImagenOriginal
+from modelo import CargadorModelo
+from navegacion import PrecargadorImagenes, listar_carpeta
+from pendientes import (descartar_pendientes, detectar_carpeta, guardar_pendientes, leer_pendientes,
+                        revisada, ruta_pendientes)
+from perfil import RegistroTiempos
+from tareas import EjecutorTareas
+from visor import PiramideImagen, VisorTeselas
 
 
 class AplicacionPuntosRecortes:
@@ -16,34 +33,88 @@ class AplicacionPuntosRecortes:
         self.root.geometry("900x700")
 
         # Variables
-        self.imagen_original = None
-        self.imagen_actual = None
-        self.foto = None
+        self.imagen_original = None  # ImagenOriginal en BGR; la resolución completa se lee solo cuando hace falta
+        self.presupuesto_imagen = 96 * 1024 * 1024  # Por encima, la imagen completa se libera cuando no se usa
         self.ruta_imagen = None
-        self.puntos = []
-        self.recuadros = []
+        self.anotaciones = AlmacenAnotaciones()
+        self.diario = DiarioSesion()  # Ediciones de cada imagen en .sesion/, restauradas al volver a abrirla
+        self.radio_seleccion = 5  # Radio en píxeles de pantalla para seleccionar un punto
         self.directorio_base = "recortes"
         self.factor_escala = 1.0
+        self.factor_ajuste = 1.0  # Escala con la que la imagen completa cabe en el canvas
+        self.zoom_maximo = 8.0
+        self._render_pendiente = False
         self.tamano_recorte = 150  # Tamaño predeterminado del recuadro (50x50 píxeles)
         self.modelo = None
+        self.cargador_modelo = CargadorModelo()
         self.umbral_confianza = 0.5
-
-        # Cargar modelo
-        self.cargar_modelo()
+        self.umbral_minimo = 0.1  # Las detecciones se guardan desde este umbral y se filtran al mostrarlas
+        self.tamano_tesela = 640
+        self.solape_tesela = 0.2
+        self.cache_detecciones = CacheDetecciones()  # Detecciones en disco por contenido de imagen y modelo
+        self.formato_recortes = "png"
+        self.compresion_png = 3
+        self.hilos_escritura = min(8, os.cpu_count() or 1)
+        self.generacion_imagen = 0  # Cambia con cada imagen abierta; descarta resultados de imágenes anteriores
+        self.ejecutor = EjecutorTareas(self.root)
+        self.lock_modelo = threading.Lock()  # El modelo se comparte entre la detección y la precarga
+        self.precargador = None  # Imágenes de la carpeta abierta con sus siguientes ya decodificadas
+        self.imagenes_adelantadas = 3
+        self.predetectar = False
+        self.tamano_lote_carpeta = 8  # Imágenes por llamada al modelo en "Detectar carpeta"
+        self.hilos_carpeta = 2  # Hilos que decodifican el lote siguiente durante la inferencia
+        self.modo_duplicados = "no"  # "omitir" o "marcar" los casi duplicados al guardar y convertir
+        self.similitud_duplicados = 0.9  # Similitud de hash perceptual a partir de la que son duplicados
+        self.registro_tiempos = RegistroTiempos()  # Tiempos por etapa de cada acción en registros/tiempos.jsonl
+        self.registro_tiempos.al_terminar = self.mostrar_tiempos
 
         # Crear widgets
         self.crear_interfaz()
+        self.root.protocol("WM_DELETE_WINDOW", self.cerrar_aplicacion)
+
+        # Cargar modelo en segundo plano una vez que la ventana ya existe
+        self.cargar_modelo()
+
+        # Volver a la última imagen de la sesión anterior con sus anotaciones
+        self.root.after_idle(self.restaurar_sesion)
 
     def cargar_modelo(self):
-        try:
-            ruta_modelo = "modelos_uvas/detector_uvas/weights/best.pt"
-            if os.path.exists(ruta_modelo):
-                self.modelo = YOLO(ruta_modelo)
-                print("Modelo cargado correctamente")
-            else:
-                print(f"No se encontró el modelo en {ruta_modelo}")
-        except Exception as e:
-            print(f"Error al cargar el modelo: {str(e)}")
+        cargador = self.cargador_modelo
+        cargador.iniciar()
+        self.estado_modelo.config(text="Cargando modelo...")
+        self.root.after(200, lambda: self.revisar_carga_modelo(cargador))
+
+    def revisar_carga_modelo(self, cargador):
+        if cargador is not self.cargador_modelo:
+            # Se eligió otro motor mientras se cargaba este
+            return
+        if not cargador.terminado():
+            self.root.after(200, lambda: self.revisar_carga_modelo(cargador))
+            return
+
+        error = cargador.error()
+        if error is None:
+            self.modelo = cargador.obtener()
+            print("Modelo cargado correctamente")
+            self.estado_modelo.config(text=f"Modelo listo ({cargador.tiempo_carga:.1f} s)")
+        elif isinstance(error, FileNotFoundError):
+            print(str(error))
+            self.estado_modelo.config(text="Modelo no disponible")
+        else:
+            print(f"Error al cargar el modelo: {str(error)}")
+            self.estado_modelo.config(text="Error al cargar el modelo")
+
+    def cambiar_motor(self):
+        motor, _, precision = self.entrada_motor.get().partition("-")
+        cargador = self.cargador_modelo
+        if (motor, precision or "fp32") == (cargador.motor, cargador.precision):
+            return
+
+        # Las detecciones en curso siguen con el modelo anterior, que ya tienen capturado
+        self.modelo = None
+        self.cargador_modelo = CargadorModelo(cargador.ruta_modelo, motor=motor, precision=precision or "fp32",
+                                              hilos=cargador.hilos)
+        self.cargar_modelo()
 
     def crear_interfaz(self):
         # Panel superior (botones)
@@ -53,6 +124,9 @@ class AplicacionPuntosRecortes:
         btn_abrir = tk.Button(panel_botones, text="Abrir imagen", command=self.abrir_imagen)
         btn_abrir.pack(side=tk.LEFT, padx=5)
 
+        btn_abrir_carpeta = tk.Button(panel_botones, text="Abrir carpeta", command=self.abrir_carpeta)
+        btn_abrir_carpeta.pack(side=tk.LEFT, padx=5)
+
         btn_detectar = tk.Button(panel_botones, text="Detectar uvas", command=self.detectar_uvas)
         btn_detectar.pack(side=tk.LEFT, padx=5)
 
@@ -72,12 +146,95 @@ class AplicacionPuntosRecortes:
                                           command=self.actualizar_recuadros)
         self.entrada_tamano.set(self.tamano_recorte)
         self.entrada_tamano.pack(side=tk.LEFT)
+        self.entrada_tamano.bind("<Return>", lambda event: self.actualizar_recuadros())
 
         # Control del umbral de confianza
         tk.Label(panel_botones, text="Umbral:").pack(side=tk.LEFT, padx=(20, 5))
-        self.entrada_umbral = ttk.Spinbox(panel_botones, from_=0.1, to=1.0, increment=0.05, width=5)
+        self.entrada_umbral = ttk.Spinbox(panel_botones, from_=0.1, to=1.0, increment=0.05, width=5,
+                                          command=self.aplicar_umbral)
         self.entrada_umbral.set(self.umbral_confianza)
         self.entrada_umbral.pack(side=tk.LEFT)
+        self.entrada_umbral.bind("<Return>", lambda event: self.aplicar_umbral())
+
+        # Panel de opciones de detección por teselas
+        panel_opciones = tk.Frame(self.root)
+        panel_opciones.pack(fill=tk.X, padx=10)
+
+        self.modo_teselas = tk.BooleanVar(value=False)
+        tk.Checkbutton(panel_opciones, text="Detección por teselas",
+                       variable=self.modo_teselas).pack(side=tk.LEFT, padx=5)
+
+        tk.Label(panel_opciones, text="Tesela:").pack(side=tk.LEFT, padx=(20, 5))
+        self.entrada_tesela = ttk.Spinbox(panel_opciones, from_=160, to=2048, increment=32, width=5)
+        self.entrada_tesela.set(self.tamano_tesela)
+        self.entrada_tesela.pack(side=tk.LEFT)
+
+        tk.Label(panel_opciones, text="Solape:").pack(side=tk.LEFT, padx=(20, 5))
+        self.entrada_solape = ttk.Spinbox(panel_opciones, from_=0.0, to=0.5, increment=0.05, width=5)
+        self.entrada_solape.set(self.solape_tesela)
+        self.entrada_solape.pack(side=tk.LEFT)
+
+        # Formato y compresión de los recortes guardados
+        tk.Label(panel_opciones, text="Formato recortes:").pack(side=tk.LEFT, padx=(20, 5))
+        self.entrada_formato = ttk.Combobox(panel_opciones, values=["png", "webp", "fragmentos"], width=10,
+                                            state="readonly")
+        self.entrada_formato.set(self.formato_recortes)
+        self.entrada_formato.pack(side=tk.LEFT)
+
+        tk.Label(panel_opciones, text="Compresión PNG:").pack(side=tk.LEFT, padx=(20, 5))
+        self.entrada_compresion = ttk.Spinbox(panel_opciones, from_=0, to=9, width=3)
+        self.entrada_compresion.set(self.compresion_png)
+        self.entrada_compresion.pack(side=tk.LEFT)
+
+        # Motor de inferencia; cambiarlo vuelve a cargar el modelo en segundo plano
+        tk.Label(panel_opciones, text="Motor:").pack(side=tk.LEFT, padx=(20, 5))
+        self.entrada_motor = ttk.Combobox(panel_opciones, values=["pytorch", "onnx", "onnx-fp16", "onnx-int8"],
+                                          width=10, state="readonly")
+        self.entrada_motor.set(self.cargador_modelo.identificador().replace("-fp32", ""))
+        self.entrada_motor.pack(side=tk.LEFT)
+        self.entrada_motor.bind("<<ComboboxSelected>>", lambda event: self.cambiar_motor())
+
+        # Detección anticipada de las imágenes siguientes de la carpeta
+        self.modo_predetectar = tk.BooleanVar(value=self.predetectar)
+        tk.Checkbutton(panel_opciones, text="Pre-detectar", variable=self.modo_predetectar,
+                       command=self.cambiar_predetectar).pack(side=tk.LEFT, padx=(20, 5))
+
+        # Tiempos por etapa en la barra de estado y perfil de la siguiente acción
+        self.ver_tiempos = tk.BooleanVar(value=False)
+        tk.Checkbutton(panel_opciones, text="Mostrar tiempos", variable=self.ver_tiempos,
+                       command=lambda: self.estado_tiempos.config(text="")).pack(side=tk.LEFT, padx=(20, 5))
+        self.modo_perfilar = tk.BooleanVar(value=False)
+        tk.Checkbutton(panel_opciones, text="Perfilar siguiente acción", variable=self.modo_perfilar,
+                       command=self.cambiar_perfilar).pack(side=tk.LEFT, padx=5)
+
+        # Detección de una carpeta completa por lotes; los resultados quedan pendientes de revisión
+        panel_carpeta = tk.Frame(self.root)
+        panel_carpeta.pack(fill=tk.X, padx=10, pady=(5, 0))
+
+        btn_detectar_carpeta = tk.Button(panel_carpeta, text="Detectar carpeta", command=self.detectar_carpeta)
+        btn_detectar_carpeta.pack(side=tk.LEFT, padx=5)
+
+        tk.Label(panel_carpeta, text="Lote:").pack(side=tk.LEFT, padx=(20, 5))
+        self.entrada_lote = ttk.Spinbox(panel_carpeta, from_=1, to=64, width=4)
+        self.entrada_lote.set(self.tamano_lote_carpeta)
+        self.entrada_lote.pack(side=tk.LEFT)
+
+        tk.Label(panel_carpeta, text="Hilos de lectura:").pack(side=tk.LEFT, padx=(20, 5))
+        self.entrada_hilos = ttk.Spinbox(panel_carpeta, from_=1, to=16, width=4)
+        self.entrada_hilos.set(self.hilos_carpeta)
+        self.entrada_hilos.pack(side=tk.LEFT)
+
+        # Casi duplicados al guardar recortes y al convertir a YOLO; se anotan en duplicados.csv
+        tk.Label(panel_carpeta, text="Duplicados:").pack(side=tk.LEFT, padx=(20, 5))
+        self.entrada_duplicados = ttk.Combobox(panel_carpeta, values=["no", "omitir", "marcar"], width=8,
+                                               state="readonly")
+        self.entrada_duplicados.set(self.modo_duplicados)
+        self.entrada_duplicados.pack(side=tk.LEFT)
+
+        tk.Label(panel_carpeta, text="Similitud:").pack(side=tk.LEFT, padx=(20, 5))
+        self.entrada_similitud = ttk.Spinbox(panel_carpeta, from_=0.5, to=1.0, increment=0.01, width=5)
+        self.entrada_similitud.set(self.similitud_duplicados)
+        self.entrada_similitud.pack(side=tk.LEFT)
 
         # Canvas para la imagen
         self.canvas = tk.Canvas(self.root, bg='gray', cursor="cross")
@@ -87,417 +244,845 @@ class AplicacionPuntosRecortes:
         self.canvas.bind("<Button-1>", self.colocar_punto)
         self.canvas.bind("<Button-3>", self.eliminar_punto)  # Botón derecho para eliminar
 
+        # Zoom con la rueda del ratón y desplazamiento arrastrando con el botón central
+        self.canvas.bind("<MouseWheel>", self.hacer_zoom)
+        self.canvas.bind("<Button-4>", self.hacer_zoom)
+        self.canvas.bind("<Button-5>", self.hacer_zoom)
+        self.canvas.bind("<ButtonPress-2>", lambda event: self.canvas.scan_mark(event.x, event.y))
+        self.canvas.bind("<B2-Motion>", self.desplazar_vista)
+        self.canvas.bind("<Configure>", lambda event: self.programar_render())
+
+        # Navegación por la carpeta abierta con las flechas
+        self.root.bind("<Right>", lambda event: self.navegar(event, 1))
+        self.root.bind("<Left>", lambda event: self.navegar(event, -1))
+
+        # Renderizador de la imagen por teselas visibles
+        self.visor = VisorTeselas(self.canvas)
+
         # Barra de estado
-        self.estado = tk.Label(self.root, text="Listo para importar una imagen", bd=1, relief=tk.SUNKEN, anchor=tk.W)
-        self.estado.pack(side=tk.BOTTOM, fill=tk.X)
+        barra_estado = tk.Frame(self.root)
+        barra_estado.pack(side=tk.BOTTOM, fill=tk.X)
+        self.estado_modelo = tk.Label(barra_estado, text="", bd=1, relief=tk.SUNKEN, anchor=tk.E, width=28)
+        self.estado_modelo.pack(side=tk.RIGHT)
+        self.estado_tiempos = tk.Label(barra_estado, text="", bd=1, relief=tk.SUNKEN, anchor=tk.E)
+        self.estado_tiempos.pack(side=tk.RIGHT)
+
+        # Progreso y cancelación de las tareas en segundo plano
+        self.btn_cancelar = tk.Button(barra_estado, text="Cancelar", state=tk.DISABLED,
+                                      command=lambda: self.ejecutor.cancelar())
+        self.btn_cancelar.pack(side=tk.RIGHT)
+        self.barra_progreso = ttk.Progressbar(barra_estado, length=160, mode="determinate")
+        self.barra_progreso.pack(side=tk.RIGHT, padx=5)
+        self.ejecutor.al_cambiar = self.actualizar_progreso_tarea
+        self.estado = tk.Label(barra_estado, text="Listo para importar una imagen", bd=1, relief=tk.SUNKEN,
+                               anchor=tk.W)
+        self.estado.pack(side=tk.LEFT, fill=tk.X, expand=True)
 
     def detectar_uvas(self):
+        if self.imagen_original is not None and self.modelo is None and not self.cargador_modelo.terminado():
+            # El modelo aún se está cargando: esperar al futuro sin bloquear la interfaz
+            self.estado.config(text="Esperando a que termine de cargar el modelo...")
+            self.root.after(200, self.detectar_uvas)
+            return
+
         if self.imagen_original is None or self.modelo is None:
             messagebox.showwarning("Aviso", "No se ha cargado una imagen o el modelo no está disponible")
             return
 
-        try:
-            # Obtener umbral de confianza
+        self.leer_umbral()
+
+        # Se detecta con el umbral mínimo para poder cambiar el umbral después sin repetir la inferencia
+        umbral_deteccion = min(self.umbral_minimo, self.umbral_confianza)
+
+        if self.modo_teselas.get():
+            # Obtener configuración de las teselas
             try:
-                umbral = float(self.entrada_umbral.get())
-                if 0 < umbral <= 1:
-                    self.umbral_confianza = umbral
+                self.tamano_tesela = int(self.entrada_tesela.get())
+            except ValueError:
+                pass
+            try:
+                solape = float(self.entrada_solape.get())
+                if 0 <= solape < 1:
+                    self.solape_tesela = solape
             except ValueError:
                 pass
 
-            # Guardar temporalmente la imagen para procesarla con YOLO
-            temp_path = "temp_detection.jpg"
-            cv2.imwrite(temp_path, cv2.cvtColor(self.imagen_original, cv2.COLOR_RGB2BGR))
-
-            # Realizar detección
-            resultados = self.modelo(temp_path, conf=self.umbral_confianza)[0]
+        # Datos de entrada fijados al lanzar la tarea
+        modelo = self.modelo
+        cargador = self.cargador_modelo
+        fuente = self.imagen_original
+        ruta = self.ruta_imagen
+        teselas = self.modo_teselas.get()
+        generacion = self.generacion_imagen
+        accion = self.registro_tiempos.iniciar("detectar_uvas", teselas=teselas, motor=cargador.identificador())
+
+        def trabajo(tarea):
+            with accion.etapa("lectura"):
+                imagen = fuente.datos()
+            with accion.etapa("deteccion"):
+                if teselas:
+                    with self.lock_modelo:
+                        resultado = detectar_por_teselas(modelo, imagen, umbral_deteccion,
+                                                         tamano_tesela=self.tamano_tesela,
+                                                         solape=self.solape_tesela,
+                                                         cache=self.cache_detecciones,
+                                                         clave_cache=self.clave_cache(ruta, cargador),
+                                                         progreso=tarea.informar, comprobar=tarea.comprobar)
+                else:
+                    # Realizar detección directamente sobre la imagen en memoria
+                    resultado = self.detectar_con_cache(modelo, cargador, imagen, ruta, umbral_deteccion)
+            # Preproceso, inferencia y postproceso medidos por el modelo
+            accion.agregar_tiempos(resultado.tiempos, "deteccion")
+            return resultado
+
+        def al_terminar(resultado):
+            self.liberar_imagen()
+            # Las anotaciones solo se modifican aquí, en el hilo de la interfaz
+            if generacion != self.generacion_imagen:
+                accion.terminar(estado="descartada")
+                return
+            with accion.etapa("dibujo"):
+                self.dibujar_detecciones(resultado)
+            accion.terminar(detecciones=len(resultado))
+
+        def al_fallar(e):
+            self.liberar_imagen()
+            accion.terminar(estado="error", error=str(e))
+            messagebox.showerror("Error", f"Error al detectar uvas: {str(e)}")
+            print(f"Error detallado: {str(e)}")
 
-            # Limpiar puntos existentes
-            self.limpiar_puntos()
+        def al_cancelar():
+            self.liberar_imagen()
+            accion.terminar(estado="cancelada")
+            self.estado.config(text="Detección cancelada")
+
+        tarea = self.ejecutor.ejecutar("Detectando uvas", trabajo, grupo="deteccion", al_terminar=al_terminar,
+                                       al_fallar=al_fallar, al_cancelar=al_cancelar)
+        if tarea is None:
+            messagebox.showwarning("Aviso", "Ya hay una detección en curso")
+
+    def actualizar_progreso_tarea(self, tarea, hechos, total, mensaje):
+        if tarea is None:
+            # Una tarea terminó; si no queda ninguna, reiniciar la barra de progreso
+            if not self.ejecutor.ocupado():
+                self.barra_progreso.stop()
+                self.barra_progreso.config(mode="determinate", value=0)
+                self.btn_cancelar.config(state=tk.DISABLED)
+            return
 
-            # Procesar resultados
-            cajas = resultados.boxes.cpu().numpy()
-            num_detecciones = len(cajas)
+        self.btn_cancelar.config(state=tk.NORMAL)
+        if total:
+            self.barra_progreso.stop()
+            self.barra_progreso.config(mode="determinate", maximum=total, value=hechos)
+            self.estado.config(text=f"{tarea.nombre}: {hechos}/{total}")
+        else:
+            self.barra_progreso.config(mode="indeterminate")
+            self.barra_progreso.start(20)
+            self.estado.config(text=f"{mensaje or tarea.nombre}...")
+
+    def leer_umbral(self):
+        # Obtener umbral de confianza
+        try:
+            umbral = float(self.entrada_umbral.get())
+            if 0 < umbral <= 1:
+                self.umbral_confianza = umbral
+        except ValueError:
+            pass
+        return self.umbral_confianza
 
-            for caja in cajas:
-                # Obtener coordenadas (x1, y1, x2, y2)
-                x1, y1, x2, y2 = map(int, caja.xyxy[0])
+    def leer_tamano(self):
+        try:
+            # Obtener el tamaño del recuadro desde la entrada
+            self.tamano_recorte = int(self.entrada_tamano.get())
+        except ValueError:
+            pass
+        return self.tamano_recorte
 
-                # Calcular centro
-                centro_x = (x1 + x2) // 2
-                centro_y = (y1 + y2) // 2
+    def dibujar_detecciones(self, resultado):
+        # Limpiar puntos existentes
+        self.limpiar_puntos()
 
-                # Escalar para la visualización en canvas
-                x_canvas = int(centro_x * self.factor_escala)
-                y_canvas = int(centro_y * self.factor_escala)
+        # Guardar todas las detecciones con su puntuación y calcular sus recuadros de una vez
+        ids = self.anotaciones.agregar_varios(resultado.centros, resultado.puntuaciones)
+        alto_img, ancho_img = self.imagen_original.forma
+        self.anotaciones.establecer_cajas(ids, calcular_recuadros(resultado.centros, self.leer_tamano(),
+                                                                  ancho_img, alto_img))
+        self.anotaciones.umbral = self.umbral_confianza
+        self.diario.detectar(resultado.centros, resultado.puntuaciones, self.tamano_recorte, self.umbral_confianza)
+
+        # Dibujar solo las anotaciones visibles dentro de la vista
+        self.redibujar_anotaciones()
+
+        self.estado.config(text=f"Se detectaron {len(self.anotaciones)} uvas con confianza > "
+                                f"{self.umbral_confianza} ({resultado.tiempos.get('total', 0.0):.0f} ms)")
+
+    def aplicar_umbral(self):
+        # Cambiar el umbral solo oculta o muestra detecciones ya guardadas, sin volver a inferir
+        self.anotaciones.umbral = self.leer_umbral()
+        self.diario.umbral(self.umbral_confianza)
+        self.redibujar_anotaciones()
+        self.estado.config(text=f"{len(self.anotaciones)} uvas con confianza > {self.umbral_confianza}")
+
+    def abrir_imagen(self, ruta=None):
+        if ruta is None:
+            ruta = filedialog.askopenfilename(
+                title="Seleccionar imagen",
+                filetypes=[("Imágenes", "*.png *.jpg *.jpeg *.bmp")]
+            )
+
+        if not ruta:
+            return
 
-                # Crear punto en el canvas
-                punto_id = self.canvas.create_oval(
-                    x_canvas - 3, y_canvas - 3, x_canvas + 3, y_canvas + 3,
-                    fill="red", outline="red", tags="punto"
-                )
+        # Una imagen suelta sale del modo carpeta
+        self.cerrar_carpeta()
+        accion = self.registro_tiempos.iniciar("abrir_imagen", ruta=ruta)
+        try:
+            with accion.etapa("lectura"):
+                # Las imágenes que no caben en el presupuesto no se decodifican a resolución completa:
+                # la pirámide sale de una lectura reducida y el nivel 0 se lee al acercar el zoom
+                imagen = ImagenOriginal(ruta, presupuesto=self.presupuesto_imagen)
+                piramide = PiramideImagen.desde_fuente(imagen)
+        except (IOError, OSError) as e:
+            accion.terminar(estado="error", error=str(e))
+            messagebox.showerror("Error", f"Error al abrir la imagen: {str(e)}")
+            return
+        self.cargar_imagen(ruta, imagen, piramide, accion=accion)
+
+    def cargar_imagen(self, ruta, imagen, piramide=None, deteccion=None, accion=None):
+        # imagen es una ImagenOriginal; sin pirámide se construye aquí
+        if accion is None:
+            accion = self.registro_tiempos.iniciar("cargar_imagen", ruta=ruta, precargada=piramide is not None)
+
+        # Cancelar la detección de la imagen anterior y mostrar la nueva
+        self.ejecutor.cancelar("deteccion")
+        self.generacion_imagen += 1
+        self.ruta_imagen = ruta
+        self.imagen_original = imagen
+        with accion.etapa("piramide"):
+            if piramide is None:
+                piramide = PiramideImagen.desde_fuente(imagen)
+            self.visor.establecer_imagen(None, piramide)
+        with accion.etapa("mostrar_imagen"):
+            self.mostrar_imagen(ajustar=True)
 
-                # Guardar coordenadas originales
-                self.puntos.append((punto_id, (centro_x, centro_y)))
+        # Limpiar puntos y recuadros anteriores
+        self.limpiar_puntos()
+        with accion.etapa("diario"):
+            restaurada = self.diario.abrir(ruta, imagen.ancho, imagen.alto, self.anotaciones,
+                                           tamano=self.leer_tamano())
+        pendientes = None if restaurada else leer_pendientes(ruta_pendientes(self.directorio_base, ruta))
+        if restaurada:
+            # Ediciones de una sesión anterior con esta imagen, guardadas o no
+            if self.anotaciones.umbral > 0:
+                self.umbral_confianza = float(self.anotaciones.umbral)
+                self.entrada_umbral.set(round(self.umbral_confianza, 4))
+            # El tamaño de los recuadros restaurados, para que los nuevos puntos no mezclen tamaños
+            if self.diario.tamano_recuadro > 0:
+                self.tamano_recorte = int(self.diario.tamano_recuadro)
+                self.entrada_tamano.set(self.tamano_recorte)
+            with accion.etapa("dibujo"):
+                self.redibujar_anotaciones()
+            self.estado.config(text=f"{len(self.anotaciones)} anotaciones restauradas en {os.path.basename(ruta)}")
+        elif pendientes is not None:
+            # Detección de "Detectar carpeta" que aún no se ha revisado
+            with accion.etapa("dibujo"):
+                self.dibujar_detecciones(pendientes)
+            self.estado.config(text=f"{len(self.anotaciones)} uvas pendientes de revisión en "
+                                    f"{os.path.basename(ruta)}")
+        elif deteccion is not None:
+            # Detección hecha por adelantado durante la precarga
+            with accion.etapa("dibujo"):
+                self.dibujar_detecciones(deteccion)
+        else:
+            texto = f"Imagen cargada: {os.path.basename(self.ruta_imagen)}"
+            if self.precargador is not None:
+                texto += f" ({self.precargador.indice + 1}/{len(self.precargador)})"
+            self.estado.config(text=texto)
+        accion.terminar(alto=imagen.alto, ancho=imagen.ancho)
+
+    def restaurar_sesion(self):
+        ruta = self.diario.ultima_imagen()
+        if ruta is not None and self.imagen_original is None:
+            self.abrir_imagen(ruta)
+
+    def abrir_carpeta(self):
+        directorio = filedialog.askdirectory(title="Seleccionar carpeta de imágenes")
+        if not directorio:
+            return
 
-                # Crear recuadro
-                self.crear_recuadro(x_canvas, y_canvas)
+        rutas = listar_carpeta(directorio)
+        if not rutas:
+            messagebox.showwarning("Aviso", "La carpeta no contiene imágenes")
+            return
 
-            # Eliminar archivo temporal
-            if os.path.exists(temp_path):
-                os.remove(temp_path)
+        self.cerrar_carpeta()
+        self.precargador = PrecargadorImagenes(rutas, adelante=self.imagenes_adelantadas,
+                                               detectar=self.detectar_anticipado,
+                                               debe_detectar=self.detecta_anticipado,
+                                               presupuesto_imagen=self.presupuesto_imagen)
+        self.ir_a_imagen(0)
+
+    def cerrar_aplicacion(self):
+        # Los hilos de trabajo no son daemon: sin cancelarlos el proceso seguiría vivo sin ventana
+        # hasta que terminara, por ejemplo, "Detectar carpeta"
+        self.ejecutor.cerrar()
+        self.cerrar_carpeta()
+        self.cargador_modelo.cerrar()
+        self.diario.cerrar()
+        self.registro_tiempos.cerrar()
+        self.root.destroy()
+
+    def cerrar_carpeta(self):
+        if self.precargador is not None:
+            self.precargador.cerrar()
+            self.precargador = None
+
+    def navegar(self, event, paso):
+        # Las flechas mueven el cursor dentro de los campos de texto; ahí no se cambia de imagen
+        if isinstance(event.widget, (tk.Entry, ttk.Entry)):
+            return
+        if self.precargador is None:
+            return
+        indice = self.precargador.indice + paso
+        if 0 <= indice < len(self.precargador):
+            self.ir_a_imagen(indice)
+
+    def ir_a_imagen(self, indice):
+        futuro = self.precargador.ir_a(indice)
+        precargador = self.precargador
+        generacion = self.generacion_imagen
+
+        def revisar():
+            # Si entretanto se navegó a otra imagen o se cerró la carpeta, descartar esta
+            if precargador is not self.precargador or generacion != self.generacion_imagen:
+                return
+            if precargador.indice != indice:
+                return
+            if not futuro.done():
+                self.root.after(20, revisar)
+                return
+
+            error = futuro.exception()
+            if error is not None:
+                messagebox.showerror("Error", f"Error al cargar la imagen: {str(error)}")
+                return
+            entrada = futuro.result()
+            self.cargar_imagen(entrada.ruta, entrada.imagen, entrada.piramide, entrada.deteccion)
+
+        if not futuro.done():
+            self.estado.config(text=f"Cargando imagen {indice + 1}/{len(precargador)}...")
+        revisar()
+
+    def cambiar_predetectar(self):
+        # Se copia a un atributo normal porque la precarga lo lee desde otros hilos
+        self.predetectar = self.modo_predetectar.get()
+
+    def detecta_anticipado(self):
+        # Sin "Pre-detectar" o sin modelo la precarga no necesita la imagen a resolución completa
+        return self.predetectar and self.modelo is not None
+
+    def detectar_anticipado(self, ruta, imagen):
+        # Se ejecuta en los hilos del precargador con la imagen en BGR; sin modelo o con la opción
+        # desactivada no detecta. El cargador se lee antes que el modelo: cambiar_motor quita el modelo
+        # antes de sustituir el cargador, así que un modelo leído después siempre es de ese cargador
+        cargador = self.cargador_modelo
+        modelo = self.modelo
+        if not self.predetectar or modelo is None:
+            return None
+        return self.detectar_con_cache(modelo, cargador, imagen, ruta, self.umbral_minimo)
+
+    def clave_cache(self, ruta, cargador, *configuracion):
+        # cargador es el del modelo que detecta, capturado junto a él: self.cargador_modelo puede
+        # cambiar mientras tanto. None si el archivo ya no se puede leer; se detecta sin caché.
+        try:
+            return self.cache_detecciones.clave(ruta, cargador.ruta_modelo, cargador.identificador(),
+                                                *configuracion)
+        except OSError:
+            return None
+
+    def detectar_con_cache(self, modelo, cargador, imagen, ruta, umbral):
+        # Se llama fuera del hilo de la interfaz: repetir la detección de una imagen ya vista con el
+        # mismo modelo solo cuesta leer el resultado del disco
+        inicio = time.perf_counter()
+        clave = self.clave_cache(ruta, cargador, "directo")
+        if clave is not None:
+            resultado = self.cache_detecciones.obtener(clave, umbral)
+            if resultado is not None:
+                resultado.tiempos["total"] = (time.perf_counter() - inicio) * 1000.0
+                return resultado
+
+        with self.lock_modelo:
+            resultado = detectar_en_memoria(modelo, imagen, umbral)
+        if clave is not None:
+            self.cache_detecciones.guardar(clave, umbral, resultado)
+        return resultado
+
+    def mostrar_imagen(self, ajustar=False):
+        if self.imagen_original is None:
+            return
 
-            self.estado.config(text=f"Se detectaron {num_detecciones} uvas con confianza > {self.umbral_confianza}")
+        alto, ancho = self.imagen_original.forma
 
-        except Exception as e:
-            messagebox.showerror("Error", f"Error al detectar uvas: {str(e)}")
-            print(f"Error detallado: {str(e)}")
+        if ajustar:
+            # Obtener dimensiones del canvas
+            ancho_canvas = self.canvas.winfo_width()
+            alto_canvas = self.canvas.winfo_height()
 
-    def abrir_imagen(self):
-        self.ruta_imagen = filedialog.askopenfilename(
-            title="Seleccionar imagen",
-            filetypes=[("Imágenes", "*.png *.jpg *.jpeg *.bmp")]
-        )
+            # Si el canvas no tiene tamaño aún, usar valores por defecto
+            if ancho_canvas < 10:
+                ancho_canvas = 800
+                alto_canvas = 600
 
-        if not self.ruta_imagen:
-            return
+            # Escalar la imagen para que se ajuste al canvas
+            self.factor_escala_ancho = ancho_canvas / ancho
+            self.factor_escala_alto = alto_canvas / alto
+            self.factor_ajuste = min(self.factor_escala_ancho, self.factor_escala_alto) * 0.95
+            self.factor_escala = self.factor_ajuste
+            self.canvas.xview_moveto(0)
+            self.canvas.yview_moveto(0)
 
-        # Cargar la imagen
-        self.imagen_original = cv2.imread(self.ruta_imagen)
-        self.imagen_original = cv2.cvtColor(self.imagen_original, cv2.COLOR_BGR2RGB)
-        self.mostrar_imagen()
+        # La región desplazable cubre la imagen completa a la escala actual
+        self.canvas.config(scrollregion=(0, 0, int(ancho * self.factor_escala), int(alto * self.factor_escala)))
 
-        # Limpiar puntos y recuadros anteriores
-        self.limpiar_puntos()
-        self.estado.config(text=f"Imagen cargada: {os.path.basename(self.ruta_imagen)}")
+        # Dibujar solo las teselas visibles desde la pirámide de resoluciones
+        self.visor.renderizar(self.factor_escala)
 
-    def mostrar_imagen(self):
+    def programar_render(self):
+        # Agrupa varios eventos seguidos (arrastre, redimensionado) en un solo redibujado
+        if self._render_pendiente:
+            return
+        self._render_pendiente = True
+
+        def render():
+            self._render_pendiente = False
+            if self.imagen_original is None:
+                return
+            accion = self.registro_tiempos.iniciar("renderizar", automatica=True)
+            with accion.etapa("mostrar_imagen"):
+                self.mostrar_imagen()
+            with accion.etapa("anotaciones"):
+                self.redibujar_anotaciones()
+            self.liberar_imagen()
+            accion.terminar()
+
+        self.root.after_idle(render)
+
+    def hacer_zoom(self, event):
         if self.imagen_original is None:
             return
 
-        # Obtener dimensiones del canvas
-        ancho_canvas = self.canvas.winfo_width()
-        alto_canvas = self.canvas.winfo_height()
-
-        # Si el canvas no tiene tamaño aún, usar valores por defecto
-        if ancho_canvas < 10:
-            ancho_canvas = 800
-            alto_canvas = 600
+        acercar = event.num == 4 or getattr(event, "delta", 0) > 0
+        nuevo_factor = self.factor_escala * (1.25 if acercar else 0.8)
+        nuevo_factor = max(self.factor_ajuste, min(self.zoom_maximo, nuevo_factor))
+        if nuevo_factor == self.factor_escala:
+            return
 
-        # Escalar la imagen para que se ajuste al canvas
-        alto, ancho = self.imagen_original.shape[:2]
-        self.factor_escala_ancho = ancho_canvas / ancho
-        self.factor_escala_alto = alto_canvas / alto
-        self.factor_escala = min(self.factor_escala_ancho, self.factor_escala_alto) * 0.95
+        # Mantener bajo el cursor el mismo punto de la imagen
+        x_orig = self.canvas.canvasx(event.x) / self.factor_escala
+        y_orig = self.canvas.canvasy(event.y) / self.factor_escala
+        self.factor_escala = nuevo_factor
 
-        nuevo_ancho = int(ancho * self.factor_escala)
-        nuevo_alto = int(alto * self.factor_escala)
+        alto, ancho = self.imagen_original.forma
+        self.canvas.config(scrollregion=(0, 0, int(ancho * nuevo_factor), int(alto * nuevo_factor)))
+        self.canvas.xview_moveto(max(0.0, (x_orig * nuevo_factor - event.x) / (ancho * nuevo_factor)))
+        self.canvas.yview_moveto(max(0.0, (y_orig * nuevo_factor - event.y) / (alto * nuevo_factor)))
 
-        # Redimensionar imagen
-        self.imagen_actual = cv2.resize(self.imagen_original.copy(), (nuevo_ancho, nuevo_alto))
+        self.programar_render()
 
-        # Convertir a formato compatible con tkinter
-        self.foto = ImageTk.PhotoImage(image=Image.fromarray(self.imagen_actual))
+    def desplazar_vista(self, event):
+        self.canvas.scan_dragto(event.x, event.y, gain=1)
+        self.programar_render()
 
-        # Mostrar en canvas
-        self.canvas.config(width=nuevo_ancho, height=nuevo_alto)
-        self.canvas.create_image(0, 0, image=self.foto, anchor=tk.NW, tags="imagen")
-
-    def colocar_punto(self, event):
-        if self.imagen_original is None:
-            return
+    def dibujar_anotacion(self, id_anotacion):
+        x_canvas = int(self.anotaciones.centros_x[id_anotacion] * self.factor_escala)
+        y_canvas = int(self.anotaciones.centros_y[id_anotacion] * self.factor_escala)
 
         # Dibujar un punto (círculo pequeño)
         punto_id = self.canvas.create_oval(
-            event.x - 3, event.y - 3, event.x + 3, event.y + 3,
+            x_canvas - 3, y_canvas - 3, x_canvas + 3, y_canvas + 3,
             fill="red", outline="red", tags="punto"
         )
 
-        # Coordenadas ajustadas a la imagen original
-        x_orig = int(event.x / self.factor_escala)
-        y_orig = int(event.y / self.factor_escala)
+        # Dibujar el recuadro guardado en coordenadas de la imagen original
+        x1, y1, x2, y2 = (self.anotaciones.cajas_de(id_anotacion) * self.factor_escala).tolist()
+        rect_id = self.canvas.create_rectangle(x1, y1, x2, y2, outline="green", width=2, tags="recuadro")
 
-        # Guardar punto y crear recuadro
-        self.puntos.append((punto_id, (x_orig, y_orig)))
-        self.crear_recuadro(event.x, event.y)
+        self.anotaciones.establecer_items(id_anotacion, punto_id, rect_id)
 
-        self.estado.config(text=f"Punto añadido: {len(self.puntos)} en total")
-
-    def eliminar_punto(self, event):
-        if not self.puntos:
+    def redibujar_anotaciones(self):
+        # Vuelve a crear los elementos del canvas solo para las anotaciones dentro de la vista
+        self.canvas.delete("punto")
+        self.canvas.delete("recuadro")
+        self.anotaciones.olvidar_items()
+        if self.imagen_original is None or not len(self.anotaciones):
             return
 
-        # Encontrar el punto más cercano al clic
-        punto_mas_cercano = None
-        distancia_minima = float('inf')
-        indice_punto = -1
+        vx0, vy0, vx1, vy1 = self.visor.region_visible()
+        margen = self.tamano_recorte / 2
+        visibles = self.anotaciones.ids_en_region(vx0 / self.factor_escala - margen,
+                                                  vy0 / self.factor_escala - margen,
+                                                  vx1 / self.factor_escala + margen,
+                                                  vy1 / self.factor_escala + margen)
+        for id_anotacion in visibles:
+            self.dibujar_anotacion(int(id_anotacion))
 
-        for i, (punto_id, (x_orig, y_orig)) in enumerate(self.puntos):
-            # Convertir coordenadas originales a coordenadas del canvas
-            x_canvas = int(x_orig * self.factor_escala)
-            y_canvas = int(y_orig * self.factor_escala)
-
-            # Calcular distancia
-            distancia = ((event.x - x_canvas) ** 2 + (event.y - y_canvas) ** 2) ** 0.5
-
-            if distancia < distancia_minima:
-                distancia_minima = distancia
-                punto_mas_cercano = punto_id
-                indice_punto = i
+    def colocar_punto(self, event):
+        if self.imagen_original is None:
+            return
 
-        # Si hay un punto cercano (a menos de 20 píxeles), eliminarlo
-        if distancia_minima < 3 and punto_mas_cercano is not None:
-            # Eliminar punto y su recuadro asociado
-            self.canvas.delete(punto_mas_cercano)
-            if indice_punto < len(self.recuadros):
-                rect_id, _ = self.recuadros[indice_punto]
-                self.canvas.delete(rect_id)
+        # Coordenadas ajustadas a la imagen original (teniendo en cuenta el desplazamiento de la vista)
+        x_orig = int(self.canvas.canvasx(event.x) / self.factor_escala)
+        y_orig = int(self.canvas.canvasy(event.y) / self.factor_escala)
 
-                # Eliminar de las listas
-                self.puntos.pop(indice_punto)
-                self.recuadros.pop(indice_punto)
+        # Guardar punto, crear su recuadro y dibujarlos
+        id_anotacion = self.anotaciones.agregar(x_orig, y_orig)
+        self.crear_recuadro(id_anotacion)
+        self.diario.agregar(x_orig, y_orig, 1.0, self.tamano_recorte)
 
-                self.estado.config(text=f"Punto eliminado: quedan {len(self.puntos)}")
+        self.estado.config(text=f"Punto añadido: {len(self.anotaciones)} en total")
 
-    def crear_recuadro(self, x_canvas, y_canvas):
-        try:
-            # Obtener el tamaño del recuadro desde la entrada
-            tamano = int(self.entrada_tamano.get())
-        except ValueError:
-            tamano = self.tamano_recorte
+    def eliminar_punto(self, event):
+        if not len(self.anotaciones):
+            return
 
-        self.tamano_recorte = tamano
-        mitad_tamano = tamano * self.factor_escala / 2
+        # Buscar el punto más cercano al clic dentro del radio de selección (en píxeles de pantalla)
+        id_anotacion = self.anotaciones.mas_cercano(self.canvas.canvasx(event.x) / self.factor_escala,
+                                                    self.canvas.canvasy(event.y) / self.factor_escala,
+                                                    self.radio_seleccion / self.factor_escala)
+        if id_anotacion is None:
+            return
 
-        # Coordenadas del recuadro en el canvas
-        x1 = x_canvas - mitad_tamano
-        y1 = y_canvas - mitad_tamano
-        x2 = x_canvas + mitad_tamano
-        y2 = y_canvas + mitad_tamano
+        # Eliminar punto y su recuadro asociado
+        punto_id, rect_id = self.anotaciones.eliminar(id_anotacion)
+        self.diario.eliminar(id_anotacion)
+        if punto_id >= 0:
+            self.canvas.delete(punto_id)
+        if rect_id >= 0:
+            self.canvas.delete(rect_id)
 
-        # Crear el recuadro
-        rect_id = self.canvas.create_rectangle(
-            x1, y1, x2, y2,
-            outline="green", width=2
-        )
+        self.estado.config(text=f"Punto eliminado: quedan {len(self.anotaciones)}")
 
-        # Coordenadas del recuadro en la imagen original
-        x_orig = int(x_canvas / self.factor_escala)
-        y_orig = int(y_canvas / self.factor_escala)
-        mitad_orig = tamano // 2
+    def crear_recuadro(self, id_anotacion, dibujar=True):
+        tamano = self.leer_tamano()
 
-        x1_orig = max(0, x_orig - mitad_orig)
-        y1_orig = max(0, y_orig - mitad_orig)
-        x2_orig = min(self.imagen_original.shape[1], x_orig + mitad_orig)
-        y2_orig = min(self.imagen_original.shape[0], y_orig + mitad_orig)
+        # Guardar información del recuadro en coordenadas de la imagen original
+        x_orig = int(self.anotaciones.centros_x[id_anotacion])
+        y_orig = int(self.anotaciones.centros_y[id_anotacion])
+        alto_img, ancho_img = self.imagen_original.forma
+        self.anotaciones.establecer_recuadro(id_anotacion,
+                                             calcular_recuadro(x_orig, y_orig, tamano, ancho_img, alto_img))
 
-        # Guardar información del recuadro
-        self.recuadros.append((rect_id, (x1_orig, y1_orig, x2_orig, y2_orig)))
+        if dibujar:
+            self.dibujar_anotacion(id_anotacion)
 
     def actualizar_recuadros(self):
-        if not self.puntos or self.imagen_original is None:
+        if self.imagen_original is None:
+            return
+        tamano = self.leer_tamano()
+        # También las ocultas por el umbral, para que no reaparezcan con el tamaño anterior
+        ids = self.anotaciones.ids_activos()
+        if not len(ids):
             return
 
-        # Eliminar recuadros actuales
-        for rect_id, _ in self.recuadros:
-            self.canvas.delete(rect_id)
-        self.recuadros = []
+        # Recalcular todos los recuadros con el nuevo tamaño de una sola vez
+        alto_img, ancho_img = self.imagen_original.forma
+        self.anotaciones.establecer_cajas(ids, calcular_recuadros(self.anotaciones.centros(ids), tamano,
+                                                                  ancho_img, alto_img))
+        self.diario.tamano(tamano)
 
-        # Recrear recuadros con el nuevo tamaño
-        for _, (x_orig, y_orig) in self.puntos:
-            x_canvas = int(x_orig * self.factor_escala)
-            y_canvas = int(y_orig * self.factor_escala)
-            self.crear_recuadro(x_canvas, y_canvas)
+        # Mover en su sitio los recuadros ya dibujados en lugar de borrarlos y crearlos de nuevo
+        dibujados = self.anotaciones.ids_con_items()
+        coordenadas = self.anotaciones.cajas_de(dibujados) * self.factor_escala
+        for rect_id, coords in zip(self.anotaciones.ids_recuadro[dibujados].tolist(), coordenadas.tolist()):
+            self.canvas.coords(rect_id, *coords)
 
     def limpiar_puntos(self):
         # Eliminar puntos y recuadros del canvas
         self.canvas.delete("punto")
-        for rect_id, _ in self.recuadros:
-            self.canvas.delete(rect_id)
-
-        self.puntos = []
-        self.recuadros = []
+        self.canvas.delete("recuadro")
+        self.anotaciones.limpiar()
         self.estado.config(text="Puntos y recuadros eliminados")
 
     def exportar_formato_yolo(self):
-        if not self.recuadros or self.imagen_original is None:
+        if not len(self.anotaciones) or self.imagen_original is None:
             messagebox.showwarning("Aviso", "No hay recuadros para exportar")
             return
 
         # Obtener nombre base de la imagen
         nombre_base = os.path.splitext(os.path.basename(self.ruta_imagen))[0]
-
-        # Crear directorio específico para formato YOLO si no existe
         directorio_yolo = os.path.join(self.directorio_base, "yolo")
-        if not os.path.exists(directorio_yolo):
-            os.makedirs(directorio_yolo)
-
-        # Crear directorio de imágenes si no existe
-        directorio_images = os.path.join(directorio_yolo, "images")
-        if not os.path.exists(directorio_images):
-            os.makedirs(directorio_images)
-
-        # Crear directorio de etiquetas si no existe
-        directorio_labels = os.path.join(directorio_yolo, "labels")
-        if not os.path.exists(directorio_labels):
-            os.makedirs(directorio_labels)
-
-        # Guardar la imagen original en formato YOLO
-        ruta_imagen_yolo = os.path.join(directorio_images, f"{nombre_base}.jpg")
-        cv2.imwrite(ruta_imagen_yolo, cv2.cvtColor(self.imagen_original, cv2.COLOR_RGB2BGR))
-
-        # Crear archivo de etiquetas YOLO
-        ruta_etiquetas = os.path.join(directorio_labels, f"{nombre_base}.txt")
-
-        # Obtener dimensiones de la imagen original
-        alto_img, ancho_img = self.imagen_original.shape[:2]
-
-        with open(ruta_etiquetas, 'w') as archivo_yolo:
-            for _, coords in self.recuadros:
-                x1, y1, x2, y2 = coords
-
-                # Calcular valores normalizados para formato YOLO
-                centro_x = (x1 + x2) / 2.0 / ancho_img
-                centro_y = (y1 + y2) / 2.0 / alto_img
-                ancho_rect = (x2 - x1) / ancho_img
-                alto_rect = (y2 - y1) / alto_img
-
-                # Clase 0 para "uva"
-                clase = 0
-
-                # Escribir en formato YOLO: <clase> <centro_x> <centro_y> <ancho> <alto>
-                archivo_yolo.write(f"{clase} {centro_x:.6f} {centro_y:.6f} {ancho_rect:.6f} {alto_rect:.6f}\n")
-
-        # Crear o actualizar archivo classes.txt
-        ruta_clases = os.path.join(directorio_yolo, "classes.txt")
-        if not os.path.exists(ruta_clases):
-            with open(ruta_clases, 'w') as archivo_clases:
-                archivo_clases.write("uva\n")
-
-        # Crear o actualizar archivo dataset.yaml para YOLOv5
-        ruta_yaml = os.path.join(directorio_yolo, "dataset.yaml")
-        with open(ruta_yaml, 'w') as archivo_yaml:
-            archivo_yaml.write(f"path: {os.path.abspath(directorio_yolo)}\n")
-            archivo_yaml.write("train: images/train\n")
-            archivo_yaml.write("val: images/val\n")
-            archivo_yaml.write("test: images/test\n\n")
-            archivo_yaml.write("names:\n  0: uva\n")
-
-        messagebox.showinfo("Éxito",
-                            f"Se han exportado {len(self.recuadros)} anotaciones en formato YOLO en '{directorio_yolo}'")
+
+        # Copia de los recuadros para que las ediciones durante la exportación no afecten al resultado
+        recuadros = self.anotaciones.lista_recuadros()
+        fuente = self.imagen_original
+        ruta = self.ruta_imagen
+
+        def trabajo(tarea):
+            # Imagen original, etiquetas y metadatos en la estructura de directorios de YOLO. Un JPEG
+            # se enlaza sin decodificarlo; los demás formatos se recodifican desde la imagen completa
+            imagen = None if ruta.lower().endswith(('.jpg', '.jpeg')) else fuente.datos()
+            exportar_imagen_yolo(directorio_yolo, nombre_base, imagen, recuadros, rgb=False,
+                                 comprobar=tarea.comprobar, ruta_origen=ruta)
+            # Enlazar la imagen en su partición si el dataset ya se indexó con src/dataset.py
+            actualizar_dataset(directorio_yolo, [nombre_base])
+
+        def al_terminar(_):
+            messagebox.showinfo("Éxito",
+                                f"Se han exportado {len(recuadros)} anotaciones en formato YOLO en '{directorio_yolo}'")
+
+        self.ejecutar_tarea("Exportando YOLO", trabajo, "exportacion", al_terminar, accion="exportar_yolo")
+
+    def opciones_duplicados(self):
+        # (modo, similitud) elegidos en la interfaz, o None si no se buscan duplicados
+        self.modo_duplicados = self.entrada_duplicados.get() or self.modo_duplicados
+        try:
+            similitud = float(self.entrada_similitud.get())
+            if 0.0 < similitud <= 1.0:
+                self.similitud_duplicados = similitud
+        except ValueError:
+            pass
+        if self.modo_duplicados == "no":
+            return None
+        return self.modo_duplicados, self.similitud_duplicados
 
     def convertir_csv_a_yolo(self):
-        # Crear directorios YOLO si no existen
-        directorio_yolo = os.path.join("recortes", "yolo")
-        directorio_images = os.path.join(directorio_yolo, "images")
-        directorio_labels = os.path.join(directorio_yolo, "labels")
-
-        for directorio in [directorio_yolo, directorio_images, directorio_labels]:
-            if not os.path.exists(directorio):
-                os.makedirs(directorio)
-
-        # Recorrer todos los subdirectorios en recortes
-        imagenes_procesadas = 0
-        for directorio in os.listdir("recortes"):
-            ruta_directorio = os.path.join("recortes", directorio)
-            if not os.path.isdir(ruta_directorio) or directorio == "yolo":
-                continue
-
-            # Buscar archivo CSV
-            archivos_csv = [f for f in os.listdir(ruta_directorio) if f.endswith("_coordenadas.csv")]
-            for csv_file in archivos_csv:
-                ruta_csv = os.path.join(ruta_directorio, csv_file)
-                nombre_base = csv_file.replace("_coordenadas.csv", "")
-
-                # Copiar imagen original
-                ruta_imagen_orig = f"imagenes/{nombre_base}.jpg"
-                if os.path.exists(ruta_imagen_orig):
-                    imagen = cv2.imread(ruta_imagen_orig)
-                    if imagen is not None:
-                        alto_img, ancho_img = imagen.shape[:2]
-                        ruta_destino = os.path.join(directorio_images, f"{nombre_base}.jpg")
-                        cv2.imwrite(ruta_destino, imagen)
-
-                        # Crear archivo de etiquetas YOLO
-                        ruta_etiquetas = os.path.join(directorio_labels, f"{nombre_base}.txt")
-                        with open(ruta_csv, 'r') as archivo_csv, open(ruta_etiquetas, 'w') as archivo_yolo:
-                            csv_reader = csv.DictReader(archivo_csv)
-                            for fila in csv_reader:
-                                x1, y1, x2, y2 = map(int, [fila['x1'], fila['y1'], fila['x2'], fila['y2']])
-
-                                # Convertir a formato YOLO
-                                centro_x = (x1 + x2) / 2.0 / ancho_img
-                                centro_y = (y1 + y2) / 2.0 / alto_img
-                                ancho_rect = (x2 - x1) / ancho_img
-                                alto_rect = (y2 - y1) / alto_img
-
-                                # Clase 0 para "uva"
-                                archivo_yolo.write(
-                                    f"0 {centro_x:.6f} {centro_y:.6f} {ancho_rect:.6f} {alto_rect:.6f}\n")
-
-                        imagenes_procesadas += 1
-
-        # Crear archivo classes.txt
-        ruta_clases = os.path.join(directorio_yolo, "classes.txt")
-        with open(ruta_clases, 'w') as archivo_clases:
-            archivo_clases.write("uva\n")
-
-        # Crear archivo dataset.yaml
-        ruta_yaml = os.path.join(directorio_yolo, "dataset.yaml")
-        with open(ruta_yaml, 'w') as archivo_yaml:
-            archivo_yaml.write(f"path: {os.path.abspath(directorio_yolo)}\n")
-            archivo_yaml.write("train: images/train\n")
-            archivo_yaml.write("val: images/val\n")
-            archivo_yaml.write("test: images/test\n\n")
-            archivo_yaml.write("names:\n  0: uva\n")
-
-        messagebox.showinfo("Éxito",
-                            f"Se han convertido {imagenes_procesadas} imágenes y sus anotaciones al formato YOLO")
+        opciones = self.opciones_duplicados()
+
+        def trabajo(tarea):
+            # Conversión en paralelo; solo se procesan los CSV que cambiaron desde la última vez
+            duplicados = None
+            if opciones is not None:
+                duplicados = IndiceDuplicados(self.directorio_base, opciones[1], modo=opciones[0])
+            try:
+                resultado = convertir_csv_a_yolo(self.directorio_base, "imagenes", progreso=tarea.informar,
+                                                 comprobar=tarea.comprobar, duplicados=duplicados)
+            finally:
+                if duplicados is not None:
+                    duplicados.cerrar()
+            actualizar_dataset(os.path.join(self.directorio_base, "yolo"))
+            return resultado, len(duplicados.descartados) if duplicados is not None else 0
+
+        def al_terminar(resultado):
+            (convertidas, omitidas, errores), casi_duplicadas = resultado
+            for ruta_csv, error in errores:
+                print(f"Error al convertir {ruta_csv}: {error}")
+
+            mensaje = f"Se han convertido {convertidas} imágenes y sus anotaciones al formato YOLO"
+            if omitidas:
+                mensaje += f" ({omitidas} sin cambios omitidas)"
+            if casi_duplicadas:
+                accion = "omitidas" if opciones[0] == "omitir" else "marcadas"
+                mensaje += f". {casi_duplicadas} casi duplicadas {accion} (ver duplicados.csv)"
+            if errores:
+                mensaje += f". {len(errores)} con errores"
+            messagebox.showinfo("Éxito", mensaje)
+
+        self.ejecutar_tarea("Convirtiendo CSV a YOLO", trabajo, "exportacion", al_terminar,
+                            accion="convertir_csv_a_yolo")
 
     def guardar_recortes(self):
-        if not self.recuadros or self.imagen_original is None:
+        if not len(self.anotaciones) or self.imagen_original is None:
             messagebox.showwarning("Aviso", "No hay recuadros para guardar")
             return
 
         # Obtener nombre base de la imagen
         nombre_base = os.path.splitext(os.path.basename(self.ruta_imagen))[0]
-
-        # Crear directorio específico para esta imagen
         directorio_salida = os.path.join(self.directorio_base, nombre_base)
-        if not os.path.exists(directorio_salida):
-            os.makedirs(directorio_salida)
-
-        # Crear archivo CSV para las coordenadas
-        ruta_csv = os.path.join(directorio_salida, f"{nombre_base}_coordenadas.csv")
-        with open(ruta_csv, 'w', newline='') as archivo_csv:
-            escritor = csv.writer(archivo_csv)
-            # Escribir cabecera
-            escritor.writerow(['nombre_archivo', 'x1', 'y1', 'x2', 'y2', 'centro_x', 'centro_y'])
 
-            # Guardar cada recorte y sus coordenadas
-            for i, (_, coords) in enumerate(self.recuadros):
-                x1, y1, x2, y2 = coords
-                recorte = self.imagen_original[y1:y2, x1:x2]
-
-                # Calcular el centro del recuadro
-                centro_x = (x1 + x2) // 2
-                centro_y = (y1 + y2) // 2
+        # Opciones de codificación
+        self.formato_recortes = self.entrada_formato.get() or self.formato_recortes
+        try:
+            compresion = int(self.entrada_compresion.get())
+            if 0 <= compresion <= 9:
+                self.compresion_png = compresion
+        except ValueError:
+            pass
+        formato = self.formato_recortes
+        compresion_png = self.compresion_png
+        tamano = self.tamano_recorte
+        opciones = self.opciones_duplicados()
+
+        # Copia de los recuadros para que las ediciones durante el guardado no afecten al resultado
+        recuadros = self.anotaciones.lista_recuadros()
+        fuente = self.imagen_original
+        ruta = self.ruta_imagen
+
+        def trabajo(tarea):
+            imagen = fuente.datos()
+            casi_duplicados = 0
+            if formato == "fragmentos":
+                # Recortes agregados al archivo de fragmentos en lugar de un archivo por uva
+                escribir_recortes_fragmentos(self.directorio_base, nombre_base, imagen, recuadros, tamano,
+                                             rgb=False)
+            else:
+                # Solo se codifican los recortes nuevos o movidos desde el último guardado de esta imagen
+                duplicados = None
+                if opciones is not None:
+                    duplicados = IndiceDuplicados(self.directorio_base, opciones[1], modo=opciones[0])
+                try:
+                    escribir_recortes(directorio_salida, nombre_base, imagen, recuadros, rgb=False,
+                                      formato=formato, compresion_png=compresion_png, hilos=self.hilos_escritura,
+                                      progreso=tarea.informar, comprobar=tarea.comprobar,
+                                      origen=huella_archivo(ruta), duplicados=duplicados)
+                finally:
+                    if duplicados is not None:
+                        duplicados.cerrar()
+                        casi_duplicados = len(duplicados.descartados)
+            # Guardar los recortes cierra la revisión de las detecciones pendientes de la imagen
+            descartar_pendientes(ruta_pendientes(self.directorio_base, ruta))
+            return casi_duplicados
+
+        def al_terminar(casi_duplicados):
+            self.estado.config(text=f"Recortes guardados: {len(recuadros)}")
+            mensaje = f"Se han guardado {len(recuadros)} recortes y sus coordenadas en '{directorio_salida}'"
+            if casi_duplicados:
+                accion = "omitidos" if opciones[0] == "omitir" else "marcados"
+                mensaje += f". {casi_duplicados} recortes casi duplicados {accion} (ver duplicados.csv)"
+            messagebox.showinfo("Éxito", mensaje)
+
+        self.ejecutar_tarea("Guardando recortes", trabajo, "recortes", al_terminar, accion="guardar_recortes",
+                            formato=formato, recortes=len(recuadros))
+
+    def detectar_carpeta(self):
+        if self.modelo is None and not self.cargador_modelo.terminado():
+            self.estado.config(text="Esperando a que termine de cargar el modelo...")
+            self.root.after(200, self.detectar_carpeta)
+            return
+        if self.modelo is None:
+            messagebox.showwarning("Aviso", "El modelo no está disponible")
+            return
 
-                # Convertir de RGB a BGR para guardar con cv2
-                recorte_bgr = cv2.cvtColor(recorte, cv2.COLOR_RGB2BGR)
+        # La carpeta abierta o, si no hay ninguna, la que se elija
+        if self.precargador is not None:
+            rutas = list(self.precargador.rutas)
+        else:
+            directorio = filedialog.askdirectory(title="Seleccionar carpeta a detectar")
+            if not directorio:
+                return
+            rutas = listar_carpeta(directorio)
+        if not rutas:
+            messagebox.showwarning("Aviso", "La carpeta no contiene imágenes")
+            return
 
-                # Nombre del archivo: nombre_imagen_uva_N.png
-                nombre_archivo = f"{nombre_base}_uva_{i + 1}.png"
-                ruta_salida = os.path.join(directorio_salida, nombre_archivo)
+        for entrada, atributo in ((self.entrada_lote, "tamano_lote_carpeta"),
+                                  (self.entrada_hilos, "hilos_carpeta")):
+            try:
+                valor = int(entrada.get())
+                if valor > 0:
+                    setattr(self, atributo, valor)
+            except ValueError:
+                pass
+        modelo = self.modelo
+        cargador = self.cargador_modelo  # La clave de la caché debe ser la del modelo capturado
+        umbral = self.umbral_minimo
+        tamano_lote = self.tamano_lote_carpeta
+        hilos = self.hilos_carpeta
+        directorio_base = self.directorio_base
+
+        def trabajo(tarea):
+            # Las imágenes ya revisadas o pendientes se saltan; las que están en la caché no se infieren
+            a_detectar = []
+            omitidas = desde_cache = 0
+            for ruta in rutas:
+                tarea.comprobar()
+                destino = ruta_pendientes(directorio_base, ruta)
+                if os.path.exists(destino) or revisada(directorio_base, ruta):
+                    omitidas += 1
+                    continue
+                clave = self.clave_cache(ruta, cargador, "directo")
+                resultado = self.cache_detecciones.obtener(clave, umbral) if clave is not None else None
+                if resultado is not None:
+                    guardar_pendientes(destino, resultado)
+                    desde_cache += 1
+                else:
+                    a_detectar.append(ruta)
+
+            def al_detectar(ruta, resultado):
+                # Misma clave que "Detectar uvas": abrir después la imagen no repite la inferencia
+                clave = self.clave_cache(ruta, cargador, "directo")
+                if clave is not None:
+                    self.cache_detecciones.guardar(clave, umbral, resultado)
+                guardar_pendientes(ruta_pendientes(directorio_base, ruta), resultado)
+
+            errores = detectar_carpeta(modelo, a_detectar, umbral, tamano_lote=tamano_lote, hilos=hilos,
+                                       lock=self.lock_modelo, al_detectar=al_detectar,
+                                       progreso=tarea.informar, comprobar=tarea.comprobar)
+            return len(a_detectar) - len(errores), desde_cache, omitidas, errores
+
+        def al_terminar(resultado):
+            detectadas, desde_cache, omitidas, errores = resultado
+            for ruta, error in errores:
+                print(f"Error al detectar {ruta}: {error}")
+
+            # La imagen abierta muestra sus pendientes si aún no tiene anotaciones
+            if self.imagen_original is not None and not len(self.anotaciones):
+                pendientes = leer_pendientes(ruta_pendientes(self.directorio_base, self.ruta_imagen))
+                if pendientes is not None:
+                    self.dibujar_detecciones(pendientes)
+
+            mensaje = f"Se han detectado {detectadas + desde_cache} imágenes, pendientes de revisión"
+            if desde_cache:
+                mensaje += f" ({desde_cache} desde la caché)"
+            if omitidas:
+                mensaje += f". {omitidas} ya revisadas o pendientes omitidas"
+            if errores:
+                mensaje += f". {len(errores)} con errores"
+            messagebox.showinfo("Éxito", mensaje)
+
+        self.ejecutar_tarea("Detectando carpeta", trabajo, "carpeta", al_terminar, accion="detectar_carpeta",
+                            etapa="deteccion", imagenes=len(rutas), lote=tamano_lote, hilos=hilos,
+                            motor=cargador.identificador())
+
+    def ejecutar_tarea(self, nombre, trabajo, grupo, al_terminar, accion, etapa="escritura", **datos):
+        # Lanza un trabajo en segundo plano con los mensajes de error y cancelación comunes, midiendo
+        # su duración como la etapa de la acción indicada
+        if self.ejecutor.ocupado(grupo):
+            messagebox.showwarning("Aviso", "Ya hay una tarea de este tipo en curso")
+            return None
+        accion = self.registro_tiempos.iniciar(accion, **datos)
+
+        def trabajo_medido(tarea):
+            with accion.etapa(etapa):
+                return trabajo(tarea)
+
+        def al_terminar_medido(resultado):
+            # Se cierra antes del mensaje para no contar el tiempo que el diálogo queda abierto
+            self.liberar_imagen()
+            accion.terminar()
+            al_terminar(resultado)
+
+        def al_fallar(e):
+            self.liberar_imagen()
+            accion.terminar(estado="error", error=str(e))
+            messagebox.showerror("Error", f"{nombre}: {str(e)}")
+            print(f"Error detallado: {str(e)}")
 
-                # Guardar recorte
-                cv2.imwrite(ruta_salida, recorte_bgr)
+        def al_cancelar():
+            self.liberar_imagen()
+            accion.terminar(estado="cancelada")
+            self.estado.config(text=f"{nombre}: cancelado")
 
-                # Guardar coordenadas en CSV
-                escritor.writerow([nombre_archivo, x1, y1, x2, y2, centro_x, centro_y])
+        return self.ejecutor.ejecutar(nombre, trabajo_medido, grupo=grupo, al_terminar=al_terminar_medido,
+                                      al_fallar=al_fallar, al_cancelar=al_cancelar)
 
-        messagebox.showinfo("Éxito",
-                            f"Se han guardado {len(self.recuadros)} recortes y sus coordenadas en '{directorio_salida}'")
+    def liberar_imagen(self):
+        # Suelta la imagen completa si supera el presupuesto y la vista actual no usa el nivel 0 de la
+        # pirámide; las tareas en curso conservan su propia referencia al array
+        if self.imagen_original is None or self.visor.piramide is None:
+            return
+        if self.visor.piramide.nivel_para(self.factor_escala) > 0:
+            self.imagen_original.liberar()
+
+    def cambiar_perfilar(self):
+        self.registro_tiempos.perfilar_siguiente = self.modo_perfilar.get()
+
+    def mostrar_tiempos(self, accion):
+        # Se llama en el hilo de la interfaz al cerrar cada acción medida
+        if accion.perfilar:
+            self.modo_perfilar.set(False)
+            self.estado.config(text=f"Perfil de {accion.nombre} guardado en {accion.ruta_perfil}")
+        if self.ver_tiempos.get():
+            self.estado_tiempos.config(text=accion.resumen())
 
 
 # Iniciar aplicación
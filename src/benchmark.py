@@ -0,0 +1,331 @@
+"""
+Pruebas de rendimiento de los caminos críticos de la herramienta.
+
+Se ejecutan sin pantalla, con imágenes sintéticas y un modelo simulado, y escriben los
+tiempos en un JSON para comparar versiones. Cubren el renderizado de mostrar_imagen, la
+detección completa de detectar_uvas, la búsqueda de eliminar_punto, guardar_recortes,
+exportar_formato_yolo y convertir_csv_a_yolo.
+
+Uso:
+    python src/benchmark.py --salida benchmark.json
+    python src/benchmark.py --rapido --grupos eliminar_punto guardar_recortes
+"""
+
+import argparse
+import csv
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from anotaciones import AlmacenAnotaciones
+from deteccion import detectar_en_memoria, detectar_por_teselas
+from exportacion import (CABECERA_CSV, calcular_recuadros, convertir_csv_a_yolo, escribir_recortes,
+                         escribir_recortes_fragmentos, exportar_imagen_yolo)
+from motores import ResultadoOnnx
+from visor import PiramideImagen, VisorTeselas
+
+GRUPOS = ("mostrar_imagen", "detectar_uvas", "eliminar_punto", "guardar_recortes", "exportar_yolo",
+          "convertir_csv_a_yolo")
+
+
+def imagen_sintetica(rng, alto, ancho):
+    # Manchas suaves con algo de ruido: se comprime como una foto, no como ruido puro
+    base = rng.integers(0, 256, size=(max(2, alto // 32), max(2, ancho // 32), 3), dtype=np.uint8)
+    imagen = cv2.resize(base, (ancho, alto), interpolation=cv2.INTER_CUBIC)
+    ruido = rng.integers(-8, 9, size=imagen.shape, dtype=np.int16)
+    return np.clip(imagen.astype(np.int16) + ruido, 0, 255).astype(np.uint8)
+
+
+def centros_aleatorios(rng, cantidad, alto, ancho):
+    return np.stack([rng.integers(0, ancho, cantidad), rng.integers(0, alto, cantidad)], axis=1)
+
+
+class ModeloSimulado:
+    # Sustituto del modelo YOLO: devuelve cajas aleatorias reproducibles tras una latencia fija,
+    # con la misma interfaz que el modelo de ultralytics o ModeloOnnx
+    def __init__(self, detecciones=200, latencia_ms=0.0, semilla=0, lado=60):
+        self.detecciones = detecciones
+        self.latencia_ms = latencia_ms
+        self.semilla = semilla
+        self.lado = lado
+
+    def __call__(self, imagenes, conf=0.25, verbose=False):
+        if isinstance(imagenes, np.ndarray):
+            imagenes = [imagenes]
+        resultados = []
+        for imagen in imagenes:
+            alto, ancho = imagen.shape[:2]
+            rng = np.random.default_rng(self.semilla)
+            centros = centros_aleatorios(rng, self.detecciones, alto, ancho).astype(np.float32)
+            cajas = np.concatenate([centros - self.lado / 2, centros + self.lado / 2], axis=1)
+            cajas = np.clip(cajas, 0, [ancho, alto, ancho, alto]).astype(np.float32)
+            puntuaciones = rng.uniform(0.05, 1.0, self.detecciones).astype(np.float32)
+            mascara = puntuaciones >= conf
+            if self.latencia_ms:
+                time.sleep(self.latencia_ms / 1000.0)
+            resultados.append(ResultadoOnnx(cajas[mascara], puntuaciones[mascara],
+                                            np.zeros(int(mascara.sum()), dtype=np.float32),
+                                            {"inference": self.latencia_ms}))
+        return resultados
+
+
+def medir(funcion, repeticiones, preparar=None, calentamiento=1):
+    # Tiempos en milisegundos de cada repetición; preparar() se ejecuta fuera de la medida
+    tiempos = []
+    for i in range(calentamiento + repeticiones):
+        if preparar is not None:
+            preparar()
+        inicio = time.perf_counter()
+        funcion()
+        transcurrido = (time.perf_counter() - inicio) * 1000.0
+        if i >= calentamiento:
+            tiempos.append(transcurrido)
+    tiempos = np.asarray(tiempos)
+    return {"min": float(tiempos.min()), "mediana": float(np.median(tiempos)),
+            "media": float(tiempos.mean()), "max": float(tiempos.max())}
+
+
+class Banco:
+    def __init__(self, repeticiones=5, semilla=0, rapido=False, directorio=None):
+        self.repeticiones = repeticiones
+        self.semilla = semilla
+        self.rapido = rapido
+        self.directorio = directorio
+        self.resultados = []
+        self._imagenes = {}
+
+    def imagen(self, alto, ancho):
+        clave = (alto, ancho)
+        if clave not in self._imagenes:
+            self._imagenes[clave] = imagen_sintetica(np.random.default_rng(self.semilla), alto, ancho)
+        return self._imagenes[clave]
+
+    def resoluciones(self):
+        return [(960, 1280)] if self.rapido else [(960, 1280), (3000, 4000), (6000, 8000)]
+
+    def registrar(self, grupo, caso, parametros, tiempos, **extra):
+        self.resultados.append({"grupo": grupo, "caso": caso, "parametros": parametros,
+                                "repeticiones": self.repeticiones, "ms": tiempos, **extra})
+        print(f"{grupo:22s} {caso:28s} {json.dumps(parametros):48s} mediana {tiempos['mediana']:9.2f} ms")
+
+    def mostrar_imagen(self):
+        # Lo que hace mostrar_imagen sin Tk: pirámide al abrir y píxeles de las teselas visibles
+        # para un canvas de 880x680 al ajustar, al 100 % y con zoom x4 (sin crear las PhotoImage)
+        ancho_canvas, alto_canvas = 880, 680
+        for alto, ancho in self.resoluciones():
+            imagen = self.imagen(alto, ancho)
+            parametros = {"alto": alto, "ancho": ancho}
+            self.registrar("mostrar_imagen", "piramide", parametros,
+                           medir(lambda: PiramideImagen(imagen), self.repeticiones))
+
+            visor = VisorTeselas(None)
+            visor.piramide = PiramideImagen(imagen)
+            ajuste = min(ancho_canvas / ancho, alto_canvas / alto) * 0.95
+            for nombre, escala in [("ajuste", ajuste), ("escala_1", 1.0), ("zoom_4", 4.0)]:
+                region = (0, 0, ancho_canvas, alto_canvas)
+
+                def renderizar():
+                    for tx, ty in visor.teselas_visibles(escala, region):
+                        visor.pixeles_tesela(escala, tx, ty)
+
+                self.registrar("mostrar_imagen", f"teselas_{nombre}", dict(parametros, escala=round(escala, 4)),
+                               medir(renderizar, self.repeticiones))
+
+    def detectar_uvas(self):
+        # Detección con el modelo simulado y carga de los resultados en el almacén de anotaciones,
+        # igual que detectar_uvas + dibujar_detecciones salvo el dibujo en el canvas
+        tamano = 150
+        for alto, ancho in self.resoluciones():
+            imagen = self.imagen(alto, ancho)
+            for detecciones in ([200] if self.rapido else [200, 2000]):
+                modelo = ModeloSimulado(detecciones, semilla=self.semilla)
+                for teselas in (False, True):
+                    def completa():
+                        if teselas:
+                            resultado = detectar_por_teselas(modelo, imagen, 0.1)
+                        else:
+                            resultado = detectar_en_memoria(modelo, imagen, 0.1)
+                        anotaciones = AlmacenAnotaciones()
+                        ids = anotaciones.agregar_varios(resultado.centros, resultado.puntuaciones)
+                        cajas = calcular_recuadros(resultado.centros, tamano, ancho, alto)
+                        anotaciones.establecer_cajas(ids, cajas)
+                        anotaciones.umbral = 0.5
+                        return anotaciones.ids()
+
+                    caso = "teselas" if teselas else "directa"
+                    parametros = {"alto": alto, "ancho": ancho, "detecciones": detecciones}
+                    self.registrar("detectar_uvas", caso, parametros, medir(completa, self.repeticiones))
+
+    def eliminar_punto(self):
+        # Búsqueda del punto más cercano al clic con N anotaciones en una imagen de 4000x3000
+        rng = np.random.default_rng(self.semilla)
+        consultas = 1000
+        for cantidad in (10, 100, 1000, 10000):
+            anotaciones = AlmacenAnotaciones()
+            centros = centros_aleatorios(rng, cantidad, 3000, 4000)
+            anotaciones.agregar_varios(centros, np.ones(cantidad, dtype=np.float32))
+            # La mitad de los clics caen cerca de un punto y la otra mitad en cualquier sitio
+            mitad = consultas // 2
+            cercanos = centros[rng.integers(0, cantidad, mitad)] + rng.integers(-3, 4, (mitad, 2))
+            clics = np.concatenate([cercanos, centros_aleatorios(rng, consultas - mitad, 3000, 4000)])
+            clics = clics.tolist()
+
+            def buscar():
+                for x, y in clics:
+                    anotaciones.mas_cercano(x, y, 5.0)
+
+            tiempos = medir(buscar, self.repeticiones)
+            self.registrar("eliminar_punto", "mas_cercano", {"puntos": cantidad, "consultas": consultas}, tiempos,
+                           us_por_consulta=tiempos["mediana"] * 1000.0 / consultas)
+
+    def guardar_recortes(self):
+        alto, ancho = (960, 1280) if self.rapido else (3000, 4000)
+        imagen = self.imagen(alto, ancho)
+        rng = np.random.default_rng(self.semilla)
+        hilos = min(8, os.cpu_count() or 1)
+        destino = os.path.join(self.directorio, "recortes")
+
+        def vaciar():
+            shutil.rmtree(destino, ignore_errors=True)
+
+        for cantidad in ([50] if self.rapido else [50, 500]):
+            centros = centros_aleatorios(rng, cantidad, alto, ancho)
+            recuadros = [tuple(caja) for caja in calcular_recuadros(centros, 150, ancho, alto).tolist()]
+            parametros = {"recortes": cantidad, "alto": alto, "ancho": ancho}
+            for formato, hilos_escritura in sorted({("png", 1), ("png", hilos), ("webp", hilos)}):
+                self.registrar("guardar_recortes", f"{formato}_{hilos_escritura}_hilos", parametros,
+                               medir(lambda: escribir_recortes(os.path.join(destino, "imagen"), "imagen", imagen,
+                                                               recuadros, formato=formato, hilos=hilos_escritura),
+                                     self.repeticiones, preparar=vaciar))
+
+            # Volver a guardar tras quitar un punto y añadir otro: solo se codifica el recorte nuevo
+            x1, y1, x2, y2 = recuadros[0]
+            editados = recuadros[2:] + [(x1 + 1, y1, x2 + 1, y2)]
+            origen = {"imagen": "sintetica", "alto": alto, "ancho": ancho}
+
+            def guardar_todo():
+                vaciar()
+                escribir_recortes(os.path.join(destino, "imagen"), "imagen", imagen, recuadros[1:], hilos=hilos,
+                                  origen=origen)
+
+            self.registrar("guardar_recortes", f"png_incremental_{hilos}_hilos", parametros,
+                           medir(lambda: escribir_recortes(os.path.join(destino, "imagen"), "imagen", imagen,
+                                                           editados, hilos=hilos, origen=origen),
+                                 self.repeticiones, preparar=guardar_todo))
+
+            # Los fragmentos se agregan a los mismos archivos en cada repetición, como en el uso real;
+            # el escritor queda abierto en la caché del módulo, así que cada tamaño usa su directorio
+            destino_fragmentos = os.path.join(self.directorio, f"fragmentos_{cantidad}")
+            self.registrar("guardar_recortes", "fragmentos", parametros,
+                           medir(lambda: escribir_recortes_fragmentos(destino_fragmentos, "imagen", imagen,
+                                                                      recuadros, 150), self.repeticiones))
+
+    def exportar_yolo(self):
+        rng = np.random.default_rng(self.semilla)
+        directorio_yolo = os.path.join(self.directorio, "yolo")
+        for alto, ancho in self.resoluciones():
+            imagen = self.imagen(alto, ancho)
+            recuadros = calcular_recuadros(centros_aleatorios(rng, 200, alto, ancho), 150, ancho, alto).tolist()
+            self.registrar("exportar_yolo", "imagen_y_etiquetas", {"alto": alto, "ancho": ancho, "recuadros": 200},
+                           medir(lambda: exportar_imagen_yolo(directorio_yolo, "imagen", imagen, recuadros),
+                                 self.repeticiones))
+        shutil.rmtree(directorio_yolo, ignore_errors=True)
+
+    def convertir_csv_a_yolo(self):
+        # Conjuntos de N imágenes JPEG con su CSV de coordenadas, convertidos desde cero y de nuevo
+        # sin cambios (todas se omiten gracias al manifiesto)
+        rng = np.random.default_rng(self.semilla)
+        alto, ancho = 960, 1280
+        for cantidad in ([10, 50] if self.rapido else [10, 100, 500]):
+            base = os.path.join(self.directorio, f"conjunto_{cantidad}")
+            directorio_imagenes, directorio_recortes = self._generar_conjunto(rng, base, cantidad, alto, ancho)
+            directorio_yolo = os.path.join(directorio_recortes, "yolo")
+            parametros = {"imagenes": cantidad}
+
+            def borrar_salida():
+                shutil.rmtree(directorio_yolo, ignore_errors=True)
+
+            self.registrar("convertir_csv_a_yolo", "completa", parametros,
+                           medir(lambda: convertir_csv_a_yolo(directorio_recortes, directorio_imagenes),
+                                 self.repeticiones, preparar=borrar_salida))
+            self.registrar("convertir_csv_a_yolo", "sin_cambios", parametros,
+                           medir(lambda: convertir_csv_a_yolo(directorio_recortes, directorio_imagenes),
+                                 self.repeticiones))
+            shutil.rmtree(base, ignore_errors=True)
+
+    def _generar_conjunto(self, rng, base, cantidad, alto, ancho):
+        directorio_imagenes = os.path.join(base, "imagenes")
+        directorio_recortes = os.path.join(base, "recortes")
+        os.makedirs(directorio_imagenes, exist_ok=True)
+        imagen = self.imagen(alto, ancho)
+        for i in range(cantidad):
+            nombre_base = f"imagen_{i:05d}"
+            cv2.imwrite(os.path.join(directorio_imagenes, f"{nombre_base}.jpg"), imagen)
+            directorio_salida = os.path.join(directorio_recortes, nombre_base)
+            os.makedirs(directorio_salida, exist_ok=True)
+            cajas = calcular_recuadros(centros_aleatorios(rng, 30, alto, ancho), 150, ancho, alto)
+            ruta_csv = os.path.join(directorio_salida, f"{nombre_base}_coordenadas.csv")
+            with open(ruta_csv, 'w', newline='') as archivo:
+                escritor = csv.writer(archivo)
+                escritor.writerow(CABECERA_CSV)
+                for j, (x1, y1, x2, y2) in enumerate(cajas.tolist()):
+                    escritor.writerow([f"{nombre_base}_uva_{j + 1}.png", x1, y1, x2, y2,
+                                       (x1 + x2) // 2, (y1 + y2) // 2])
+        return directorio_imagenes, directorio_recortes
+
+
+def entorno():
+    try:
+        version = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                 cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        version = None
+    return {"fecha": datetime.now().isoformat(timespec="seconds"), "version": version,
+            "python": platform.python_version(), "plataforma": platform.platform(),
+            "procesador": platform.processor(), "cpus": os.cpu_count(),
+            "numpy": np.__version__, "opencv": cv2.__version__}
+
+
+def crear_parser():
+    parser = argparse.ArgumentParser(description="Pruebas de rendimiento sin interfaz gráfica")
+    parser.add_argument("--salida", default="benchmark.json", help="Archivo JSON de resultados")
+    parser.add_argument("--repeticiones", type=int, default=5, help="Repeticiones medidas de cada caso")
+    parser.add_argument("--semilla", type=int, default=0, help="Semilla de los datos sintéticos")
+    parser.add_argument("--rapido", action="store_true", help="Solo los tamaños pequeños")
+    parser.add_argument("--grupos", nargs="*", choices=GRUPOS, default=list(GRUPOS), help="Grupos a ejecutar")
+    return parser
+
+
+def main(argv=None):
+    opciones = crear_parser().parse_args(argv)
+
+    directorio = tempfile.mkdtemp(prefix="benchmark_uvas_")
+    try:
+        banco = Banco(opciones.repeticiones, opciones.semilla, opciones.rapido, directorio)
+        for grupo in opciones.grupos:
+            getattr(banco, grupo)()
+    finally:
+        shutil.rmtree(directorio, ignore_errors=True)
+
+    informe = {"entorno": entorno(), "opciones": {"repeticiones": opciones.repeticiones,
+                                                  "semilla": opciones.semilla, "rapido": opciones.rapido},
+               "resultados": banco.resultados}
+    with open(opciones.salida, 'w') as archivo:
+        json.dump(informe, archivo, indent=2)
+    print(f"Resultados guardados en {opciones.salida}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
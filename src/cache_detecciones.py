@@ -0,0 +1,129 @@
+import hashlib
+import os
+import threading
+
+import numpy as np
+
+from deteccion import ResultadoDeteccion
+
+DIRECTORIO_CACHE = ".cache_detecciones"
+
+
+def hash_archivo(ruta, bloque=1024 * 1024):
+    resumen = hashlib.blake2b(digest_size=16)
+    with open(ruta, 'rb') as archivo:
+        for trozo in iter(lambda: archivo.read(bloque), b""):
+            resumen.update(trozo)
+    return resumen.hexdigest()
+
+
+class CacheDetecciones:
+    # Detecciones crudas (antes de NMS y desde un umbral mínimo) guardadas en disco, un .npz por
+    # entrada, para poder cambiar el umbral sin volver a inferir. Las claves incluyen el hash del
+    # contenido de la imagen y el de los pesos del modelo, así que un archivo renombrado sigue
+    # acertando y un modelo reentrenado no. Cuando el directorio supera max_bytes se borran
+    # primero las entradas usadas hace más tiempo.
+    def __init__(self, directorio=DIRECTORIO_CACHE, max_bytes=256 * 1024 * 1024):
+        self.directorio = directorio
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._hashes = {}
+        os.makedirs(directorio, exist_ok=True)
+
+        # Índice en memoria: nombre -> [tamaño, último uso]
+        self._entradas = {}
+        for entrada in os.scandir(directorio):
+            if entrada.name.endswith(".npz"):
+                estado = entrada.stat()
+                self._entradas[entrada.name] = [estado.st_size, estado.st_mtime]
+            elif entrada.name.endswith(".tmp"):
+                # Escritura interrumpida en una sesión anterior
+                os.remove(entrada.path)
+        self._total = sum(tamano for tamano, _ in self._entradas.values())
+
+    def huella(self, ruta):
+        # Hash del contenido, recordado mientras el archivo no cambie de tamaño ni de fecha
+        estado = os.stat(ruta)
+        clave = (os.path.abspath(ruta), estado.st_size, estado.st_mtime_ns)
+        with self._lock:
+            valor = self._hashes.get(clave)
+        if valor is None:
+            valor = hash_archivo(ruta)
+            with self._lock:
+                self._hashes[clave] = valor
+        return valor
+
+    def clave(self, ruta_imagen, ruta_modelo, *configuracion):
+        return (self.huella(ruta_imagen), self.huella(ruta_modelo)) + configuracion
+
+    def _nombre(self, clave):
+        return hashlib.blake2b(repr(clave).encode(), digest_size=16).hexdigest() + ".npz"
+
+    def obtener(self, clave, umbral_confianza):
+        nombre = self._nombre(clave)
+        with self._lock:
+            if nombre not in self._entradas:
+                return None
+        ruta = os.path.join(self.directorio, nombre)
+        try:
+            with np.load(ruta) as datos:
+                if umbral_confianza < float(datos["umbral_minimo"]):
+                    return None
+                resultado = ResultadoDeteccion(datos["cajas"], datos["puntuaciones"], datos["clases"])
+            os.utime(ruta)
+        except (OSError, ValueError, KeyError):
+            # Entrada borrada o dañada: se trata como un fallo de caché
+            self._quitar(nombre)
+            return None
+
+        with self._lock:
+            if nombre in self._entradas:
+                self._entradas[nombre][1] = os.stat(ruta).st_mtime
+        return resultado
+
+    def guardar(self, clave, umbral_minimo, resultado):
+        nombre = self._nombre(clave)
+        ruta = os.path.join(self.directorio, nombre)
+        temporal = f"{ruta}.{threading.get_ident()}.tmp"
+        with open(temporal, 'wb') as archivo:
+            np.savez(archivo, cajas=resultado.cajas, puntuaciones=resultado.puntuaciones,
+                     clases=resultado.clases, umbral_minimo=np.float32(umbral_minimo))
+        os.replace(temporal, ruta)
+        estado = os.stat(ruta)
+
+        with self._lock:
+            anterior = self._entradas.pop(nombre, None)
+            if anterior is not None:
+                self._total -= anterior[0]
+            self._entradas[nombre] = [estado.st_size, estado.st_mtime]
+            self._total += estado.st_size
+            sobrantes = self._sobrantes()
+        for nombre_sobrante in sobrantes:
+            self._borrar(nombre_sobrante)
+
+    def _sobrantes(self):
+        # Nombres a desalojar, del uso más antiguo al más reciente, hasta volver bajo max_bytes
+        sobrantes = []
+        for nombre, (tamano, _) in sorted(self._entradas.items(), key=lambda item: item[1][1]):
+            if self._total <= self.max_bytes:
+                break
+            del self._entradas[nombre]
+            self._total -= tamano
+            sobrantes.append(nombre)
+        return sobrantes
+
+    def _quitar(self, nombre):
+        with self._lock:
+            anterior = self._entradas.pop(nombre, None)
+            if anterior is not None:
+                self._total -= anterior[0]
+        self._borrar(nombre)
+
+    def _borrar(self, nombre):
+        try:
+            os.remove(os.path.join(self.directorio, nombre))
+        except FileNotFoundError:
+            pass
+
+    def __len__(self):
+        return len(self._entradas)
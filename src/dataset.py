@@ -0,0 +1,327 @@
+"""
+Índice y particiones train/val/test del dataset YOLO exportado.
+
+Las exportaciones escriben todas las imágenes en yolo/images/ y todas las etiquetas en
+yolo/labels/. Este módulo guarda en yolo/dataset.sqlite una fila por imagen con su número
+de etiquetas y estadísticas de sus cajas, la asigna a train, val o test estratificando por
+número de uvas, y crea en images/<partición>/ y labels/<partición>/ enlaces duros (o
+simbólicos) a los archivos planos, que es lo que espera dataset.yaml. La asignación depende
+solo de la semilla y del nombre de cada imagen, así que es reproducible, y una imagen ya
+asignada no cambia de partición al volver a exportar. Tras la primera construcción, las
+exportaciones de la aplicación y de lote.py actualizan el índice de forma incremental.
+
+Uso:
+    python src/dataset.py recortes/yolo --val 0.2 --test 0.1 --semilla 0
+"""
+
+import argparse
+import hashlib
+import os
+import sqlite3
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from exportacion import escribir_metadatos_yolo, leer_dimensiones
+
+ARCHIVO_INDICE = "dataset.sqlite"
+PARTICIONES = ("train", "val", "test")
+EXTENSIONES = ('.png', '.jpg', '.jpeg', '.bmp')
+
+# Estratos por número de etiquetas: 0, 1-10, 11-50, 51-200 y más de 200 uvas
+CORTES_ESTRATOS = (0, 10, 50, 200)
+
+ESQUEMA = """
+CREATE TABLE IF NOT EXISTS configuracion (clave TEXT PRIMARY KEY, valor TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS imagenes (
+    nombre TEXT PRIMARY KEY,
+    archivo TEXT NOT NULL,
+    ancho INTEGER,
+    alto INTEGER,
+    etiquetas INTEGER NOT NULL,
+    area_media REAL,
+    area_min REAL,
+    area_max REAL,
+    ancho_medio REAL,
+    alto_medio REAL,
+    firma_imagen TEXT NOT NULL,
+    firma_etiquetas TEXT,
+    estrato INTEGER NOT NULL,
+    particion TEXT NOT NULL
+);
+"""
+
+
+def firma(ruta):
+    # Cambia si el archivo se reescribe o se sustituye por otro (nuevo inodo); None si no existe
+    try:
+        estado = os.stat(ruta)
+    except FileNotFoundError:
+        return None
+    return f"{estado.st_size}:{estado.st_mtime_ns}:{estado.st_ino}"
+
+
+def estadisticas_etiquetas(ruta_etiquetas):
+    # Número de cajas y estadísticas de su tamaño normalizado (área, ancho y alto relativos a la imagen)
+    try:
+        with open(ruta_etiquetas, 'r') as archivo:
+            valores = archivo.read().split()
+    except FileNotFoundError:
+        valores = []
+    cajas = np.array(valores, dtype=np.float64).reshape(-1, 5)
+    if not len(cajas):
+        return 0, None, None, None, None, None
+    areas = cajas[:, 3] * cajas[:, 4]
+    return (len(cajas), float(areas.mean()), float(areas.min()), float(areas.max()),
+            float(cajas[:, 3].mean()), float(cajas[:, 4].mean()))
+
+
+def estrato(etiquetas):
+    return int(np.searchsorted(CORTES_ESTRATOS, etiquetas))
+
+
+def orden_reproducible(semilla, nombre):
+    return hashlib.blake2b(f"{semilla}:{nombre}".encode(), digest_size=8).hexdigest()
+
+
+def enlazar(origen, destino, simbolico=False):
+    # Enlace duro por defecto; si el sistema de archivos no lo permite, enlace simbólico relativo
+    if os.path.lexists(destino):
+        os.remove(destino)
+    if not simbolico:
+        try:
+            os.link(origen, destino)
+            return
+        except OSError:
+            pass
+    os.symlink(os.path.relpath(origen, os.path.dirname(destino)), destino)
+
+
+class IndiceDataset:
+    # Índice SQLite del dataset YOLO de un directorio. La configuración de la partición (fracciones,
+    # semilla y tipo de enlace) se guarda en el propio índice para que las actualizaciones
+    # incrementales repartan igual que la primera construcción.
+    def __init__(self, directorio_yolo):
+        self.directorio_yolo = directorio_yolo
+        self.directorio_images = os.path.join(directorio_yolo, "images")
+        self.directorio_labels = os.path.join(directorio_yolo, "labels")
+        self.ruta = os.path.join(directorio_yolo, ARCHIVO_INDICE)
+        self.conexion = sqlite3.connect(self.ruta)
+        self.conexion.executescript(ESQUEMA)
+
+    def cerrar(self):
+        self.conexion.close()
+
+    def configuracion(self):
+        valores = dict(self.conexion.execute("SELECT clave, valor FROM configuracion"))
+        return {"val": float(valores.get("val", 0.2)), "test": float(valores.get("test", 0.1)),
+                "semilla": int(valores.get("semilla", 0)), "simbolico": valores.get("simbolico") == "1"}
+
+    def configurar(self, val=0.2, test=0.1, semilla=0, simbolico=False):
+        if val < 0 or test < 0 or val + test >= 1:
+            raise ValueError("Las fracciones de val y test deben ser positivas y sumar menos de 1")
+        valores = {"val": val, "test": test, "semilla": semilla, "simbolico": "1" if simbolico else "0"}
+        with self.conexion:
+            self.conexion.executemany("INSERT OR REPLACE INTO configuracion VALUES (?, ?)",
+                                      [(clave, str(valor)) for clave, valor in valores.items()])
+
+    def _archivos(self, nombres=None):
+        # nombre -> archivo de imagen en el directorio plano images/
+        if nombres is None:
+            return {os.path.splitext(entrada.name)[0]: entrada.name
+                    for entrada in os.scandir(self.directorio_images)
+                    if entrada.is_file() and entrada.name.lower().endswith(EXTENSIONES)}
+        archivos = {}
+        for nombre in nombres:
+            for extension in EXTENSIONES:
+                if os.path.exists(os.path.join(self.directorio_images, nombre + extension)):
+                    archivos[nombre] = nombre + extension
+                    break
+        return archivos
+
+    def actualizar(self, nombres=None, reparticionar=False):
+        # Sin nombres se recorre todo images/ y se quitan del índice las imágenes que ya no están;
+        # con nombres solo se revisan esas (lo que acaba de exportarse). Devuelve un resumen de cambios.
+        configuracion = self.configuracion()
+        if reparticionar:
+            with self.conexion:
+                self.conexion.execute("DELETE FROM imagenes")
+            for particion in PARTICIONES:
+                for directorio in (self.directorio_images, self.directorio_labels):
+                    ruta = os.path.join(directorio, particion)
+                    if os.path.isdir(ruta):
+                        for entrada in os.scandir(ruta):
+                            os.remove(entrada.path)
+
+        archivos = self._archivos(nombres)
+        consulta = "SELECT nombre, archivo, firma_imagen, firma_etiquetas, particion FROM imagenes"
+        if nombres is None:
+            filas = self.conexion.execute(consulta).fetchall()
+        else:
+            filas = [fila for nombre in nombres
+                     for fila in self.conexion.execute(consulta + " WHERE nombre = ?", (nombre,))]
+        indexadas = {fila[0]: fila[1:] for fila in filas}
+
+        eliminadas = [nombre for nombre in indexadas if nombre not in archivos]
+        for nombre in eliminadas:
+            self._quitar_enlaces(nombre, indexadas[nombre][0], indexadas[nombre][3])
+
+        nuevas, cambiadas = [], []
+        for nombre, archivo in archivos.items():
+            firma_imagen = firma(os.path.join(self.directorio_images, archivo))
+            firma_etiquetas = firma(os.path.join(self.directorio_labels, f"{nombre}.txt"))
+            anterior = indexadas.get(nombre)
+            if anterior is None:
+                nuevas.append((nombre, archivo, firma_imagen, firma_etiquetas))
+            elif anterior[:3] != (archivo, firma_imagen, firma_etiquetas):
+                if anterior[0] != archivo:
+                    self._quitar_enlaces(nombre, anterior[0], anterior[3])
+                cambiadas.append((nombre, archivo, firma_imagen, firma_etiquetas, anterior[3]))
+
+        # Las imágenes nuevas se reparten en un orden que solo depende de la semilla y del nombre
+        nuevas.sort(key=lambda entrada: orden_reproducible(configuracion["semilla"], entrada[0]))
+        cuentas = self._cuentas()
+        filas_nuevas = []
+        for nombre, archivo, firma_imagen, firma_etiquetas in nuevas:
+            *datos, estrato_imagen = self._datos(nombre, archivo)
+            particion = self._elegir_particion(cuentas, estrato_imagen, configuracion)
+            filas_nuevas.append((nombre, archivo, *datos, firma_imagen, firma_etiquetas, estrato_imagen,
+                                 particion))
+            self._enlazar(nombre, archivo, particion, configuracion["simbolico"])
+
+        filas_cambiadas = []
+        for nombre, archivo, firma_imagen, firma_etiquetas, particion in cambiadas:
+            # Una imagen reexportada conserva su partición aunque cambie su número de uvas
+            *datos, estrato_imagen = self._datos(nombre, archivo)
+            filas_cambiadas.append((nombre, archivo, *datos, firma_imagen, firma_etiquetas, estrato_imagen,
+                                    particion))
+            self._enlazar(nombre, archivo, particion, configuracion["simbolico"])
+
+        with self.conexion:
+            self.conexion.executemany("DELETE FROM imagenes WHERE nombre = ?",
+                                      [(nombre,) for nombre in eliminadas])
+            self.conexion.executemany(f"INSERT OR REPLACE INTO imagenes VALUES ({', '.join(['?'] * 14)})",
+                                      filas_nuevas + filas_cambiadas)
+        return {"nuevas": len(nuevas), "cambiadas": len(cambiadas), "eliminadas": len(eliminadas)}
+
+    def _datos(self, nombre, archivo):
+        # (ancho, alto, etiquetas, area_media, area_min, area_max, ancho_medio, alto_medio, estrato)
+        try:
+            ancho, alto = leer_dimensiones(os.path.join(self.directorio_images, archivo))
+        except OSError:
+            ancho, alto = None, None
+        etiquetas = estadisticas_etiquetas(os.path.join(self.directorio_labels, f"{nombre}.txt"))
+        return (ancho, alto) + etiquetas + (estrato(etiquetas[0]),)
+
+    def _cuentas(self):
+        # estrato -> {partición: imágenes}
+        cuentas = {}
+        for estrato_fila, particion, cantidad in self.conexion.execute(
+                "SELECT estrato, particion, COUNT(*) FROM imagenes GROUP BY estrato, particion"):
+            cuentas.setdefault(estrato_fila, dict.fromkeys(PARTICIONES, 0))[particion] = cantidad
+        return cuentas
+
+    def _elegir_particion(self, cuentas, estrato_imagen, configuracion):
+        # La partición más por debajo de su fracción dentro del estrato; en empate, la primera
+        cuenta = cuentas.setdefault(estrato_imagen, dict.fromkeys(PARTICIONES, 0))
+        total = sum(cuenta.values()) + 1
+        fracciones = {"train": 1 - configuracion["val"] - configuracion["test"], "val": configuracion["val"],
+                      "test": configuracion["test"]}
+        particion = max(PARTICIONES, key=lambda p: fracciones[p] * total - cuenta[p])
+        cuenta[particion] += 1
+        return particion
+
+    def _enlazar(self, nombre, archivo, particion, simbolico):
+        directorio_images = os.path.join(self.directorio_images, particion)
+        directorio_labels = os.path.join(self.directorio_labels, particion)
+        os.makedirs(directorio_images, exist_ok=True)
+        os.makedirs(directorio_labels, exist_ok=True)
+        enlazar(os.path.join(self.directorio_images, archivo), os.path.join(directorio_images, archivo),
+                simbolico)
+        ruta_etiquetas = os.path.join(self.directorio_labels, f"{nombre}.txt")
+        destino_etiquetas = os.path.join(directorio_labels, f"{nombre}.txt")
+        if os.path.exists(ruta_etiquetas):
+            enlazar(ruta_etiquetas, destino_etiquetas, simbolico)
+        elif os.path.lexists(destino_etiquetas):
+            # Sin etiquetas la imagen cuenta como fondo
+            os.remove(destino_etiquetas)
+
+    def _quitar_enlaces(self, nombre, archivo, particion):
+        for ruta in (os.path.join(self.directorio_images, particion, archivo),
+                     os.path.join(self.directorio_labels, particion, f"{nombre}.txt")):
+            if os.path.lexists(ruta):
+                os.remove(ruta)
+
+    def resumen(self):
+        # Por partición: imágenes, etiquetas totales, media de uvas por imagen y área media de las cajas
+        consulta = ("SELECT particion, COUNT(*), COALESCE(SUM(etiquetas), 0), AVG(etiquetas), "
+                    "SUM(area_media * etiquetas) / NULLIF(SUM(etiquetas), 0) FROM imagenes GROUP BY particion")
+        filas = {fila[0]: fila[1:] for fila in self.conexion.execute(consulta)}
+        return {particion: dict(zip(("imagenes", "etiquetas", "uvas_por_imagen", "area_media"),
+                                    filas.get(particion, (0, 0, None, None))))
+                for particion in PARTICIONES}
+
+
+def actualizar_dataset(directorio_yolo, nombres=None):
+    # Mantiene al día el índice tras una exportación, solo si ya se construyó antes con este módulo
+    if not os.path.exists(os.path.join(directorio_yolo, ARCHIVO_INDICE)):
+        return None
+    indice = IndiceDataset(directorio_yolo)
+    try:
+        return indice.actualizar(nombres)
+    finally:
+        indice.cerrar()
+
+
+def crear_parser():
+    parser = argparse.ArgumentParser(description="Indexa el dataset YOLO exportado y lo divide en train/val/test")
+    parser.add_argument("directorio", nargs="?", default=os.path.join("recortes", "yolo"),
+                        help="Directorio YOLO con images/ y labels/ (por defecto: recortes/yolo)")
+    parser.add_argument("--val", type=float, default=None, help="Fracción de validación (por defecto: 0.2)")
+    parser.add_argument("--test", type=float, default=None, help="Fracción de prueba (por defecto: 0.1)")
+    parser.add_argument("--semilla", type=int, default=None, help="Semilla del reparto (por defecto: 0)")
+    parser.add_argument("--simbolicos", action="store_true", help="Usar enlaces simbólicos en lugar de duros")
+    parser.add_argument("--reparticionar", action="store_true",
+                        help="Rehacer el reparto desde cero (necesario al cambiar fracciones o semilla)")
+    return parser
+
+
+def main(argv=None):
+    opciones = crear_parser().parse_args(argv)
+    if not os.path.isdir(os.path.join(opciones.directorio, "images")):
+        print(f"No existe el directorio {os.path.join(opciones.directorio, 'images')}")
+        return 1
+
+    nuevo = not os.path.exists(os.path.join(opciones.directorio, ARCHIVO_INDICE))
+    indice = IndiceDataset(opciones.directorio)
+    try:
+        configuracion = indice.configuracion()
+        cambios = {"val": opciones.val, "test": opciones.test, "semilla": opciones.semilla}
+        cambios = {clave: valor for clave, valor in cambios.items() if valor is not None}
+        distinta = any(configuracion[clave] != valor for clave, valor in cambios.items())
+        if distinta and not (nuevo or opciones.reparticionar):
+            print("Cambiar las fracciones o la semilla requiere --reparticionar")
+            return 1
+        configuracion.update(cambios)
+        if opciones.simbolicos:
+            configuracion["simbolico"] = True
+        indice.configurar(**configuracion)
+
+        resultado = indice.actualizar(reparticionar=opciones.reparticionar)
+        print(f"{resultado['nuevas']} nuevas, {resultado['cambiadas']} cambiadas, "
+              f"{resultado['eliminadas']} eliminadas")
+        for particion, datos in indice.resumen().items():
+            area = f"{datos['area_media']:.5f}" if datos["area_media"] is not None else "-"
+            print(f"{particion:<6} {datos['imagenes']:>7} imágenes {datos['etiquetas']:>9} etiquetas "
+                  f"{datos['uvas_por_imagen'] or 0:>8.1f} uvas/imagen  área media {area}")
+    finally:
+        indice.cerrar()
+
+    escribir_metadatos_yolo(opciones.directorio, sobrescribir_clases=False)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
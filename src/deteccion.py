@@ -0,0 +1,206 @@
+import time
+from dataclasses import dataclass, field
+
+import numpy as np
+
+
+@dataclass
+class ResultadoDeteccion:
+    # Cajas en coordenadas de la imagen original (x1, y1, x2, y2)
+    cajas: np.ndarray
+    puntuaciones: np.ndarray
+    clases: np.ndarray
+    # Tiempos en milisegundos por etapa (preproceso, inferencia, postproceso, total)
+    tiempos: dict = field(default_factory=dict)
+
+    def __len__(self):
+        return len(self.cajas)
+
+    @property
+    def centros(self):
+        # Centros enteros, igual que el cálculo original (x1 + x2) // 2
+        cajas = self.cajas.astype(int)
+        return np.stack([(cajas[:, 0] + cajas[:, 2]) // 2,
+                         (cajas[:, 1] + cajas[:, 3]) // 2], axis=1)
+
+    def filtrar(self, umbral):
+        mascara = self.puntuaciones >= umbral
+        return ResultadoDeteccion(self.cajas[mascara], self.puntuaciones[mascara],
+                                  self.clases[mascara], dict(self.tiempos))
+
+
+def resultado_desde_yolo(resultado, tiempos=None):
+    # Convierte un objeto Results de ultralytics en un ResultadoDeteccion
+    cajas = resultado.boxes.cpu().numpy()
+    return ResultadoDeteccion(
+        cajas.xyxy.astype(np.float32).reshape(-1, 4),
+        cajas.conf.astype(np.float32).reshape(-1),
+        cajas.cls.astype(np.float32).reshape(-1),
+        dict(tiempos or {}),
+    )
+
+
+def detectar_en_memoria(modelo, imagen_bgr, umbral_confianza=0.5):
+    # imagen_bgr en el orden de canales de cv2.imread, que es el que espera YOLO
+    inicio = time.perf_counter()
+
+    resultado = modelo(imagen_bgr, conf=umbral_confianza, verbose=False)[0]
+
+    velocidad = getattr(resultado, "speed", None) or {}
+    tiempos = {
+        "preproceso": velocidad.get("preprocess", 0.0),
+        "inferencia": velocidad.get("inference", 0.0),
+        "postproceso": velocidad.get("postprocess", 0.0),
+    }
+    deteccion = resultado_desde_yolo(resultado, tiempos)
+    deteccion.tiempos["total"] = (time.perf_counter() - inicio) * 1000.0
+    return deteccion
+
+
+def detectar_lote(modelo, imagenes_bgr, umbral_confianza=0.5):
+    # Inferencia de varias imágenes BGR en una sola llamada al modelo
+    if not imagenes_bgr:
+        return []
+
+    inicio = time.perf_counter()
+    resultados = modelo(list(imagenes_bgr), conf=umbral_confianza, verbose=False)
+    total = (time.perf_counter() - inicio) * 1000.0
+
+    detecciones = []
+    for resultado in resultados:
+        velocidad = getattr(resultado, "speed", None) or {}
+        detecciones.append(resultado_desde_yolo(resultado, {
+            "preproceso": velocidad.get("preprocess", 0.0),
+            "inferencia": velocidad.get("inference", 0.0),
+            "postproceso": velocidad.get("postprocess", 0.0),
+            "total": total / len(resultados),
+        }))
+    return detecciones
+
+
+def generar_teselas(alto, ancho, tamano=640, solape=0.2):
+    # Devuelve (x1, y1, x2, y2) de cada tesela; las del borde se desplazan hacia dentro
+    # para que todas tengan el tamaño completo cuando la imagen es mayor que la tesela
+    paso = max(1, int(tamano * (1.0 - solape)))
+
+    def inicios(longitud):
+        if longitud <= tamano:
+            return [0]
+        posiciones = list(range(0, longitud - tamano, paso))
+        posiciones.append(longitud - tamano)
+        return posiciones
+
+    return [(x, y, min(x + tamano, ancho), min(y + tamano, alto))
+            for y in inicios(alto) for x in inicios(ancho)]
+
+
+def nms(cajas, puntuaciones, umbral_iou=0.5, en_borde=None, umbral_contenida=0.6):
+    # Supresión de no máximos vectorizada; devuelve los índices conservados. Las cajas en_borde
+    # (cortadas por el borde de una tesela) van después de las completas y, si comparten más de
+    # umbral_contenida del área de la menor con otra, se suprimen aunque su IoU sea bajo
+    if len(cajas) == 0:
+        return np.zeros(0, dtype=np.int64)
+
+    x1, y1, x2, y2 = cajas[:, 0], cajas[:, 1], cajas[:, 2], cajas[:, 3]
+    areas = np.maximum(0.0, x2 - x1) * np.maximum(0.0, y2 - y1)
+    if en_borde is None:
+        orden = np.argsort(-puntuaciones, kind="stable")
+    else:
+        orden = np.lexsort((-puntuaciones, en_borde))
+
+    conservados = []
+    while orden.size > 0:
+        i = orden[0]
+        conservados.append(i)
+        resto = orden[1:]
+
+        ancho_inter = np.maximum(0.0, np.minimum(x2[i], x2[resto]) - np.maximum(x1[i], x1[resto]))
+        alto_inter = np.maximum(0.0, np.minimum(y2[i], y2[resto]) - np.maximum(y1[i], y1[resto]))
+        interseccion = ancho_inter * alto_inter
+        iou = interseccion / np.maximum(areas[i] + areas[resto] - interseccion, 1e-9)
+        suprimir = iou > umbral_iou
+        if en_borde is not None:
+            contenida = interseccion / np.maximum(np.minimum(areas[i], areas[resto]), 1e-9)
+            suprimir |= (contenida > umbral_contenida) & (en_borde[i] | en_borde[resto])
+
+        orden = resto[~suprimir]
+
+    return np.asarray(conservados, dtype=np.int64)
+
+
+def cortadas_por_teselas(cajas, teselas, ancho, alto, margen=2.0):
+    # Cajas que acaban en un borde interior de alguna tesela: la uva seguía fuera de la tesela y
+    # la caja está truncada. Los bordes que coinciden con los de la imagen no cuentan.
+    teselas = np.asarray(teselas, dtype=np.float32).reshape(-1, 4)
+    izquierdos = np.unique(teselas[teselas[:, 0] > 0, 0])
+    superiores = np.unique(teselas[teselas[:, 1] > 0, 1])
+    derechos = np.unique(teselas[teselas[:, 2] < ancho, 2])
+    inferiores = np.unique(teselas[teselas[:, 3] < alto, 3])
+
+    def toca(valores, bordes):
+        if not len(bordes):
+            return np.zeros(len(valores), dtype=bool)
+        return (np.abs(valores[:, None] - bordes[None, :]) <= margen).any(axis=1)
+
+    return (toca(cajas[:, 0], izquierdos) | toca(cajas[:, 1], superiores)
+            | toca(cajas[:, 2], derechos) | toca(cajas[:, 3], inferiores))
+
+
+def detectar_por_teselas(modelo, imagen_bgr, umbral_confianza=0.5, tamano_tesela=640, solape=0.2,
+                         tamano_lote=8, umbral_iou=0.5, cache=None, clave_cache=None,
+                         umbral_minimo=0.1, progreso=None, comprobar=None):
+    # progreso(hechos, total) informa de las teselas procesadas; comprobar() se llama entre lotes
+    # y puede lanzar una excepción para cancelar la detección
+    inicio = time.perf_counter()
+    alto, ancho = imagen_bgr.shape[:2]
+    clave = (clave_cache, alto, ancho, tamano_tesela, solape)
+
+    teselas = generar_teselas(alto, ancho, tamano_tesela, solape)
+    crudo = None
+    if cache is not None and clave_cache is not None:
+        crudo = cache.obtener(clave, umbral_confianza)
+
+    tiempos = {"preproceso": 0.0, "inferencia": 0.0, "postproceso": 0.0}
+    if crudo is None:
+        umbral_inferencia = min(umbral_confianza, umbral_minimo)
+
+        cajas, puntuaciones, clases = [], [], []
+        for i in range(0, len(teselas), tamano_lote):
+            if comprobar is not None:
+                comprobar()
+            lote = teselas[i:i + tamano_lote]
+            # Vistas sin copia de cada tesela, procesadas en un solo lote por el modelo
+            recortes = [imagen_bgr[y1:y2, x1:x2] for x1, y1, x2, y2 in lote]
+            resultados = modelo(recortes, conf=umbral_inferencia, verbose=False)
+
+            for (x1, y1, _, _), resultado in zip(lote, resultados):
+                velocidad = getattr(resultado, "speed", None) or {}
+                tiempos["preproceso"] += velocidad.get("preprocess", 0.0)
+                tiempos["inferencia"] += velocidad.get("inference", 0.0)
+                tiempos["postproceso"] += velocidad.get("postprocess", 0.0)
+
+                parcial = resultado_desde_yolo(resultado)
+                # Trasladar las cajas de la tesela a coordenadas de la imagen completa
+                cajas.append(parcial.cajas + np.array([x1, y1, x1, y1], dtype=np.float32))
+                puntuaciones.append(parcial.puntuaciones)
+                clases.append(parcial.clases)
+
+            if progreso is not None:
+                progreso(min(i + tamano_lote, len(teselas)), len(teselas))
+
+        crudo = ResultadoDeteccion(np.concatenate(cajas), np.concatenate(puntuaciones),
+                                   np.concatenate(clases))
+        if cache is not None and clave_cache is not None:
+            cache.guardar(clave, umbral_inferencia, crudo)
+
+    # Filtrar por umbral y fusionar las detecciones repetidas en las zonas de solape
+    inicio_fusion = time.perf_counter()
+    filtrado = crudo.filtrar(umbral_confianza)
+    # Una uva partida entre teselas da una caja truncada en cada una: se queda la completa
+    en_borde = cortadas_por_teselas(filtrado.cajas, teselas, ancho, alto)
+    indices = nms(filtrado.cajas, filtrado.puntuaciones, umbral_iou, en_borde=en_borde)
+    tiempos["fusion"] = (time.perf_counter() - inicio_fusion) * 1000.0
+    tiempos["total"] = (time.perf_counter() - inicio) * 1000.0
+
+    return ResultadoDeteccion(filtrado.cajas[indices], filtrado.puntuaciones[indices],
+                              filtrado.clases[indices], tiempos)
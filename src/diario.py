@@ -0,0 +1,206 @@
+import hashlib
+import os
+import struct
+
+import numpy as np
+
+from exportacion import calcular_recuadro, calcular_recuadros
+
+DIRECTORIO_SESION = ".sesion"
+
+# Cada registro es (operación, longitud de los datos) seguido de los datos en little-endian
+CABECERA = struct.Struct("<BI")
+IMAGEN, AGREGAR, ELIMINAR, TAMANO, UMBRAL, DETECTAR, ESTADO = range(7)
+AGREGAR_DATOS = struct.Struct("<iifi")  # x, y, puntuación, tamaño del recuadro
+DETECTAR_DATOS = struct.Struct("<ifI")  # tamaño del recuadro, umbral, número de detecciones
+ESTADO_DATOS = struct.Struct("<fiII")  # umbral, tamaño del recuadro, ids usados, anotaciones activas
+
+
+class DiarioSesion:
+    # Diario de solo escritura con las ediciones de cada imagen (.sesion/<hash de la ruta>.bin):
+    # añadir, eliminar, cambiar el tamaño de los recuadros, el umbral o una detección completa.
+    # Cada acción añade unos pocos bytes, así que un cierre inesperado o abrir otra imagen por
+    # error no pierde nada; al volver a abrir la imagen (o al arrancar, la última abierta) se
+    # reproduce el diario. Cada max_registros se compacta en un único registro con el estado.
+    def __init__(self, directorio=DIRECTORIO_SESION, max_registros=2000, max_diarios=500):
+        self.directorio = directorio
+        self.max_registros = max_registros
+        self.max_diarios = max_diarios
+        self.ruta_imagen = None
+        self.tamano_recuadro = 0  # Último tamaño de recuadro usado en la imagen abierta
+        self._archivo = None
+        self._almacen = None
+        self._registros = 0
+        self._dimensiones = (0, 0)
+        os.makedirs(directorio, exist_ok=True)
+
+    def _ruta(self, ruta_imagen):
+        nombre = hashlib.blake2b(os.path.abspath(ruta_imagen).encode(), digest_size=12).hexdigest()
+        return os.path.join(self.directorio, f"{nombre}.bin")
+
+    def ultima_imagen(self):
+        # Imagen abierta al terminar la sesión anterior, o None
+        try:
+            with open(os.path.join(self.directorio, "actual"), 'r', encoding="utf-8") as archivo:
+                ruta = archivo.read().strip()
+        except OSError:
+            return None
+        return ruta if ruta and os.path.exists(ruta) else None
+
+    def abrir(self, ruta_imagen, ancho, alto, almacen, tamano=0):
+        # Empieza a registrar las ediciones de la imagen sobre almacen. Si ya tenía un diario con
+        # ediciones, las reproduce en almacen y devuelve True; tamano_recuadro queda entonces con
+        # el tamaño de recuadro de la sesión restaurada.
+        self.cerrar()
+        self.ruta_imagen = ruta_imagen
+        self.tamano_recuadro = tamano
+        self._almacen = almacen
+        self._dimensiones = (ancho, alto)
+        ruta = self._ruta(ruta_imagen)
+
+        restaurado = False
+        if os.path.exists(ruta):
+            with open(ruta, 'rb') as archivo:
+                datos = archivo.read()
+            try:
+                restaurado = self._reproducir(datos, almacen)
+            except (struct.error, ValueError, IndexError) as e:
+                # Diario dañado: se conserva lo reproducido hasta el error
+                print(f"Diario de sesión dañado para {ruta_imagen}: {str(e)}")
+                restaurado = len(almacen) > 0
+
+        # El diario reproducido se reescribe compactado: cada apertura empieza con un archivo pequeño
+        self._archivo = None
+        self.compactar()
+        with open(os.path.join(self.directorio, "actual"), 'w', encoding="utf-8") as archivo:
+            archivo.write(ruta_imagen)
+        self._podar()
+        return restaurado
+
+    def cerrar(self):
+        if self._archivo is not None:
+            self._archivo.close()
+            self._archivo = None
+
+    def _escribir(self, operacion, datos=b""):
+        if self._archivo is None:
+            return
+        self._archivo.write(CABECERA.pack(operacion, len(datos)) + datos)
+        self._registros += 1
+        if self._registros >= self.max_registros:
+            self.compactar()
+
+    def agregar(self, x, y, puntuacion, tamano):
+        self.tamano_recuadro = tamano
+        self._escribir(AGREGAR, AGREGAR_DATOS.pack(int(x), int(y), float(puntuacion), int(tamano)))
+
+    def eliminar(self, id_anotacion):
+        self._escribir(ELIMINAR, struct.pack("<I", int(id_anotacion)))
+
+    def tamano(self, tamano):
+        self.tamano_recuadro = tamano
+        self._escribir(TAMANO, struct.pack("<i", int(tamano)))
+
+    def umbral(self, umbral):
+        self._escribir(UMBRAL, struct.pack("<f", float(umbral)))
+
+    def detectar(self, centros, puntuaciones, tamano, umbral):
+        # Una detección sustituye todas las anotaciones anteriores de la imagen
+        self.tamano_recuadro = tamano
+        datos = (DETECTAR_DATOS.pack(int(tamano), float(umbral), len(centros))
+                 + np.ascontiguousarray(centros, dtype="<i4").tobytes()
+                 + np.ascontiguousarray(puntuaciones, dtype="<f4").tobytes())
+        self._escribir(DETECTAR, datos)
+
+    def compactar(self):
+        # Reescribe el diario como la imagen y un único registro de estado, de forma atómica
+        if self.ruta_imagen is None:
+            return
+        ancho, alto = self._dimensiones
+        n, ids, centros, puntuaciones, cajas = self._almacen.instantanea()
+        ruta_bytes = self.ruta_imagen.encode("utf-8")
+        estado = (ESTADO_DATOS.pack(float(self._almacen.umbral), int(self.tamano_recuadro), n, len(ids))
+                  + np.ascontiguousarray(ids, dtype="<i4").tobytes()
+                  + np.ascontiguousarray(centros, dtype="<i4").tobytes()
+                  + np.ascontiguousarray(puntuaciones, dtype="<f4").tobytes()
+                  + np.ascontiguousarray(cajas, dtype="<i4").tobytes())
+        imagen = struct.pack("<II", ancho, alto) + ruta_bytes
+
+        self.cerrar()
+        ruta = self._ruta(self.ruta_imagen)
+        temporal = f"{ruta}.tmp"
+        with open(temporal, 'wb') as archivo:
+            archivo.write(CABECERA.pack(IMAGEN, len(imagen)) + imagen)
+            archivo.write(CABECERA.pack(ESTADO, len(estado)) + estado)
+        os.replace(temporal, ruta)
+        # Sin búfer: cada registro llega al sistema operativo en cuanto se escribe
+        self._archivo = open(ruta, 'ab', buffering=0)
+        self._registros = 0
+
+    def _reproducir(self, datos, almacen):
+        # Aplica los registros sobre almacen; un último registro incompleto (escritura cortada) se
+        # ignora. Devuelve True si había alguna anotación o edición que restaurar.
+        ancho, alto = self._dimensiones
+        posicion = 0
+        ediciones = False
+        while posicion + CABECERA.size <= len(datos):
+            operacion, longitud = CABECERA.unpack_from(datos, posicion)
+            inicio = posicion + CABECERA.size
+            if inicio + longitud > len(datos):
+                break
+            carga = memoryview(datos)[inicio:inicio + longitud]
+            posicion = inicio + longitud
+
+            if operacion == IMAGEN:
+                continue
+            ediciones = True
+            if operacion == AGREGAR:
+                x, y, puntuacion, tamano = AGREGAR_DATOS.unpack(carga)
+                self.tamano_recuadro = tamano
+                id_anotacion = almacen.agregar(x, y, puntuacion)
+                almacen.establecer_recuadro(id_anotacion, calcular_recuadro(x, y, tamano, ancho, alto))
+            elif operacion == ELIMINAR:
+                almacen.eliminar(struct.unpack("<I", carga)[0])
+            elif operacion == TAMANO:
+                tamano = struct.unpack("<i", carga)[0]
+                self.tamano_recuadro = tamano
+                ids = almacen.ids_activos()
+                almacen.establecer_cajas(ids, calcular_recuadros(almacen.centros(ids), tamano, ancho, alto))
+            elif operacion == UMBRAL:
+                almacen.umbral = struct.unpack("<f", carga)[0]
+            elif operacion == DETECTAR:
+                tamano, umbral, cantidad = DETECTAR_DATOS.unpack_from(carga)
+                desplazamiento = DETECTAR_DATOS.size
+                centros = np.frombuffer(carga, "<i4", cantidad * 2, desplazamiento).reshape(-1, 2)
+                puntuaciones = np.frombuffer(carga, "<f4", cantidad, desplazamiento + cantidad * 8)
+                almacen.limpiar()
+                ids = almacen.agregar_varios(centros, puntuaciones)
+                almacen.establecer_cajas(ids, calcular_recuadros(centros, tamano, ancho, alto))
+                almacen.umbral = umbral
+                self.tamano_recuadro = tamano
+            elif operacion == ESTADO:
+                umbral, tamano, n, cantidad = ESTADO_DATOS.unpack_from(carga)
+                desplazamiento = ESTADO_DATOS.size
+                ids = np.frombuffer(carga, "<i4", cantidad, desplazamiento).astype(np.intp)
+                desplazamiento += cantidad * 4
+                centros = np.frombuffer(carga, "<i4", cantidad * 2, desplazamiento).reshape(-1, 2)
+                desplazamiento += cantidad * 8
+                puntuaciones = np.frombuffer(carga, "<f4", cantidad, desplazamiento)
+                desplazamiento += cantidad * 4
+                cajas = np.frombuffer(carga, "<i4", cantidad * 4, desplazamiento).reshape(-1, 4)
+                almacen.restaurar(n, ids, centros, puntuaciones, cajas)
+                almacen.umbral = umbral
+                if tamano > 0:
+                    self.tamano_recuadro = tamano
+                ediciones = n > 0
+        return ediciones
+
+    def _podar(self):
+        # Conserva solo los diarios de las max_diarios imágenes usadas más recientemente
+        diarios = [entrada for entrada in os.scandir(self.directorio) if entrada.name.endswith(".bin")]
+        if len(diarios) <= self.max_diarios:
+            return
+        diarios.sort(key=lambda entrada: entrada.stat().st_mtime)
+        for entrada in diarios[:len(diarios) - self.max_diarios]:
+            if entrada.path != self._ruta(self.ruta_imagen):
+                os.remove(entrada.path)
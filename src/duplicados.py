@@ -0,0 +1,279 @@
+import csv
+import os
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import cv2
+import numpy as np
+
+ARCHIVO_INDICE = "duplicados.sqlite"
+ARCHIVO_INFORME = "duplicados.csv"
+METODOS = ("phash", "dhash")
+MODOS = ("omitir", "marcar")
+
+# Bits a 1 de cada byte, para contar la distancia de Hamming de muchos hashes a la vez
+BITS_POR_BYTE = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+
+def _matriz_dct(n=32):
+    # DCT-II ortonormal: la DCT 2D de un bloque X es D @ X @ D.T
+    k = np.arange(n)[:, None]
+    i = np.arange(n)[None, :]
+    matriz = np.sqrt(2.0 / n) * np.cos(np.pi * (2 * i + 1) * k / (2 * n))
+    matriz[0] /= np.sqrt(2.0)
+    return matriz
+
+
+DCT_32 = _matriz_dct(32)
+
+
+def _empaquetar(bits):
+    # (N, 64) booleanos -> (N,) uint64
+    return np.packbits(bits, axis=1).view(">u8").reshape(-1).astype(np.uint64)
+
+
+def dhash(grises):
+    # grises: (N, 8, 9). Cada bit indica si un píxel es más claro que su vecino de la derecha
+    grises = np.asarray(grises, dtype=np.float32)
+    return _empaquetar((grises[:, :, 1:] > grises[:, :, :-1]).reshape(len(grises), 64))
+
+
+def phash(grises):
+    # grises: (N, 32, 32). Bits de las 8x8 frecuencias más bajas de la DCT comparadas con su mediana
+    grises = np.asarray(grises, dtype=np.float32)
+    frecuencias = np.einsum("ij,njk,lk->nil", DCT_32, grises, DCT_32, optimize=True)[:, :8, :8]
+    frecuencias = frecuencias.reshape(len(grises), 64)
+    # Sin la componente continua, que solo refleja el brillo medio
+    medianas = np.median(frecuencias[:, 1:], axis=1, keepdims=True)
+    return _empaquetar(frecuencias > medianas)
+
+
+def _reducir(imagen, metodo):
+    if imagen.ndim == 3:
+        imagen = cv2.cvtColor(imagen, cv2.COLOR_BGR2GRAY)
+    forma = (9, 8) if metodo == "dhash" else (32, 32)
+    return cv2.resize(imagen, forma, interpolation=cv2.INTER_AREA)
+
+
+def hashes_imagenes(imagenes, metodo="phash"):
+    # Hash de cada imagen (o recorte) de la lista; las de tamaño cero reciben 0
+    if not len(imagenes):
+        return np.zeros(0, dtype=np.uint64)
+    lado = (8, 9) if metodo == "dhash" else (32, 32)
+    reducidas = np.stack([_reducir(imagen, metodo) if imagen.size else np.zeros(lado, np.uint8)
+                          for imagen in imagenes])
+    return dhash(reducidas) if metodo == "dhash" else phash(reducidas)
+
+
+def _leer_gris(ruta):
+    # Basta una decodificación reducida: el hash solo mira 32x32 píxeles
+    imagen = cv2.imread(ruta, cv2.IMREAD_REDUCED_GRAYSCALE_8)
+    if imagen is None:
+        raise IOError(f"No se pudo leer la imagen {ruta}")
+    return imagen
+
+
+def hashes_archivos(rutas, metodo="phash", hilos=4):
+    with ThreadPoolExecutor(max_workers=max(1, hilos)) as pool:
+        return hashes_imagenes(list(pool.map(_leer_gris, rutas)), metodo)
+
+
+def distancias(hash_valor, hashes):
+    # Distancia de Hamming entre un hash y un array de hashes
+    diferencias = np.bitwise_xor(np.asarray(hashes, dtype=np.uint64), np.uint64(hash_valor))
+    return BITS_POR_BYTE[diferencias.view(np.uint8)].reshape(-1, 8).sum(axis=1)
+
+
+class _IndiceHamming:
+    # Hash más cercano a distancia <= maximo sin compararlo con todos (multi-índice): partidos los
+    # 64 bits en maximo + 1 trozos, dos hashes a esa distancia coinciden al menos en uno, así que
+    # basta comparar con los que comparten algún trozo. Los grupos de los hashes indexados son
+    # arrays; los agregados después van en listas hasta que son tantos que conviene reindexar.
+    # Con trozos de menos de 8 bits los grupos son demasiado grandes y se compara con todos.
+    def __init__(self, hashes, capacidad, maximo):
+        self.maximo = maximo
+        self.n = len(hashes)
+        self.hashes = np.empty(self.n + capacidad, dtype=np.uint64)
+        self.hashes[:self.n] = hashes
+        self.trozos = []
+        if maximo + 1 <= 8:
+            limites = np.linspace(0, 64, maximo + 2).astype(int).tolist()
+            self.trozos = [(inicio, (1 << (fin - inicio)) - 1) for inicio, fin in zip(limites[:-1], limites[1:])]
+        self._reindexar()
+
+    def _reindexar(self):
+        self._indexados = self.n
+        self._iniciales = []  # por trozo: valor del trozo -> array de posiciones
+        self._agregados = [{} for _ in self.trozos]  # por trozo: valor del trozo -> lista de posiciones
+        for inicio, mascara in self.trozos:
+            valores = (self.hashes[:self.n] >> np.uint64(inicio)) & np.uint64(mascara)
+            orden = np.argsort(valores)
+            ordenados = valores[orden]
+            cortes = np.flatnonzero(ordenados[1:] != ordenados[:-1]) + 1
+            primeros = np.concatenate(([0], cortes)) if self.n else cortes
+            self._iniciales.append(dict(zip(ordenados[primeros].tolist(), np.split(orden, cortes))))
+
+    def agregar(self, valor):
+        posicion = self.n
+        self.hashes[posicion] = valor
+        self.n += 1
+        if not self.trozos:
+            return
+        if self.n - self._indexados > max(1024, self._indexados):
+            self._reindexar()
+            return
+        valor = int(valor)
+        for agregados, (inicio, mascara) in zip(self._agregados, self.trozos):
+            agregados.setdefault((valor >> inicio) & mascara, []).append(posicion)
+
+    def mas_cercano(self, valor):
+        # (posición, distancia) del más cercano a distancia <= maximo, o None. Entre varios a la
+        # misma distancia gana el de menor posición, el primero aceptado.
+        if not self.trozos:
+            candidatos = np.arange(self.n)
+        else:
+            grupos = []
+            entero = int(valor)
+            for iniciales, agregados, (inicio, mascara) in zip(self._iniciales, self._agregados, self.trozos):
+                trozo = (entero >> inicio) & mascara
+                grupo = iniciales.get(trozo)
+                if grupo is not None:
+                    grupos.append(grupo)
+                grupo = agregados.get(trozo)
+                if grupo:
+                    grupos.append(np.asarray(grupo, dtype=np.intp))
+            if not grupos:
+                return None
+            candidatos = np.concatenate(grupos)
+        if not len(candidatos):
+            return None
+        distancia = distancias(valor, self.hashes[candidatos])
+        minima = int(distancia.min())
+        if minima > self.maximo:
+            return None
+        return int(candidatos[distancia == minima].min()), minima
+
+
+class IndiceDuplicados:
+    # Hashes perceptuales de las imágenes de origen y de los recortes ya aceptados, en SQLite. Un
+    # elemento cuya similitud (1 - distancia de Hamming / 64) con alguno ya aceptado llega a
+    # umbral se considera casi duplicado: con modo "omitir" no se guarda y con "marcar" se guarda
+    # igualmente; en ambos casos se anota en duplicados.csv. La decisión de cada elemento se
+    # recuerda mientras su firma no cambie, así que repetir la exportación da el mismo resultado.
+    def __init__(self, directorio, umbral=0.9, metodo="phash", modo="omitir"):
+        if metodo not in METODOS:
+            raise ValueError(f"Método de hash no válido: {metodo}")
+        if modo not in MODOS:
+            raise ValueError(f"Modo no válido: {modo}")
+        self.directorio = directorio
+        self.umbral = umbral
+        self.metodo = metodo
+        self.modo = modo
+        self.descartados = []  # (tipo, clave, original, similitud) detectados en esta sesión
+        self._lock = threading.Lock()
+        os.makedirs(directorio, exist_ok=True)
+        self.conexion = sqlite3.connect(os.path.join(directorio, ARCHIVO_INDICE), check_same_thread=False)
+        self.conexion.execute("CREATE TABLE IF NOT EXISTS hashes (tipo TEXT NOT NULL, metodo TEXT NOT NULL, "
+                              "clave TEXT NOT NULL, hash INTEGER NOT NULL, firma TEXT, duplicado_de TEXT, "
+                              "similitud REAL, PRIMARY KEY (tipo, metodo, clave))")
+        self.conexion.commit()
+
+    def cerrar(self):
+        self.conexion.close()
+
+    @property
+    def omitir(self):
+        return self.modo == "omitir"
+
+    def _aceptados(self, tipo):
+        # Claves y hashes de los elementos de un tipo que no son duplicados de otro
+        filas = self.conexion.execute("SELECT clave, hash FROM hashes WHERE tipo = ? AND metodo = ? "
+                                      "AND duplicado_de IS NULL", (tipo, self.metodo)).fetchall()
+        # SQLite guarda enteros con signo: se reinterpretan los mismos 64 bits
+        return ([clave for clave, _ in filas],
+                np.array([valor for _, valor in filas], dtype=np.int64).view(np.uint64))
+
+    def olvidar(self, tipo, prefijo):
+        # Quita las entradas cuya clave empieza por prefijo (p. ej. los recortes de una imagen que se
+        # vuelve a guardar), para que no se comparen consigo mismas. El rango [prefijo, siguiente)
+        # usa la clave primaria en lugar de recorrer toda la tabla.
+        siguiente = prefijo[:-1] + chr(ord(prefijo[-1]) + 1)
+        with self._lock, self.conexion:
+            self.conexion.execute("DELETE FROM hashes WHERE tipo = ? AND metodo = ? AND clave >= ? "
+                                  "AND clave < ?", (tipo, self.metodo, prefijo, siguiente))
+
+    def _previas(self, tipo, claves, firmas):
+        # clave -> (original o None, similitud) para las claves ya evaluadas con la misma firma
+        previas = {}
+        for clave, firma in zip(claves, firmas):
+            fila = self.conexion.execute("SELECT firma, duplicado_de, similitud FROM hashes WHERE tipo = ? "
+                                         "AND metodo = ? AND clave = ?", (tipo, self.metodo, clave)).fetchone()
+            if fila is not None and firma is not None and fila[0] == firma:
+                previas[clave] = (fila[1], fila[2])
+        return previas
+
+    def evaluadas(self, tipo, claves, firmas):
+        # Claves cuya decisión anterior sigue valiendo: no hace falta volver a calcular su hash
+        with self._lock:
+            return set(self._previas(tipo, claves, firmas))
+
+    def filtrar(self, tipo, claves, hashes, firmas=None):
+        # Evalúa los elementos en orden y devuelve un array booleano con los casi duplicados. El
+        # primero de cada grupo de parecidos se acepta; los siguientes se comparan con él.
+        firmas = list(firmas) if firmas is not None else [None] * len(claves)
+        hashes = np.asarray(hashes, dtype=np.uint64)
+        duplicados = np.zeros(len(claves), dtype=bool)
+        nuevos_descartes = []
+        with self._lock:
+            previas = self._previas(tipo, claves, firmas)
+
+            # Lo que se vuelve a evaluar no puede compararse con su propia entrada anterior
+            claves_aceptadas, hashes_indice = self._aceptados(tipo)
+            reevaluadas = set(claves) - set(previas)
+            conservar = np.array([clave not in reevaluadas for clave in claves_aceptadas], dtype=bool)
+            claves_aceptadas = [clave for clave, sigue in zip(claves_aceptadas, conservar) if sigue]
+            # similitud >= umbral equivale a una distancia de Hamming <= maximo
+            maximo = int(np.floor((1.0 - self.umbral) * 64 + 1e-9))
+            indice = _IndiceHamming(hashes_indice[conservar], len(claves), maximo)
+
+            filas = []
+            for i, (clave, valor, firma) in enumerate(zip(claves, hashes, firmas)):
+                if clave in previas:
+                    original, similitud = previas[clave]
+                else:
+                    original, similitud = None, None
+                    cercano = indice.mas_cercano(valor)
+                    if cercano is not None:
+                        original = claves_aceptadas[cercano[0]]
+                        similitud = 1.0 - cercano[1] / 64.0
+                        nuevos_descartes.append((tipo, clave, original, similitud))
+                    filas.append((tipo, self.metodo, clave, int(hashes[i:i + 1].view(np.int64)[0]), firma,
+                                  original, similitud))
+                if original is not None:
+                    duplicados[i] = True
+                    self.descartados.append((tipo, clave, original, similitud))
+                elif clave not in previas:
+                    claves_aceptadas.append(clave)
+                    indice.agregar(valor)
+
+            with self.conexion:
+                self.conexion.executemany("INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?, ?, ?)", filas)
+            self._informar(nuevos_descartes)
+        return duplicados
+
+    def _informar(self, descartados):
+        # Una fila por casi duplicado nuevo en duplicados.csv; los ya informados no se repiten
+        if not descartados:
+            return
+        ruta = os.path.join(self.directorio, ARCHIVO_INFORME)
+        nuevo = not os.path.exists(ruta)
+        fecha = datetime.now().isoformat(timespec="seconds")
+        accion = "omitido" if self.omitir else "marcado"
+        with open(ruta, 'a', newline='') as archivo_csv:
+            escritor = csv.writer(archivo_csv)
+            if nuevo:
+                escritor.writerow(["fecha", "tipo", "clave", "original", "similitud", "accion"])
+            for tipo, clave, original, similitud in descartados:
+                escritor.writerow([fecha, tipo, clave, original, f"{similitud:.3f}", accion])
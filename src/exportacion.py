@@ -0,0 +1,544 @@
+import csv
+import hashlib
+import json
+import os
+import shutil
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import cv2
+import numpy as np
+from PIL import Image
+
+from duplicados import hashes_archivos, hashes_imagenes
+from fragmentos import directorio_fragmentos, obtener_escritor
+
+CABECERA_CSV = ['nombre_archivo', 'x1', 'y1', 'x2', 'y2', 'centro_x', 'centro_y']
+
+
+def calcular_recuadro(x_orig, y_orig, tamano, ancho_img, alto_img):
+    # Recuadro de tamaño fijo centrado en el punto y recortado a los bordes de la imagen
+    mitad_orig = tamano // 2
+    x1_orig = max(0, x_orig - mitad_orig)
+    y1_orig = max(0, y_orig - mitad_orig)
+    x2_orig = min(ancho_img, x_orig + mitad_orig)
+    y2_orig = min(alto_img, y_orig + mitad_orig)
+    return x1_orig, y1_orig, x2_orig, y2_orig
+
+
+def calcular_recuadros(centros, tamano, ancho_img, alto_img):
+    # Versión vectorizada de calcular_recuadro para un array (N, 2) de centros
+    centros = np.asarray(centros, dtype=np.int64).reshape(-1, 2)
+    mitad_orig = tamano // 2
+    cajas = np.empty((len(centros), 4), dtype=np.int64)
+    cajas[:, 0] = np.maximum(0, centros[:, 0] - mitad_orig)
+    cajas[:, 1] = np.maximum(0, centros[:, 1] - mitad_orig)
+    cajas[:, 2] = np.minimum(ancho_img, centros[:, 0] + mitad_orig)
+    cajas[:, 3] = np.minimum(alto_img, centros[:, 1] + mitad_orig)
+    return cajas
+
+
+def linea_yolo(coords, ancho_img, alto_img, clase=0):
+    x1, y1, x2, y2 = coords
+
+    # Calcular valores normalizados para formato YOLO
+    centro_x = (x1 + x2) / 2.0 / ancho_img
+    centro_y = (y1 + y2) / 2.0 / alto_img
+    ancho_rect = (x2 - x1) / ancho_img
+    alto_rect = (y2 - y1) / alto_img
+
+    # Formato YOLO: <clase> <centro_x> <centro_y> <ancho> <alto>
+    return f"{clase} {centro_x:.6f} {centro_y:.6f} {ancho_rect:.6f} {alto_rect:.6f}\n"
+
+
+def escribir_etiquetas_yolo(ruta_etiquetas, recuadros, ancho_img, alto_img):
+    with open(ruta_etiquetas, 'w') as archivo_yolo:
+        for coords in recuadros:
+            # Clase 0 para "uva"
+            archivo_yolo.write(linea_yolo(coords, ancho_img, alto_img))
+
+
+def crear_directorios_yolo(directorio_yolo):
+    directorio_images = os.path.join(directorio_yolo, "images")
+    directorio_labels = os.path.join(directorio_yolo, "labels")
+    for directorio in [directorio_yolo, directorio_images, directorio_labels]:
+        if not os.path.exists(directorio):
+            os.makedirs(directorio, exist_ok=True)
+    return directorio_images, directorio_labels
+
+
+def escribir_metadatos_yolo(directorio_yolo, sobrescribir_clases=True):
+    # Crear archivo classes.txt
+    ruta_clases = os.path.join(directorio_yolo, "classes.txt")
+    if sobrescribir_clases or not os.path.exists(ruta_clases):
+        with open(ruta_clases, 'w') as archivo_clases:
+            archivo_clases.write("uva\n")
+
+    # Crear archivo dataset.yaml
+    ruta_yaml = os.path.join(directorio_yolo, "dataset.yaml")
+    with open(ruta_yaml, 'w') as archivo_yaml:
+        archivo_yaml.write(f"path: {os.path.abspath(directorio_yolo)}\n")
+        archivo_yaml.write("train: images/train\n")
+        archivo_yaml.write("val: images/val\n")
+        archivo_yaml.write("test: images/test\n\n")
+        archivo_yaml.write("names:\n  0: uva\n")
+
+
+def exportar_imagen_yolo(directorio_yolo, nombre_base, imagen, recuadros, rgb=True, comprobar=None,
+                         ruta_origen=None):
+    # Imagen completa, etiquetas y metadatos de una imagen anotada en formato YOLO. Si el archivo
+    # original ya es JPEG se enlaza tal cual (imagen puede ser None) en lugar de recodificarlo.
+    directorio_images, directorio_labels = crear_directorios_yolo(directorio_yolo)
+
+    ruta_imagen_yolo = os.path.join(directorio_images, f"{nombre_base}.jpg")
+    if ruta_origen is not None and ruta_origen.lower().endswith(('.jpg', '.jpeg')):
+        ancho_img, alto_img = leer_dimensiones(ruta_origen)
+        enlazar_o_copiar(ruta_origen, ruta_imagen_yolo)
+    else:
+        alto_img, ancho_img = imagen.shape[:2]
+        escribir_imagen(ruta_imagen_yolo, cv2.cvtColor(imagen, cv2.COLOR_RGB2BGR) if rgb else imagen)
+    if comprobar is not None:
+        comprobar()
+
+    # Etiquetas normalizadas con las dimensiones de la imagen original
+    ruta_etiquetas = os.path.join(directorio_labels, f"{nombre_base}.txt")
+    escribir_etiquetas_yolo(ruta_etiquetas, recuadros, ancho_img, alto_img)
+
+    # Crear classes.txt si no existe y actualizar dataset.yaml
+    escribir_metadatos_yolo(directorio_yolo, sobrescribir_clases=False)
+    return ruta_imagen_yolo, ruta_etiquetas
+
+
+def escribir_imagen(ruta, imagen):
+    # El destino puede ser un enlace duro a la foto original (exportada antes como JPEG): se escribe
+    # en un temporal y se reemplaza la entrada del directorio en lugar de sobrescribir el archivo
+    base, extension = os.path.splitext(ruta)
+    temporal = f"{base}.tmp{extension}"
+    if not cv2.imwrite(temporal, imagen):
+        raise IOError(f"No se pudo escribir la imagen {ruta}")
+    os.replace(temporal, ruta)
+
+
+def parametros_codificacion(formato="png", compresion_png=3):
+    # Extensión y parámetros de cv2.imwrite para cada formato de recorte
+    if formato == "webp":
+        # Una calidad mayor que 100 activa el modo sin pérdida de WebP
+        return ".webp", [cv2.IMWRITE_WEBP_QUALITY, 101]
+    return ".png", [cv2.IMWRITE_PNG_COMPRESSION, int(compresion_png)]
+
+
+def _recortes_anteriores(directorio_salida, nombre_base, extension, parametros, origen):
+    # coords -> nombres de archivo del guardado anterior, si se hizo desde la misma imagen y con la
+    # misma codificación; si no, vacío y se vuelve a escribir todo
+    ruta_manifiesto = os.path.join(directorio_salida, f"{nombre_base}_guardado.json")
+    ruta_csv = os.path.join(directorio_salida, f"{nombre_base}_coordenadas.csv")
+    try:
+        with open(ruta_manifiesto, 'r') as archivo:
+            manifiesto = json.load(archivo)
+        with open(ruta_csv, 'r', newline='') as archivo_csv:
+            filas = list(csv.DictReader(archivo_csv))
+    except (OSError, ValueError):
+        return {}
+    if manifiesto != {"origen": origen, "extension": extension, "parametros": parametros}:
+        return {}
+
+    anteriores = {}
+    for fila in filas:
+        if not fila['nombre_archivo']:
+            continue
+        coords = tuple(int(fila[clave]) for clave in ('x1', 'y1', 'x2', 'y2'))
+        anteriores.setdefault(coords, []).append(fila['nombre_archivo'])
+    return anteriores
+
+
+def _recortes_duplicados(duplicados, nombre_base, imagen, recuadros):
+    # Los recortes de esta imagen se vuelven a evaluar en cada guardado, ya que los puntos cambian
+    duplicados.olvidar("recorte", f"{nombre_base}:")
+    claves = [f"{nombre_base}:{x1},{y1},{x2},{y2}" for x1, y1, x2, y2 in recuadros]
+    hashes = hashes_imagenes([imagen[y1:y2, x1:x2] for x1, y1, x2, y2 in recuadros], duplicados.metodo)
+    es_duplicado = duplicados.filtrar("recorte", claves, hashes)
+    return es_duplicado if duplicados.omitir else np.zeros(len(recuadros), dtype=bool)
+
+
+def escribir_recortes(directorio_salida, nombre_base, imagen, recuadros, rgb=True, formato="png",
+                      compresion_png=3, hilos=1, progreso=None, comprobar=None, origen=None, duplicados=None):
+    # Guarda un archivo por recuadro y el CSV de coordenadas; imagen puede estar en RGB o BGR.
+    # Con hilos > 1 la extracción y codificación se reparten en un pool con un número acotado
+    # de tareas en vuelo, y el CSV se escribe al final siempre en el orden de los recuadros.
+    # Con origen (p. ej. huella_archivo de la imagen) solo se codifican los recortes nuevos o
+    # movidos: los que ya estaban guardados con las mismas coordenadas se conservan o se renombran.
+    # Con duplicados (IndiceDuplicados en modo "omitir") los recortes casi idénticos a otro ya
+    # aceptado no se escriben, pero su fila del CSV se conserva con nombre_archivo vacío.
+    if not os.path.exists(directorio_salida):
+        os.makedirs(directorio_salida, exist_ok=True)
+
+    extension, parametros = parametros_codificacion(formato, compresion_png)
+    nombres = [f"{nombre_base}_uva_{i + 1}{extension}" for i in range(len(recuadros))]
+    if duplicados is not None:
+        for i in np.flatnonzero(_recortes_duplicados(duplicados, nombre_base, imagen, recuadros)):
+            nombres[i] = ""
+
+    anteriores = {}
+    if origen is not None:
+        anteriores = _recortes_anteriores(directorio_salida, nombre_base, extension, parametros, origen)
+    # Sin manifiesto el siguiente guardado lo reescribe todo: si este se cancela o falla a medias, los
+    # archivos ya no coinciden con el CSV anterior
+    ruta_manifiesto = os.path.join(directorio_salida, f"{nombre_base}_guardado.json")
+    if os.path.exists(ruta_manifiesto):
+        os.remove(ruta_manifiesto)
+    sobrantes = {nombre for lista in anteriores.values() for nombre in lista}
+    # Un recorte omitido por duplicado no debe dejar el archivo de un guardado anterior con su nombre
+    sobrantes.update(f"{nombre_base}_uva_{i + 1}{extension}" for i, nombre in enumerate(nombres) if not nombre)
+
+    movidos = []
+    try:
+        por_escribir = _apartar_reutilizados(directorio_salida, nombres, recuadros, anteriores, sobrantes,
+                                             movidos)
+        _escribir_nuevos(directorio_salida, nombres, recuadros, por_escribir, imagen, rgb, parametros, hilos,
+                         progreso, comprobar)
+    except BaseException:
+        # Devolver a su nombre los recortes apartados para que no queden archivos .mover huérfanos
+        for temporal, _ in movidos:
+            if os.path.exists(temporal):
+                os.replace(temporal, temporal[:-len(".mover")])
+        raise
+
+    for temporal, destino in movidos:
+        os.replace(temporal, destino)
+    for nombre in sobrantes:
+        # Recortes de puntos eliminados desde el guardado anterior
+        try:
+            os.remove(os.path.join(directorio_salida, nombre))
+        except FileNotFoundError:
+            pass
+
+    ruta_csv = os.path.join(directorio_salida, f"{nombre_base}_coordenadas.csv")
+    with open(ruta_csv, 'w', newline='') as archivo_csv:
+        escritor = csv.writer(archivo_csv)
+        escritor.writerow(CABECERA_CSV)
+
+        for nombre_archivo, (x1, y1, x2, y2) in zip(nombres, recuadros):
+            # Calcular el centro del recuadro
+            centro_x = (x1 + x2) // 2
+            centro_y = (y1 + y2) // 2
+            escritor.writerow([nombre_archivo, x1, y1, x2, y2, centro_x, centro_y])
+
+    # El manifiesto se escribe solo cuando los archivos y el CSV ya son coherentes
+    if origen is not None:
+        with open(ruta_manifiesto, 'w') as archivo:
+            json.dump({"origen": origen, "extension": extension, "parametros": parametros}, archivo)
+
+    return ruta_csv
+
+
+def _apartar_reutilizados(directorio_salida, nombres, recuadros, anteriores, sobrantes, movidos):
+    # Aparta como .mover los recortes reutilizados que cambian de nombre, para que ningún archivo nuevo
+    # los sobrescriba antes de moverlos, y devuelve los índices de los recortes que hay que escribir
+    por_escribir = []
+    for i, coords in enumerate(recuadros):
+        if not nombres[i]:
+            continue
+        candidatos = anteriores.get(tuple(coords))
+        while candidatos:
+            anterior = candidatos.pop()
+            ruta_anterior = os.path.join(directorio_salida, anterior)
+            if not os.path.exists(ruta_anterior):
+                continue
+            sobrantes.discard(anterior)
+            if anterior != nombres[i]:
+                temporal = f"{ruta_anterior}.mover"
+                os.replace(ruta_anterior, temporal)
+                movidos.append((temporal, os.path.join(directorio_salida, nombres[i])))
+            break
+        else:
+            por_escribir.append(i)
+    sobrantes.difference_update(nombres)
+    return por_escribir
+
+
+def _escribir_nuevos(directorio_salida, nombres, recuadros, por_escribir, imagen, rgb, parametros, hilos,
+                     progreso, comprobar):
+    total = len(por_escribir)
+
+    def guardar(i):
+        x1, y1, x2, y2 = recuadros[i]
+        recorte = imagen[y1:y2, x1:x2]
+
+        # Convertir de RGB a BGR para guardar con cv2
+        if rgb:
+            recorte = cv2.cvtColor(recorte, cv2.COLOR_RGB2BGR)
+
+        # Nombre del archivo: nombre_imagen_uva_N.png
+        if not cv2.imwrite(os.path.join(directorio_salida, nombres[i]), recorte, parametros):
+            raise IOError(f"No se pudo escribir el recorte {nombres[i]}")
+
+    if hilos <= 1:
+        for hechos, i in enumerate(por_escribir, 1):
+            if comprobar is not None:
+                comprobar()
+            guardar(i)
+            if progreso is not None:
+                progreso(hechos, total)
+    else:
+        completados = 0
+        with ThreadPoolExecutor(max_workers=hilos) as pool:
+            en_vuelo = deque()
+            for posicion, i in enumerate(por_escribir):
+                if comprobar is not None:
+                    comprobar()
+                en_vuelo.append(pool.submit(guardar, i))
+
+                # Limitar las tareas pendientes para no acumular recortes en memoria
+                while len(en_vuelo) >= hilos * 4 or (posicion == total - 1 and en_vuelo):
+                    en_vuelo.popleft().result()
+                    completados += 1
+                    if progreso is not None:
+                        progreso(completados, total)
+
+
+def escribir_recortes_fragmentos(directorio_base, nombre_base, imagen, recuadros, tamano, rgb=True):
+    # Agrega los recortes al archivo de fragmentos y escribe el CSV de coordenadas de la imagen,
+    # cuya columna nombre_archivo apunta a "fragmento#posicion"
+    escritor = obtener_escritor(directorio_fragmentos(directorio_base, tamano), tamano)
+
+    directorio_salida = os.path.join(directorio_base, nombre_base)
+    if not os.path.exists(directorio_salida):
+        os.makedirs(directorio_salida, exist_ok=True)
+    # Los recortes sueltos y el manifiesto de un guardado anterior en PNG/WebP ya no corresponden al CSV
+    for archivo in os.listdir(directorio_salida):
+        if archivo.startswith(f"{nombre_base}_uva_") or archivo == f"{nombre_base}_guardado.json":
+            os.remove(os.path.join(directorio_salida, archivo))
+
+    ruta_csv = os.path.join(directorio_salida, f"{nombre_base}_coordenadas.csv")
+    # El CSV se escribe con el escritor bloqueado: una compactación en otro hilo no puede dejarlo
+    # con referencias anteriores a ella
+    with escritor.lock:
+        referencias = escritor.agregar(nombre_base, imagen, recuadros, rgb=rgb)
+        _escribir_csv_fragmentos(ruta_csv, referencias, recuadros)
+        if escritor.conviene_compactar():
+            for imagen_compactada, nuevas in escritor.compactar().items():
+                _actualizar_referencias(directorio_base, imagen_compactada, nuevas)
+
+    return ruta_csv
+
+
+def _escribir_csv_fragmentos(ruta_csv, referencias, recuadros):
+    temporal = f"{ruta_csv}.tmp"
+    with open(temporal, 'w', newline='') as archivo_csv:
+        escritor_csv = csv.writer(archivo_csv)
+        escritor_csv.writerow(CABECERA_CSV)
+        for referencia, (x1, y1, x2, y2) in zip(referencias, recuadros):
+            escritor_csv.writerow([referencia, x1, y1, x2, y2, (x1 + x2) // 2, (y1 + y2) // 2])
+    os.replace(temporal, ruta_csv)
+
+
+def _actualizar_referencias(directorio_base, nombre_base, referencias):
+    # Tras compactar, apunta el CSV de la imagen a las nuevas posiciones. Si la imagen se volvió a
+    # guardar en PNG/WebP desde entonces, su CSV ya no usa los fragmentos y se deja como está.
+    ruta_csv = os.path.join(directorio_base, nombre_base, f"{nombre_base}_coordenadas.csv")
+    try:
+        with open(ruta_csv, 'r', newline='') as archivo_csv:
+            filas = list(csv.DictReader(archivo_csv))
+    except OSError:
+        return
+    if len(filas) != len(referencias) or not all('#' in fila['nombre_archivo'] for fila in filas):
+        return
+    recuadros = [tuple(int(fila[clave]) for clave in ('x1', 'y1', 'x2', 'y2')) for fila in filas]
+    _escribir_csv_fragmentos(ruta_csv, referencias, recuadros)
+
+
+def leer_dimensiones(ruta_imagen):
+    # Lee solo la cabecera de la imagen; tiene en cuenta la orientación EXIF igual que cv2.imread
+    with Image.open(ruta_imagen) as imagen:
+        ancho_img, alto_img = imagen.size
+        orientacion = imagen.getexif().get(0x0112, 1)
+    if orientacion in (5, 6, 7, 8):
+        ancho_img, alto_img = alto_img, ancho_img
+    return ancho_img, alto_img
+
+
+def enlazar_o_copiar(origen, destino):
+    # Enlace duro cuando origen y destino están en el mismo sistema de archivos; si no, copia de bytes
+    if os.path.exists(destino):
+        if os.path.samefile(origen, destino):
+            return
+        os.remove(destino)
+    try:
+        os.link(origen, destino)
+    except OSError:
+        shutil.copyfile(origen, destino)
+
+
+def huella_archivo(ruta, con_hash=False):
+    estado = os.stat(ruta)
+    huella = {"mtime": estado.st_mtime_ns, "tamano": estado.st_size}
+    if con_hash:
+        with open(ruta, 'rb') as archivo:
+            huella["hash"] = hashlib.blake2b(archivo.read(), digest_size=16).hexdigest()
+    return huella
+
+
+def _convertir_uno(tarea):
+    ruta_csv, ruta_imagen_orig, ruta_destino, ruta_etiquetas = tarea
+
+    ancho_img, alto_img = leer_dimensiones(ruta_imagen_orig)
+    enlazar_o_copiar(ruta_imagen_orig, ruta_destino)
+
+    with open(ruta_csv, 'r') as archivo_csv:
+        recuadros = [tuple(map(int, [fila['x1'], fila['y1'], fila['x2'], fila['y2']]))
+                     for fila in csv.DictReader(archivo_csv)]
+    escribir_etiquetas_yolo(ruta_etiquetas, recuadros, ancho_img, alto_img)
+
+    return ruta_csv, huella_archivo(ruta_csv, con_hash=True), huella_archivo(ruta_imagen_orig)
+
+
+def _sin_cambios(entrada, ruta_csv, ruta_imagen_orig, salidas):
+    if entrada is None or not all(os.path.exists(ruta) for ruta in salidas):
+        return False
+
+    huella_imagen = huella_archivo(ruta_imagen_orig)
+    if entrada["imagen"] != huella_imagen:
+        return False
+
+    huella_csv = huella_archivo(ruta_csv)
+    if huella_csv["mtime"] == entrada["csv"]["mtime"] and huella_csv["tamano"] == entrada["csv"]["tamano"]:
+        return True
+
+    # Fecha distinta pero mismo tamaño: comparar el contenido antes de volver a convertir
+    if huella_csv["tamano"] == entrada["csv"]["tamano"]:
+        huella_csv = huella_archivo(ruta_csv, con_hash=True)
+        if huella_csv["hash"] == entrada["csv"].get("hash"):
+            entrada["csv"] = huella_csv
+            return True
+    return False
+
+
+def convertir_csv_a_yolo(directorio_recortes="recortes", directorio_imagenes="imagenes", procesos=None,
+                         forzar=False, progreso=None, comprobar=None, duplicados=None):
+    # Convierte todos los recortes/*/_coordenadas.csv a etiquetas YOLO en paralelo, saltando los
+    # que no han cambiado desde la última conversión según el manifiesto. Con duplicados en modo
+    # "omitir" las imágenes casi idénticas a otra ya aceptada se quitan del export.
+    directorio_yolo = os.path.join(directorio_recortes, "yolo")
+    directorio_images, directorio_labels = crear_directorios_yolo(directorio_yolo)
+
+    ruta_manifiesto = os.path.join(directorio_yolo, "manifiesto.json")
+    manifiesto = {}
+    if not forzar and os.path.exists(ruta_manifiesto):
+        try:
+            with open(ruta_manifiesto, 'r') as archivo:
+                manifiesto = json.load(archivo)
+        except (OSError, ValueError):
+            manifiesto = {}
+
+    candidatas = []
+    for directorio in sorted(os.listdir(directorio_recortes)):
+        ruta_directorio = os.path.join(directorio_recortes, directorio)
+        if not os.path.isdir(ruta_directorio) or directorio == "yolo":
+            continue
+
+        for csv_file in sorted(os.listdir(ruta_directorio)):
+            if not csv_file.endswith("_coordenadas.csv"):
+                continue
+            ruta_csv = os.path.join(ruta_directorio, csv_file)
+            nombre_base = csv_file.replace("_coordenadas.csv", "")
+
+            ruta_imagen_orig = os.path.join(directorio_imagenes, f"{nombre_base}.jpg")
+            if not os.path.exists(ruta_imagen_orig):
+                continue
+            candidatas.append((nombre_base, ruta_csv, ruta_imagen_orig))
+
+    es_duplicada = np.zeros(len(candidatas), dtype=bool)
+    if duplicados is not None:
+        es_duplicada = _imagenes_duplicadas(duplicados, candidatas)
+
+    tareas = []
+    omitidas = 0
+    for (nombre_base, ruta_csv, ruta_imagen_orig), duplicada in zip(candidatas, es_duplicada):
+        ruta_destino = os.path.join(directorio_images, f"{nombre_base}.jpg")
+        ruta_etiquetas = os.path.join(directorio_labels, f"{nombre_base}.txt")
+        if duplicada:
+            # Quitar lo que se exportó antes de que apareciera la imagen de la que es duplicada
+            for ruta in (ruta_destino, ruta_etiquetas):
+                if os.path.exists(ruta):
+                    os.remove(ruta)
+            manifiesto.pop(ruta_csv, None)
+            continue
+        if _sin_cambios(manifiesto.get(ruta_csv), ruta_csv, ruta_imagen_orig,
+                        [ruta_destino, ruta_etiquetas]):
+            omitidas += 1
+            continue
+        tareas.append((ruta_csv, ruta_imagen_orig, ruta_destino, ruta_etiquetas))
+
+    convertidas = 0
+    errores = []
+    try:
+        if procesos == 1 or len(tareas) < 2:
+            resultados = (_convertir_seguro(tarea) for tarea in tareas)
+            for hechos, (ruta_csv, resultado) in enumerate(resultados, 1):
+                convertidas += _registrar(manifiesto, errores, ruta_csv, resultado)
+                _avanzar(progreso, comprobar, hechos, len(tareas))
+        else:
+            pool = ProcessPoolExecutor(max_workers=procesos)
+            try:
+                resultados = pool.map(_convertir_seguro, tareas, chunksize=16)
+                for hechos, (ruta_csv, resultado) in enumerate(resultados, 1):
+                    convertidas += _registrar(manifiesto, errores, ruta_csv, resultado)
+                    _avanzar(progreso, comprobar, hechos, len(tareas))
+            finally:
+                # Si se cancela, descartar los bloques que aún no han empezado
+                pool.shutdown(wait=True, cancel_futures=True)
+    finally:
+        # Guardar lo convertido hasta ahora aunque se cancele, para no repetirlo la próxima vez
+        _guardar_manifiesto(ruta_manifiesto, manifiesto)
+
+    escribir_metadatos_yolo(directorio_yolo)
+    return convertidas, omitidas, errores
+
+
+def _imagenes_duplicadas(duplicados, candidatas):
+    # Solo se leen (con decodificación reducida) las imágenes nuevas o modificadas; el resto
+    # conserva la decisión guardada en el índice
+    claves = [nombre_base for nombre_base, _, _ in candidatas]
+    firmas = []
+    for _, _, ruta_imagen in candidatas:
+        estado = os.stat(ruta_imagen)
+        firmas.append(f"{estado.st_size}:{estado.st_mtime_ns}")
+    evaluadas = duplicados.evaluadas("imagen", claves, firmas)
+    hashes = np.zeros(len(candidatas), dtype=np.uint64)
+    pendientes = [i for i, clave in enumerate(claves) if clave not in evaluadas]
+    if pendientes:
+        hashes[pendientes] = hashes_archivos([candidatas[i][2] for i in pendientes], duplicados.metodo)
+    es_duplicada = duplicados.filtrar("imagen", claves, hashes, firmas)
+    return es_duplicada if duplicados.omitir else np.zeros(len(candidatas), dtype=bool)
+
+
+def _avanzar(progreso, comprobar, hechos, total):
+    if progreso is not None:
+        progreso(hechos, total)
+    if comprobar is not None:
+        comprobar()
+
+
+def _guardar_manifiesto(ruta_manifiesto, manifiesto):
+    # Guardar el manifiesto de forma atómica
+    ruta_temporal = ruta_manifiesto + ".tmp"
+    with open(ruta_temporal, 'w') as archivo:
+        json.dump(manifiesto, archivo)
+    os.replace(ruta_temporal, ruta_manifiesto)
+
+
+def _convertir_seguro(tarea):
+    try:
+        return tarea[0], _convertir_uno(tarea)
+    except Exception as e:
+        return tarea[0], e
+
+
+def _registrar(manifiesto, errores, ruta_csv, resultado):
+    if isinstance(resultado, Exception):
+        errores.append((ruta_csv, str(resultado)))
+        manifiesto.pop(ruta_csv, None)
+        return 0
+    _, huella_csv, huella_imagen = resultado
+    manifiesto[ruta_csv] = {"csv": huella_csv, "imagen": huella_imagen}
+    return 1
@@ -0,0 +1,289 @@
+"""
+Archivo de recortes en fragmentos.
+
+En lugar de un PNG por uva, los recortes se agregan a archivos binarios de tamaño fijo
+(fragmentos) que se pueden abrir con np.memmap como un array (N, tamano, tamano, 3) en
+RGB. Un índice CSV de solo escritura al final guarda, para cada recorte, el fragmento,
+la posición, el tamaño real (los recortes del borde se rellenan con ceros; los mayores que
+tamano se reducen conservando la proporción) y las coordenadas x1, y1, x2, y2, centro_x,
+centro_y en la imagen original.
+
+Volver a guardar una imagen agrega sus recortes de nuevo sin borrar los anteriores, que quedan
+obsoletos en los fragmentos. Cuando los obsoletos superan la mitad del archivo, compactar()
+lo reescribe con solo el último guardado de cada imagen y las posiciones cambian.
+"""
+
+import csv
+import json
+import os
+import shutil
+import threading
+from collections import Counter
+
+import cv2
+import numpy as np
+
+CABECERA_INDICE = ['imagen', 'guardado', 'fragmento', 'posicion', 'alto', 'ancho',
+                   'x1', 'y1', 'x2', 'y2', 'centro_x', 'centro_y']
+
+
+def directorio_fragmentos(directorio_base, tamano):
+    # Un archivo de fragmentos por tamaño de recorte, ya que todas las entradas comparten forma
+    return os.path.join(directorio_base, f"_fragmentos_{tamano}")
+
+
+_escritores = {}
+_lock_escritores = threading.Lock()
+
+
+def obtener_escritor(directorio, tamano):
+    # Un único escritor por directorio para que varios hilos agreguen al mismo archivo
+    with _lock_escritores:
+        escritor = _escritores.get(directorio)
+        if escritor is None or escritor.tamano != tamano:
+            escritor = EscritorFragmentos(directorio, tamano)
+            _escritores[directorio] = escritor
+        return escritor
+
+
+def nombre_fragmento(fragmento):
+    return f"fragmento_{fragmento:05d}.bin"
+
+
+def _leer_indice(ruta_indice):
+    if not os.path.exists(ruta_indice):
+        return []
+    with open(ruta_indice, 'r', newline='') as archivo:
+        return list(csv.DictReader(archivo))
+
+
+def _vigentes(filas):
+    # Filas del último guardado de cada imagen; las de guardados anteriores están obsoletas
+    ultimo = {}
+    for fila in filas:
+        ultimo[fila['imagen']] = max(ultimo.get(fila['imagen'], -1), int(fila['guardado']))
+    return [fila for fila in filas if int(fila['guardado']) == ultimo[fila['imagen']]]
+
+
+class EscritorFragmentos:
+    def __init__(self, directorio, tamano, recortes_por_fragmento=4096):
+        self.directorio = directorio
+        self.tamano = tamano
+        # Reentrante para que quien agrega pueda escribir su CSV y compactar sin soltarlo
+        self.lock = threading.RLock()
+        if not os.path.exists(directorio) and os.path.exists(f"{directorio}.compactando"):
+            # Cierre inesperado entre los dos renombrados de compactar(): la copia nueva ya estaba completa
+            os.replace(f"{directorio}.compactando", directorio)
+        if os.path.exists(f"{directorio}.anterior"):
+            shutil.rmtree(f"{directorio}.anterior")
+        os.makedirs(directorio, exist_ok=True)
+
+        ruta_meta = os.path.join(directorio, "meta.json")
+        if os.path.exists(ruta_meta):
+            with open(ruta_meta, 'r') as archivo:
+                meta = json.load(archivo)
+            if meta["tamano"] != tamano:
+                raise ValueError(f"El archivo {directorio} contiene recortes de {meta['tamano']} píxeles, "
+                                 f"no de {tamano}")
+            self.recortes_por_fragmento = meta["recortes_por_fragmento"]
+        else:
+            self.recortes_por_fragmento = recortes_por_fragmento
+            with open(ruta_meta, 'w') as archivo:
+                json.dump({"tamano": tamano, "canales": 3, "dtype": "uint8", "orden": "RGB",
+                           "recortes_por_fragmento": recortes_por_fragmento}, archivo)
+
+        self.ruta_indice = os.path.join(directorio, "indice.csv")
+        filas = _leer_indice(self.ruta_indice)
+        self.total = len(filas)
+        self.guardado = max((int(fila['guardado']) for fila in filas), default=-1) + 1
+        self._por_imagen = Counter(fila['imagen'] for fila in _vigentes(filas))
+        self.obsoletos = self.total - sum(self._por_imagen.values())
+
+        # Descartar bytes escritos tras la última entrada del índice (p. ej. tras un cierre inesperado)
+        if self.total:
+            fragmento, posicion = divmod(self.total, self.recortes_por_fragmento)
+            ruta = self.ruta_fragmento(fragmento)
+            if os.path.exists(ruta):
+                with open(ruta, 'r+b') as archivo:
+                    archivo.truncate(posicion * self.bytes_por_recorte)
+
+        if not os.path.exists(self.ruta_indice):
+            with open(self.ruta_indice, 'w', newline='') as archivo:
+                csv.writer(archivo).writerow(CABECERA_INDICE)
+
+    @property
+    def bytes_por_recorte(self):
+        return self.tamano * self.tamano * 3
+
+    def ruta_fragmento(self, fragmento):
+        return os.path.join(self.directorio, nombre_fragmento(fragmento))
+
+    def agregar(self, nombre_imagen, imagen, recuadros, rgb=True):
+        # Agrega todos los recortes de una imagen; devuelve la referencia "fragmento#posicion" de cada uno
+        bloque = np.zeros((self.tamano, self.tamano, 3), dtype=np.uint8)
+        referencias = []
+
+        with self.lock:
+            guardado = self.guardado
+            self.guardado += 1
+
+            filas = []
+            archivo = None
+            fragmento_abierto = None
+            try:
+                for x1, y1, x2, y2 in recuadros:
+                    fragmento, posicion = divmod(self.total, self.recortes_por_fragmento)
+                    if fragmento != fragmento_abierto:
+                        if archivo is not None:
+                            archivo.close()
+                        archivo = open(self.ruta_fragmento(fragmento), 'ab')
+                        fragmento_abierto = fragmento
+
+                    recorte = imagen[y1:y2, x1:x2]
+                    if max(recorte.shape[:2]) > self.tamano:
+                        # Un recuadro mayor que el de los fragmentos se reduce en lugar de cortarse
+                        escala = self.tamano / max(recorte.shape[:2])
+                        alto, ancho = (max(1, round(lado * escala)) for lado in recorte.shape[:2])
+                        recorte = cv2.resize(recorte, (ancho, alto), interpolation=cv2.INTER_AREA)
+                    if not rgb:
+                        recorte = recorte[..., ::-1]
+                    alto, ancho = recorte.shape[:2]
+                    bloque.fill(0)
+                    bloque[:alto, :ancho] = recorte
+                    archivo.write(bloque.tobytes())
+
+                    filas.append([nombre_imagen, guardado, fragmento, posicion, alto, ancho,
+                                  x1, y1, x2, y2, (x1 + x2) // 2, (y1 + y2) // 2])
+                    referencias.append(f"{nombre_fragmento(fragmento)}#{posicion}")
+                    self.total += 1
+            finally:
+                if archivo is not None:
+                    archivo.close()
+
+            # El índice se escribe después de los datos: una entrada siempre apunta a bytes completos
+            with open(self.ruta_indice, 'a', newline='') as archivo_indice:
+                csv.writer(archivo_indice).writerows(filas)
+
+            # Los recortes del guardado anterior de esta imagen pasan a ser obsoletos
+            self.obsoletos += self._por_imagen[nombre_imagen]
+            self._por_imagen[nombre_imagen] = len(filas)
+
+        return referencias
+
+    def conviene_compactar(self):
+        return self.obsoletos >= self.recortes_por_fragmento and self.obsoletos * 2 >= self.total
+
+    def compactar(self):
+        # Reescribe los fragmentos con solo el último guardado de cada imagen. La copia se hace en un
+        # directorio aparte que luego sustituye al actual, así que el índice nunca apunta a bytes a medias.
+        # Devuelve imagen -> nuevas referencias "fragmento#posicion", en el orden en que se agregaron.
+        with self.lock:
+            vigentes = _vigentes(_leer_indice(self.ruta_indice))
+            nuevo = f"{self.directorio}.compactando"
+            if os.path.exists(nuevo):
+                shutil.rmtree(nuevo)
+            os.makedirs(nuevo)
+            shutil.copyfile(os.path.join(self.directorio, "meta.json"), os.path.join(nuevo, "meta.json"))
+
+            filas = []
+            referencias = {}
+            archivo = origen = None
+            fragmento_abierto = origen_abierto = None
+            try:
+                for total, fila in enumerate(vigentes):
+                    fragmento, posicion = divmod(total, self.recortes_por_fragmento)
+                    if fragmento != fragmento_abierto:
+                        if archivo is not None:
+                            archivo.close()
+                        archivo = open(os.path.join(nuevo, nombre_fragmento(fragmento)), 'wb')
+                        fragmento_abierto = fragmento
+                    if int(fila['fragmento']) != origen_abierto:
+                        if origen is not None:
+                            origen.close()
+                        origen_abierto = int(fila['fragmento'])
+                        origen = open(self.ruta_fragmento(origen_abierto), 'rb')
+
+                    origen.seek(int(fila['posicion']) * self.bytes_por_recorte)
+                    archivo.write(origen.read(self.bytes_por_recorte))
+                    filas.append({**fila, 'fragmento': fragmento, 'posicion': posicion})
+                    referencias.setdefault(fila['imagen'], []).append(f"{nombre_fragmento(fragmento)}#{posicion}")
+            finally:
+                for abierto in (archivo, origen):
+                    if abierto is not None:
+                        abierto.close()
+
+            with open(os.path.join(nuevo, "indice.csv"), 'w', newline='') as archivo_indice:
+                escritor = csv.DictWriter(archivo_indice, fieldnames=CABECERA_INDICE)
+                escritor.writeheader()
+                escritor.writerows(filas)
+
+            anterior = f"{self.directorio}.anterior"
+            if os.path.exists(anterior):
+                shutil.rmtree(anterior)
+            os.replace(self.directorio, anterior)
+            os.replace(nuevo, self.directorio)
+            shutil.rmtree(anterior)
+
+            self.total = len(filas)
+            self.obsoletos = 0
+            return referencias
+
+
+class LectorFragmentos:
+    def __init__(self, directorio, solo_ultimo_guardado=True):
+        self.directorio = directorio
+        with open(os.path.join(directorio, "meta.json"), 'r') as archivo:
+            meta = json.load(archivo)
+        self.tamano = meta["tamano"]
+        self.recortes_por_fragmento = meta["recortes_por_fragmento"]
+        self._mapas = {}
+
+        filas = _leer_indice(os.path.join(directorio, "indice.csv"))
+        if solo_ultimo_guardado:
+            # Si una imagen se guardó varias veces, quedarse solo con su último guardado
+            filas = _vigentes(filas)
+
+        self.imagenes = [fila['imagen'] for fila in filas]
+        columnas = CABECERA_INDICE[2:]
+        self.indice = np.array([[int(fila[c]) for c in columnas] for fila in filas],
+                               dtype=np.int64).reshape(-1, len(columnas))
+
+    def __len__(self):
+        return len(self.indice)
+
+    def _mapa(self, fragmento):
+        mapa = self._mapas.get(fragmento)
+        if mapa is None:
+            ruta = os.path.join(self.directorio, nombre_fragmento(fragmento))
+            bytes_por_recorte = self.tamano * self.tamano * 3
+            num_recortes = os.path.getsize(ruta) // bytes_por_recorte
+            mapa = np.memmap(ruta, dtype=np.uint8, mode='r',
+                             shape=(num_recortes, self.tamano, self.tamano, 3))
+            self._mapas[fragmento] = mapa
+        return mapa
+
+    def __getitem__(self, i):
+        # Vista del recorte sin relleno, leída bajo demanda del fragmento mapeado en memoria
+        fragmento, posicion, alto, ancho = self.indice[i, :4]
+        return self._mapa(int(fragmento))[posicion, :alto, :ancho]
+
+    def metadatos(self, i):
+        fila = dict(zip(CABECERA_INDICE[2:], (int(v) for v in self.indice[i])))
+        fila['imagen'] = self.imagenes[i]
+        return fila
+
+    def indices_de_imagen(self, nombre_imagen):
+        return [i for i, imagen in enumerate(self.imagenes) if imagen == nombre_imagen]
+
+    def iterar(self, tamano_lote=256):
+        # Lotes (recortes con relleno, filas del índice); los recortes son vistas del memmap
+        # cuando el lote es contiguo dentro de un mismo fragmento
+        for inicio in range(0, len(self), tamano_lote):
+            filas = self.indice[inicio:inicio + tamano_lote]
+            fragmentos = filas[:, 0]
+            posiciones = filas[:, 1]
+            if (fragmentos == fragmentos[0]).all() and (np.diff(posiciones) == 1).all():
+                lote = self._mapa(int(fragmentos[0]))[posiciones[0]:posiciones[-1] + 1]
+            else:
+                lote = np.stack([self._mapa(int(f))[p] for f, p in zip(fragmentos, posiciones)])
+            yield lote, filas
@@ -0,0 +1,64 @@
+import threading
+
+import cv2
+
+from exportacion import leer_dimensiones
+
+# Decodificación reducida: en JPEG libjpeg escala en el dominio DCT, sin pasar por la resolución completa
+REDUCCIONES = {2: cv2.IMREAD_REDUCED_COLOR_2, 4: cv2.IMREAD_REDUCED_COLOR_4, 8: cv2.IMREAD_REDUCED_COLOR_8}
+
+
+def leer_reducida(ruta, factor):
+    imagen = cv2.imread(ruta, REDUCCIONES[factor]) if factor > 1 else cv2.imread(ruta)
+    if imagen is None:
+        raise IOError(f"No se pudo leer la imagen {ruta}")
+    return imagen
+
+
+class ImagenOriginal:
+    # Imagen a resolución completa guardada una sola vez en BGR, el orden de cv2.imread, del modelo
+    # y de cv2.imwrite, así que ni la detección ni el guardado necesitan convertirla. Si ocupa más
+    # que el presupuesto de memoria, liberar() suelta el buffer y datos() lo vuelve a leer del
+    # disco cuando alguien lo necesita (detectar, guardar, zoom por encima del 50 %).
+    def __init__(self, ruta, datos=None, presupuesto=None):
+        self.ruta = ruta
+        self.presupuesto = presupuesto
+        self._datos = datos
+        self._lock = threading.Lock()
+        if datos is not None:
+            self.alto, self.ancho = datos.shape[:2]
+        else:
+            # Solo la cabecera: decidir si cabe en el presupuesto no requiere decodificar
+            self.ancho, self.alto = leer_dimensiones(ruta)
+
+    @property
+    def forma(self):
+        return self.alto, self.ancho
+
+    @property
+    def bytes(self):
+        return self.alto * self.ancho * 3
+
+    @property
+    def cargada(self):
+        return self._datos is not None
+
+    def excede_presupuesto(self):
+        return self.presupuesto is not None and self.bytes > self.presupuesto
+
+    def datos(self):
+        with self._lock:
+            if self._datos is None:
+                datos = cv2.imread(self.ruta)
+                if datos is None:
+                    raise IOError(f"No se pudo leer la imagen {self.ruta}")
+                # La orientación EXIF puede diferir de la cabecera leída con PIL en casos raros
+                self.alto, self.ancho = datos.shape[:2]
+                self._datos = datos
+            return self._datos
+
+    def liberar(self):
+        # Quien ya tenga el array lo conserva; solo se suelta la referencia propia
+        if self.excede_presupuesto():
+            with self._lock:
+                self._datos = None
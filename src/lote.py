@@ -0,0 +1,299 @@
+"""
+Etiquetado por lotes sin interfaz gráfica.
+
+Recorre un directorio de imágenes, detecta las uvas con el modelo YOLO y guarda los
+recortes, el CSV de coordenadas y las etiquetas YOLO igual que la aplicación. La
+lectura, la inferencia y la escritura se ejecutan en etapas concurrentes unidas por
+colas acotadas, de modo que decodificar y escribir se solapa con la inferencia.
+
+Uso:
+    python src/lote.py imagenes/ --salida recortes --lote 8
+"""
+
+import argparse
+import os
+import queue
+import sys
+import threading
+import time
+
+import cv2
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from cache_detecciones import CacheDetecciones
+from dataset import actualizar_dataset
+from deteccion import detectar_lote, detectar_por_teselas
+from exportacion import (calcular_recuadro, crear_directorios_yolo, enlazar_o_copiar, escribir_etiquetas_yolo,
+                         escribir_imagen, escribir_metadatos_yolo, escribir_recortes,
+                         escribir_recortes_fragmentos)
+from modelo import RUTA_MODELO, cargar_modelo
+from motores import MOTORES, PRECISIONES
+
+EXTENSIONES = ('.png', '.jpg', '.jpeg', '.bmp')
+
+# Marca de fin de flujo entre etapas
+FIN = object()
+
+
+def listar_imagenes(directorio, recursivo=False):
+    if recursivo:
+        for raiz, _, archivos in os.walk(directorio):
+            for archivo in sorted(archivos):
+                if archivo.lower().endswith(EXTENSIONES):
+                    yield os.path.join(raiz, archivo)
+    else:
+        for archivo in sorted(os.listdir(directorio)):
+            if archivo.lower().endswith(EXTENSIONES):
+                yield os.path.join(directorio, archivo)
+
+
+def recuadros_desde_deteccion(deteccion, tamano, ancho_img, alto_img):
+    # Misma lógica que crear_recuadro: un recuadro de tamaño fijo por centro detectado
+    return [calcular_recuadro(int(x), int(y), tamano, ancho_img, alto_img) for x, y in deteccion.centros]
+
+
+class Estadisticas:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.inicio = time.perf_counter()
+        self.imagenes = 0
+        self.recortes = 0
+        self.errores = 0
+
+    def sumar(self, imagenes=0, recortes=0, errores=0):
+        with self.lock:
+            self.imagenes += imagenes
+            self.recortes += recortes
+            self.errores += errores
+            return self.imagenes
+
+
+def etapa_lectura(cola_rutas, cola_imagenes, estadisticas):
+    while True:
+        ruta = cola_rutas.get()
+        if ruta is FIN:
+            cola_imagenes.put(FIN)
+            return
+
+        # cv2.imread devuelve BGR, que es lo que espera el modelo y lo que escribe cv2
+        imagen = cv2.imread(ruta)
+        if imagen is None:
+            print(f"No se pudo leer la imagen {ruta}")
+            estadisticas.sumar(errores=1)
+            continue
+        cola_imagenes.put((ruta, imagen))
+
+
+def etapa_inferencia(modelo, cola_imagenes, cola_resultados, opciones, estadisticas, num_lectores,
+                     num_escritores, cache=None):
+    def procesar(lote):
+        try:
+            detecciones = inferir(lote)
+        except Exception as e:
+            print(f"Error al detectar uvas en un lote de {len(lote)} imágenes: {str(e)}")
+            estadisticas.sumar(errores=len(lote))
+            return
+
+        for (ruta, imagen), deteccion in zip(lote, detecciones):
+            try:
+                alto_img, ancho_img = imagen.shape[:2]
+                recuadros = recuadros_desde_deteccion(deteccion, opciones.tamano, ancho_img, alto_img)
+            except Exception as e:
+                print(f"Error al procesar las detecciones de {ruta}: {str(e)}")
+                estadisticas.sumar(errores=1)
+                continue
+            cola_resultados.put((ruta, imagen, recuadros))
+
+    def clave(ruta, *configuracion):
+        motor = opciones.motor if opciones.motor == "pytorch" else f"{opciones.motor}-{opciones.precision}"
+        return cache.clave(ruta, opciones.modelo, motor, *configuracion)
+
+    def inferir(lote):
+        if opciones.teselas:
+            return [detectar_por_teselas(modelo, imagen, opciones.umbral,
+                                         tamano_tesela=opciones.tamano_tesela, solape=opciones.solape,
+                                         tamano_lote=opciones.lote, cache=cache,
+                                         clave_cache=clave(ruta) if cache else None)
+                    for ruta, imagen in lote]
+        if cache is None:
+            return detectar_lote(modelo, [imagen for _, imagen in lote], opciones.umbral)
+
+        # Solo se infieren las imágenes que no están en la caché; las guardadas pueden venir de un
+        # umbral más bajo (p. ej. de la aplicación), así que se filtran al umbral pedido
+        claves = [clave(ruta, "directo") for ruta, _ in lote]
+        detecciones = [cache.obtener(clave, opciones.umbral) for clave in claves]
+        detecciones = [d.filtrar(opciones.umbral) if d is not None else None for d in detecciones]
+        pendientes = [i for i, deteccion in enumerate(detecciones) if deteccion is None]
+        if pendientes:
+            nuevas = detectar_lote(modelo, [lote[i][1] for i in pendientes], opciones.umbral)
+            for i, deteccion in zip(pendientes, nuevas):
+                cache.guardar(claves[i], opciones.umbral, deteccion)
+                detecciones[i] = deteccion
+        return detecciones
+
+    lectores_activos = num_lectores
+    lote = []
+    try:
+        while lectores_activos > 0:
+            elemento = cola_imagenes.get()
+            if elemento is FIN:
+                lectores_activos -= 1
+                continue
+            lote.append(elemento)
+            if len(lote) >= opciones.lote:
+                procesar(lote)
+                lote = []
+
+        if lote:
+            procesar(lote)
+    finally:
+        # Los escritores terminan aunque esta etapa falle; si no, el proceso se quedaría esperándolos
+        for _ in range(num_escritores):
+            cola_resultados.put(FIN)
+
+
+def etapa_escritura(cola_resultados, opciones, estadisticas, directorio_images, directorio_labels):
+    while True:
+        elemento = cola_resultados.get()
+        if elemento is FIN:
+            return
+
+        ruta, imagen, recuadros = elemento
+        try:
+            nombre_base = os.path.splitext(os.path.basename(ruta))[0]
+            alto_img, ancho_img = imagen.shape[:2]
+
+            # Recortes y CSV de coordenadas, con el mismo formato que guardar_recortes
+            if recuadros and opciones.formato == "fragmentos":
+                escribir_recortes_fragmentos(opciones.salida, nombre_base, imagen, recuadros,
+                                             opciones.tamano, rgb=False)
+            elif recuadros:
+                escribir_recortes(os.path.join(opciones.salida, nombre_base), nombre_base, imagen,
+                                  recuadros, rgb=False, formato=opciones.formato,
+                                  compresion_png=opciones.compresion)
+
+            # Imagen y etiquetas YOLO; los JPEG se enlazan (o copian) sin volver a codificarlos
+            ruta_imagen_yolo = os.path.join(directorio_images, f"{nombre_base}.jpg")
+            if ruta.lower().endswith(('.jpg', '.jpeg')):
+                enlazar_o_copiar(ruta, ruta_imagen_yolo)
+            else:
+                # Reemplaza en lugar de sobrescribir: el destino puede ser un enlace a otra foto original
+                escribir_imagen(ruta_imagen_yolo, imagen)
+            escribir_etiquetas_yolo(os.path.join(directorio_labels, f"{nombre_base}.txt"),
+                                    recuadros, ancho_img, alto_img)
+
+            total = estadisticas.sumar(imagenes=1, recortes=len(recuadros))
+            if total % opciones.informe == 0:
+                transcurrido = time.perf_counter() - estadisticas.inicio
+                print(f"{total} imágenes procesadas ({total / transcurrido:.2f} img/s)")
+        except Exception as e:
+            print(f"Error al guardar los resultados de {ruta}: {str(e)}")
+            estadisticas.sumar(errores=1)
+
+
+def procesar_directorio(modelo, opciones):
+    directorio_yolo = os.path.join(opciones.salida, "yolo")
+    directorio_images, directorio_labels = crear_directorios_yolo(directorio_yolo)
+
+    # Colas acotadas para limitar la memoria ocupada por imágenes decodificadas
+    cola_rutas = queue.Queue(maxsize=opciones.lote * 4)
+    cola_imagenes = queue.Queue(maxsize=opciones.lote * 2)
+    cola_resultados = queue.Queue(maxsize=opciones.lote * 2)
+    estadisticas = Estadisticas()
+    cache = CacheDetecciones(opciones.cache, opciones.cache_mb * 1024 * 1024) if opciones.cache else None
+
+    hilos = [threading.Thread(target=etapa_lectura, args=(cola_rutas, cola_imagenes, estadisticas), daemon=True)
+             for _ in range(opciones.lectores)]
+    hilos += [threading.Thread(target=etapa_escritura,
+                               args=(cola_resultados, opciones, estadisticas, directorio_images,
+                                     directorio_labels), daemon=True)
+              for _ in range(opciones.escritores)]
+    hilo_inferencia = threading.Thread(target=etapa_inferencia,
+                                       args=(modelo, cola_imagenes, cola_resultados, opciones, estadisticas,
+                                             opciones.lectores, opciones.escritores, cache), daemon=True)
+    for hilo in hilos + [hilo_inferencia]:
+        hilo.start()
+
+    omitidas = 0
+    for ruta in listar_imagenes(opciones.entrada, opciones.recursivo):
+        nombre_base = os.path.splitext(os.path.basename(ruta))[0]
+        ruta_etiquetas = os.path.join(directorio_labels, f"{nombre_base}.txt")
+        if opciones.omitir_existentes and os.path.exists(ruta_etiquetas):
+            omitidas += 1
+            continue
+        cola_rutas.put(ruta)
+
+    for _ in range(opciones.lectores):
+        cola_rutas.put(FIN)
+    for hilo in hilos + [hilo_inferencia]:
+        hilo.join()
+
+    escribir_metadatos_yolo(directorio_yolo, sobrescribir_clases=False)
+    cambios = actualizar_dataset(directorio_yolo)
+    if cambios is not None:
+        print(f"Índice del dataset: {cambios['nuevas']} nuevas, {cambios['cambiadas']} cambiadas")
+
+    transcurrido = time.perf_counter() - estadisticas.inicio
+    print(f"Terminado: {estadisticas.imagenes} imágenes, {estadisticas.recortes} recortes, "
+          f"{estadisticas.errores} errores, {omitidas} omitidas en {transcurrido:.1f} s")
+    return estadisticas
+
+
+def entero_positivo(valor):
+    numero = int(valor)
+    if numero < 1:
+        raise argparse.ArgumentTypeError(f"debe ser un entero mayor que 0, no {valor}")
+    return numero
+
+
+def crear_parser():
+    parser = argparse.ArgumentParser(description="Etiquetado automático de uvas por lotes sin interfaz")
+    parser.add_argument("entrada", help="Directorio con las imágenes a procesar")
+    parser.add_argument("--salida", default="recortes", help="Directorio de salida (por defecto: recortes)")
+    parser.add_argument("--modelo", default=RUTA_MODELO, help="Ruta a los pesos del modelo YOLO")
+    parser.add_argument("--motor", choices=MOTORES, default="pytorch", help="Motor de inferencia")
+    parser.add_argument("--precision", choices=PRECISIONES, default="fp32",
+                        help="Precisión del modelo ONNX (solo con --motor onnx)")
+    parser.add_argument("--hilos-inferencia", type=int, default=None, help="Hilos del motor de inferencia")
+    parser.add_argument("--umbral", type=float, default=0.5, help="Umbral de confianza")
+    parser.add_argument("--tamano", type=int, default=150, help="Tamaño del recuadro en píxeles")
+    parser.add_argument("--lote", type=entero_positivo, default=8, help="Imágenes por lote de inferencia")
+    parser.add_argument("--lectores", type=entero_positivo, default=2, help="Hilos de decodificación")
+    parser.add_argument("--escritores", type=entero_positivo, default=4, help="Hilos de escritura")
+    parser.add_argument("--formato", choices=["png", "webp", "fragmentos"], default="png",
+                        help="Formato de los recortes")
+    parser.add_argument("--compresion", type=int, default=3, help="Nivel de compresión PNG (0-9)")
+    parser.add_argument("--recursivo", action="store_true", help="Buscar imágenes en subdirectorios")
+    parser.add_argument("--omitir-existentes", action="store_true",
+                        help="No volver a procesar imágenes que ya tienen etiquetas YOLO")
+    parser.add_argument("--teselas", action="store_true", help="Usar detección por teselas")
+    parser.add_argument("--tamano-tesela", type=int, default=640, help="Tamaño de las teselas")
+    parser.add_argument("--solape", type=float, default=0.2, help="Solape entre teselas")
+    parser.add_argument("--cache", default=None,
+                        help="Directorio de la caché de detecciones (p. ej. .cache_detecciones)")
+    parser.add_argument("--cache-mb", type=int, default=256, help="Tamaño máximo de la caché en MB")
+    parser.add_argument("--informe", type=int, default=100, help="Mostrar progreso cada N imágenes")
+    return parser
+
+
+def main(argv=None):
+    opciones = crear_parser().parse_args(argv)
+
+    if not os.path.isdir(opciones.entrada):
+        print(f"No existe el directorio {opciones.entrada}")
+        return 1
+    if not os.path.exists(opciones.modelo):
+        print(f"No se encontró el modelo en {opciones.modelo}")
+        return 1
+
+    modelo = cargar_modelo(opciones.modelo, motor=opciones.motor, precision=opciones.precision,
+                           hilos=opciones.hilos_inferencia)
+    print("Modelo cargado correctamente")
+
+    estadisticas = procesar_directorio(modelo, opciones)
+    return 1 if estadisticas.errores else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
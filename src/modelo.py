@@ -0,0 +1,73 @@
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+RUTA_MODELO = "modelos_uvas/detector_uvas/weights/best.pt"
+
+
+def cargar_modelo(ruta_modelo=RUTA_MODELO, calentar=True, motor="pytorch", precision="fp32", hilos=None):
+    # torch y ultralytics se importan aquí para no retrasar el arranque de la aplicación
+    if not os.path.exists(ruta_modelo):
+        raise FileNotFoundError(f"No se encontró el modelo en {ruta_modelo}")
+
+    if motor == "onnx":
+        # El ONNX exportado se guarda junto a los pesos y solo se regenera si best.pt cambia
+        from motores import ModeloOnnx, exportar_onnx
+
+        modelo = ModeloOnnx(exportar_onnx(ruta_modelo, precision), hilos=hilos)
+    else:
+        import torch
+        from ultralytics import YOLO
+
+        if hilos:
+            torch.set_num_threads(hilos)
+        modelo = YOLO(ruta_modelo)
+
+    if calentar:
+        # Una inferencia de prueba inicializa los pesos y los núcleos antes de la primera detección real
+        modelo(np.zeros((640, 640, 3), dtype=np.uint8), verbose=False)
+    return modelo
+
+
+class CargadorModelo:
+    # Carga el modelo en un hilo en segundo plano; la interfaz consulta el futuro sin bloquearse
+    def __init__(self, ruta_modelo=RUTA_MODELO, motor="pytorch", precision="fp32", hilos=None):
+        self.ruta_modelo = ruta_modelo
+        self.motor = motor
+        self.precision = precision
+        self.hilos = hilos
+        self.futuro = None
+        self.tiempo_carga = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="carga_modelo")
+
+    def iniciar(self):
+        if self.futuro is None:
+            self.futuro = self._executor.submit(self._cargar)
+        return self.futuro
+
+    def _cargar(self):
+        inicio = time.perf_counter()
+        modelo = cargar_modelo(self.ruta_modelo, motor=self.motor, precision=self.precision, hilos=self.hilos)
+        self.tiempo_carga = time.perf_counter() - inicio
+        return modelo
+
+    def terminado(self):
+        return self.futuro is not None and self.futuro.done()
+
+    def error(self):
+        if not self.terminado():
+            return None
+        return self.futuro.exception()
+
+    def obtener(self, timeout=None):
+        return self.iniciar().result(timeout)
+
+    def cerrar(self):
+        # Una carga en curso no se puede interrumpir, pero una pendiente ya no empieza
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def identificador(self):
+        # Distingue en la caché de detecciones los resultados de cada motor y precisión
+        return "pytorch" if self.motor == "pytorch" else f"{self.motor}-{self.precision}"
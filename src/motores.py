@@ -0,0 +1,307 @@
+"""
+Motores de inferencia del detector de uvas.
+
+El motor "pytorch" usa directamente el modelo de ultralytics. El motor "onnx" exporta
+best.pt una sola vez a ONNX (opcionalmente cuantizado a INT8 o convertido a FP16), guarda
+el archivo junto a los pesos y lo ejecuta con ONNX Runtime en la CPU con un número de
+hilos configurable, sin necesidad de cargar torch en los puestos de etiquetado.
+
+Uso:
+    python src/motores.py --precision int8 --paridad imagenes/
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from cache_detecciones import hash_archivo
+from deteccion import detectar_en_memoria, nms
+
+MOTORES = ("pytorch", "onnx")
+PRECISIONES = ("fp32", "fp16", "int8")
+
+
+def ruta_exportada(ruta_pesos, precision="fp32"):
+    # best.pt -> best.onnx, best.fp16.onnx o best.int8.onnx en el mismo directorio
+    base = os.path.splitext(ruta_pesos)[0]
+    sufijo = "" if precision == "fp32" else f".{precision}"
+    return f"{base}{sufijo}.onnx"
+
+
+def _exportacion_valida(ruta_onnx, hash_pesos, tamano):
+    # El archivo .json junto al .onnx recuerda de qué pesos se exportó
+    try:
+        with open(f"{ruta_onnx}.json", 'r') as archivo:
+            meta = json.load(archivo)
+    except (OSError, ValueError):
+        return False
+    return os.path.exists(ruta_onnx) and meta.get("pesos") == hash_pesos and meta.get("tamano") == tamano
+
+
+def exportar_onnx(ruta_pesos, precision="fp32", tamano=640, forzar=False):
+    # Devuelve la ruta del modelo ONNX, exportándolo solo si no existe o si los pesos cambiaron
+    if precision not in PRECISIONES:
+        raise ValueError(f"Precisión no válida: {precision}")
+    if not os.path.exists(ruta_pesos):
+        raise FileNotFoundError(f"No se encontró el modelo en {ruta_pesos}")
+
+    hash_pesos = hash_archivo(ruta_pesos)
+    ruta_onnx = ruta_exportada(ruta_pesos, precision)
+    if not forzar and _exportacion_valida(ruta_onnx, hash_pesos, tamano):
+        return ruta_onnx
+
+    ruta_base = ruta_exportada(ruta_pesos, "fp32")
+    if forzar or not _exportacion_valida(ruta_base, hash_pesos, tamano):
+        from ultralytics import YOLO
+
+        # Lote y tamaño dinámicos para poder inferir varias imágenes o teselas en una llamada
+        exportado = YOLO(ruta_pesos).export(format="onnx", imgsz=tamano, dynamic=True, simplify=True)
+        if os.path.abspath(str(exportado)) != os.path.abspath(ruta_base):
+            os.replace(str(exportado), ruta_base)
+        _guardar_meta(ruta_base, hash_pesos, tamano, "fp32")
+
+    if precision == "int8":
+        # Cuantización dinámica de los pesos: no necesita imágenes de calibración
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+
+        quantize_dynamic(ruta_base, ruta_onnx, weight_type=QuantType.QUInt8)
+        _guardar_meta(ruta_onnx, hash_pesos, tamano, precision)
+    elif precision == "fp16":
+        # Entradas y salidas siguen en float32; solo cambian los pesos y las operaciones internas
+        import onnx
+        from onnxconverter_common import float16
+
+        modelo = float16.convert_float_to_float16(onnx.load(ruta_base), keep_io_types=True)
+        onnx.save(modelo, ruta_onnx)
+        _guardar_meta(ruta_onnx, hash_pesos, tamano, precision)
+
+    return ruta_onnx
+
+
+def _guardar_meta(ruta_onnx, hash_pesos, tamano, precision):
+    with open(f"{ruta_onnx}.json", 'w') as archivo:
+        json.dump({"pesos": hash_pesos, "tamano": tamano, "precision": precision}, archivo)
+
+
+class _Cajas:
+    # Mismo subconjunto de la API de ultralytics (boxes.cpu().numpy().xyxy/conf/cls) que usa
+    # resultado_desde_yolo, para que la detección funcione igual con cualquier motor
+    def __init__(self, xyxy, conf, cls):
+        self.xyxy = xyxy
+        self.conf = conf
+        self.cls = cls
+
+    def cpu(self):
+        return self
+
+    def numpy(self):
+        return self
+
+
+class ResultadoOnnx:
+    def __init__(self, cajas, puntuaciones, clases, speed):
+        self.boxes = _Cajas(cajas, puntuaciones, clases)
+        self.speed = speed
+
+
+def _letterbox(imagen, tamano):
+    # Redimensiona conservando la proporción y rellena con gris hasta tamano x tamano
+    alto, ancho = imagen.shape[:2]
+    ganancia = min(tamano / alto, tamano / ancho)
+    nuevo_ancho, nuevo_alto = int(round(ancho * ganancia)), int(round(alto * ganancia))
+    if (nuevo_ancho, nuevo_alto) != (ancho, alto):
+        imagen = cv2.resize(np.ascontiguousarray(imagen), (nuevo_ancho, nuevo_alto),
+                            interpolation=cv2.INTER_LINEAR)
+
+    izquierda = (tamano - nuevo_ancho) // 2
+    arriba = (tamano - nuevo_alto) // 2
+    lienzo = np.full((tamano, tamano, 3), 114, dtype=np.uint8)
+    lienzo[arriba:arriba + nuevo_alto, izquierda:izquierda + nuevo_ancho] = imagen
+    return lienzo, ganancia, izquierda, arriba
+
+
+class ModeloOnnx:
+    # Detector YOLO exportado a ONNX ejecutado con ONNX Runtime en la CPU. Se llama igual que
+    # un modelo de ultralytics: modelo(imagen_bgr o lista, conf=..., verbose=False).
+    def __init__(self, ruta_onnx, hilos=None, tamano=640, umbral_iou=0.7, max_detecciones=300):
+        import onnxruntime as ort
+
+        opciones = ort.SessionOptions()
+        opciones.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        opciones.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+        # Todos los hilos en cada operación; uno entre operaciones porque el grafo es secuencial
+        opciones.intra_op_num_threads = hilos or os.cpu_count() or 1
+        opciones.inter_op_num_threads = 1
+
+        self.ruta = ruta_onnx
+        self.tamano = tamano
+        self.umbral_iou = umbral_iou
+        self.max_detecciones = max_detecciones
+        self.sesion = ort.InferenceSession(ruta_onnx, opciones, providers=["CPUExecutionProvider"])
+        self.entrada = self.sesion.get_inputs()[0].name
+
+    def __call__(self, imagenes, conf=0.25, verbose=False):
+        if isinstance(imagenes, np.ndarray):
+            imagenes = [imagenes]
+        if not imagenes:
+            return []
+
+        inicio = time.perf_counter()
+        lienzos, transformaciones = [], []
+        for imagen in imagenes:
+            lienzo, ganancia, izquierda, arriba = _letterbox(imagen, self.tamano)
+            lienzos.append(lienzo)
+            transformaciones.append((ganancia, izquierda, arriba, imagen.shape[1], imagen.shape[0]))
+        # BGR -> RGB, NHWC -> NCHW y escala a [0, 1], como el preproceso de ultralytics
+        tensor = np.ascontiguousarray(np.stack(lienzos)[..., ::-1].transpose(0, 3, 1, 2), dtype=np.float32)
+        tensor /= 255.0
+
+        inicio_inferencia = time.perf_counter()
+        salida = self.sesion.run(None, {self.entrada: tensor})[0]
+        inicio_postproceso = time.perf_counter()
+
+        resultados = [self._postprocesar(prediccion, conf, *transformacion)
+                      for prediccion, transformacion in zip(salida, transformaciones)]
+        fin = time.perf_counter()
+
+        # Tiempos por imagen en milisegundos, igual que result.speed de ultralytics
+        n = len(imagenes)
+        velocidad = {
+            "preprocess": (inicio_inferencia - inicio) * 1000.0 / n,
+            "inference": (inicio_postproceso - inicio_inferencia) * 1000.0 / n,
+            "postprocess": (fin - inicio_postproceso) * 1000.0 / n,
+        }
+        return [ResultadoOnnx(cajas, puntuaciones, clases, dict(velocidad))
+                for cajas, puntuaciones, clases in resultados]
+
+    def _postprocesar(self, prediccion, conf, ganancia, izquierda, arriba, ancho, alto):
+        # prediccion: (4 + clases, anclas) con cajas centro-ancho-alto en píxeles del lienzo
+        prediccion = prediccion.T
+        puntuaciones_clase = prediccion[:, 4:]
+        clases = puntuaciones_clase.argmax(axis=1)
+        puntuaciones = puntuaciones_clase[np.arange(len(clases)), clases]
+
+        mascara = puntuaciones >= conf
+        xywh = prediccion[mascara, :4]
+        puntuaciones = puntuaciones[mascara].astype(np.float32)
+        clases = clases[mascara].astype(np.float32)
+
+        cajas = np.empty_like(xywh)
+        cajas[:, :2] = xywh[:, :2] - xywh[:, 2:] / 2
+        cajas[:, 2:] = xywh[:, :2] + xywh[:, 2:] / 2
+
+        # NMS por clase desplazando las cajas de cada clase a una zona distinta del plano
+        desplazadas = cajas + clases[:, None] * 7680.0
+        indices = nms(desplazadas, puntuaciones, self.umbral_iou)[:self.max_detecciones]
+        cajas, puntuaciones, clases = cajas[indices], puntuaciones[indices], clases[indices]
+
+        # Del lienzo con relleno a coordenadas de la imagen de entrada
+        cajas -= np.array([izquierda, arriba, izquierda, arriba], dtype=np.float32)
+        cajas /= ganancia
+        cajas[:, [0, 2]] = cajas[:, [0, 2]].clip(0, ancho)
+        cajas[:, [1, 3]] = cajas[:, [1, 3]].clip(0, alto)
+        return cajas.astype(np.float32), puntuaciones, clases
+
+
+def iou_cajas(a, b):
+    # Matriz de IoU entre dos conjuntos de cajas (x1, y1, x2, y2)
+    x1 = np.maximum(a[:, None, 0], b[None, :, 0])
+    y1 = np.maximum(a[:, None, 1], b[None, :, 1])
+    x2 = np.minimum(a[:, None, 2], b[None, :, 2])
+    y2 = np.minimum(a[:, None, 3], b[None, :, 3])
+    interseccion = np.clip(x2 - x1, 0, None) * np.clip(y2 - y1, 0, None)
+    area_a = (a[:, 2] - a[:, 0]) * (a[:, 3] - a[:, 1])
+    area_b = (b[:, 2] - b[:, 0]) * (b[:, 3] - b[:, 1])
+    return interseccion / np.maximum(area_a[:, None] + area_b[None, :] - interseccion, 1e-9)
+
+
+def comparar_detecciones(referencia, candidata, iou_minimo=0.9):
+    # Empareja cada caja de referencia con la candidata de mayor IoU que no se haya usado
+    emparejadas, ious, diferencias = 0, [], []
+    if len(referencia) and len(candidata):
+        matriz = iou_cajas(referencia.cajas, candidata.cajas)
+        usadas = set()
+        for i in np.argsort(-referencia.puntuaciones):
+            for j in np.argsort(-matriz[i]):
+                if matriz[i, j] < iou_minimo:
+                    break
+                if j in usadas:
+                    continue
+                usadas.add(j)
+                emparejadas += 1
+                ious.append(float(matriz[i, j]))
+                diferencias.append(abs(float(referencia.puntuaciones[i] - candidata.puntuaciones[j])))
+                break
+    return {"referencia": len(referencia), "candidata": len(candidata), "emparejadas": emparejadas,
+            "iou_medio": float(np.mean(ious)) if ious else None,
+            "max_dif_puntuacion": max(diferencias) if diferencias else 0.0}
+
+
+def verificar_paridad(ruta_pesos, modelo, rutas_imagenes, umbral=0.25, iou_minimo=0.9, tolerancia=0.02):
+    # Compara las detecciones del modelo exportado con las de PyTorch en las mismas imágenes.
+    # Se admite que falte o sobre una caja por imagen cerca del umbral de confianza.
+    from ultralytics import YOLO
+
+    referencia = YOLO(ruta_pesos)
+    informe = {"imagenes": [], "correcto": True}
+    for ruta in rutas_imagenes:
+        imagen = cv2.imread(ruta)
+        if imagen is None:
+            continue
+        comparacion = comparar_detecciones(detectar_en_memoria(referencia, imagen, umbral),
+                                           detectar_en_memoria(modelo, imagen, umbral), iou_minimo)
+        comparacion["ruta"] = ruta
+        faltan = max(comparacion["referencia"], comparacion["candidata"]) - comparacion["emparejadas"]
+        comparacion["correcto"] = faltan <= 1 and comparacion["max_dif_puntuacion"] <= tolerancia
+        informe["correcto"] &= comparacion["correcto"]
+        informe["imagenes"].append(comparacion)
+    return informe
+
+
+def crear_parser():
+    parser = argparse.ArgumentParser(description="Exporta el detector a ONNX y comprueba su paridad con PyTorch")
+    parser.add_argument("--modelo", default=None, help="Ruta a los pesos best.pt")
+    parser.add_argument("--precision", choices=PRECISIONES, default="fp32", help="Precisión del modelo ONNX")
+    parser.add_argument("--tamano", type=int, default=640, help="Tamaño de entrada del modelo")
+    parser.add_argument("--hilos", type=int, default=None, help="Hilos de ONNX Runtime")
+    parser.add_argument("--forzar", action="store_true", help="Volver a exportar aunque exista el archivo")
+    parser.add_argument("--paridad", default=None, help="Directorio de imágenes para comparar con PyTorch")
+    parser.add_argument("--umbral", type=float, default=0.25, help="Umbral de confianza de la comparación")
+    parser.add_argument("--tolerancia", type=float, default=0.02,
+                        help="Diferencia máxima de puntuación entre cajas emparejadas")
+    return parser
+
+
+def main(argv=None):
+    from modelo import RUTA_MODELO
+
+    opciones = crear_parser().parse_args(argv)
+    ruta_pesos = opciones.modelo or RUTA_MODELO
+    ruta_onnx = exportar_onnx(ruta_pesos, opciones.precision, opciones.tamano, opciones.forzar)
+    print(f"Modelo ONNX: {ruta_onnx}")
+
+    if not opciones.paridad:
+        return 0
+
+    from lote import listar_imagenes
+
+    modelo = ModeloOnnx(ruta_onnx, opciones.hilos, opciones.tamano)
+    informe = verificar_paridad(ruta_pesos, modelo, list(listar_imagenes(opciones.paridad)),
+                                opciones.umbral, tolerancia=opciones.tolerancia)
+    for comparacion in informe["imagenes"]:
+        estado = "OK" if comparacion["correcto"] else "DIFERENTE"
+        print(f"{estado} {comparacion['ruta']}: {comparacion['emparejadas']}/{comparacion['referencia']} cajas, "
+              f"diferencia máxima de puntuación {comparacion['max_dif_puntuacion']:.3f}")
+    print("Paridad correcta" if informe["correcto"] else "Paridad fuera de tolerancia")
+    return 0 if informe["correcto"] else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,126 @@
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
+
+from imagen import ImagenOriginal
+from visor import PiramideImagen
+
+EXTENSIONES = ('.png', '.jpg', '.jpeg', '.bmp')
+
+
+def listar_carpeta(directorio):
+    return [os.path.join(directorio, archivo) for archivo in sorted(os.listdir(directorio))
+            if archivo.lower().endswith(EXTENSIONES)]
+
+
+@dataclass
+class ImagenPrecargada:
+    ruta: str
+    imagen: ImagenOriginal
+    piramide: PiramideImagen
+    deteccion: object = None
+
+    @property
+    def bytes(self):
+        # El nivel 0 de la pirámide es el mismo array que la imagen completa cuando está cargada
+        completa = self.imagen.bytes if self.imagen.cargada and self.piramide.niveles[0] is None else 0
+        return self.piramide.bytes + completa
+
+
+class PrecargadorImagenes:
+    # Decodifica en segundo plano las siguientes imágenes de la carpeta (y la anterior), construye
+    # su pirámide de visualización y, opcionalmente, ejecuta la detección. Las imágenes listas se
+    # guardan en una caché LRU limitada por memoria que nunca descarta la ventana actual.
+    # debe_detectar() decide en cada carga si se detecta; si no, la imagen no se lee completa.
+    def __init__(self, rutas, adelante=3, hilos=2, memoria_max=1500 * 1024 * 1024, detectar=None,
+                 presupuesto_imagen=None, debe_detectar=None):
+        self.rutas = list(rutas)
+        self.adelante = adelante
+        self.memoria_max = memoria_max
+        self.presupuesto_imagen = presupuesto_imagen
+        self.detectar = detectar
+        self.debe_detectar = debe_detectar
+        self.indice = 0
+        self._pool = ThreadPoolExecutor(max_workers=hilos, thread_name_prefix="precarga")
+        self._lock = threading.Lock()
+        self._futuros = {}
+        self._cache = OrderedDict()
+
+    def __len__(self):
+        return len(self.rutas)
+
+    def _cargar(self, ruta):
+        try:
+            fuente = ImagenOriginal(ruta, presupuesto=self.presupuesto_imagen)
+            detectar = self.detectar is not None and (self.debe_detectar is None or self.debe_detectar())
+            if detectar:
+                # La detección necesita la imagen completa: se lee una vez y la pirámide sale de ella
+                fuente.datos()
+            entrada = ImagenPrecargada(ruta, fuente, PiramideImagen.desde_fuente(fuente))
+            if detectar:
+                try:
+                    entrada.deteccion = self.detectar(ruta, fuente.datos())
+                except Exception as e:
+                    # Un fallo del modelo no impide abrir la imagen: se detectará cuando se pida
+                    print(f"Error en la detección anticipada de {ruta}: {str(e)}")
+                    entrada.deteccion = None
+            fuente.liberar()
+        except Exception:
+            # Sin entrada en caché: un nuevo intento volverá a leer el archivo
+            with self._lock:
+                self._futuros.pop(ruta, None)
+            raise
+
+        with self._lock:
+            self._cache[ruta] = entrada
+            self._futuros.pop(ruta, None)
+            self._liberar_memoria()
+        return entrada
+
+    def _ventana(self):
+        inicio = max(0, self.indice - 1)
+        return set(self.rutas[inicio:self.indice + self.adelante + 1])
+
+    def _liberar_memoria(self):
+        ventana = self._ventana()
+        total = sum(entrada.bytes for entrada in self._cache.values())
+        for ruta in list(self._cache):
+            if total <= self.memoria_max:
+                break
+            if ruta in ventana:
+                continue
+            total -= self._cache.pop(ruta).bytes
+
+    def futuro(self, indice):
+        # Futuro con la ImagenPrecargada del índice; si ya está en caché se devuelve resuelto
+        ruta = self.rutas[indice]
+        with self._lock:
+            entrada = self._cache.get(ruta)
+            if entrada is not None:
+                self._cache.move_to_end(ruta)
+                resuelto = Future()
+                resuelto.set_result(entrada)
+                return resuelto
+            futuro = self._futuros.get(ruta)
+            if futuro is None:
+                futuro = self._pool.submit(self._cargar, ruta)
+                self._futuros[ruta] = futuro
+            return futuro
+
+    def ir_a(self, indice):
+        # Cambia la posición actual y programa la precarga de las siguientes y de la anterior
+        self.indice = max(0, min(indice, len(self.rutas) - 1))
+        futuro = self.futuro(self.indice)
+        vecinos = list(range(self.indice + 1, self.indice + self.adelante + 1)) + [self.indice - 1]
+        for vecino in vecinos:
+            if 0 <= vecino < len(self.rutas):
+                self.futuro(vecino)
+        return futuro
+
+    def cerrar(self):
+        self._pool.shutdown(wait=False, cancel_futures=True)
+        with self._lock:
+            self._cache.clear()
+            self._futuros.clear()
@@ -0,0 +1,106 @@
+import csv
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+from deteccion import ResultadoDeteccion, detectar_lote
+
+# Detecciones por imagen a la espera de que alguien las revise: recortes/_pendientes/<imagen>.csv
+DIRECTORIO_PENDIENTES = "_pendientes"
+CABECERA_PENDIENTES = ["centro_x", "centro_y", "x1", "y1", "x2", "y2", "puntuacion"]
+
+
+def ruta_pendientes(directorio_base, ruta_imagen):
+    nombre_base = os.path.splitext(os.path.basename(ruta_imagen))[0]
+    return os.path.join(directorio_base, DIRECTORIO_PENDIENTES, f"{nombre_base}.csv")
+
+
+def revisada(directorio_base, ruta_imagen):
+    # Una imagen con recortes guardados ya pasó por la revisión
+    nombre_base = os.path.splitext(os.path.basename(ruta_imagen))[0]
+    return os.path.exists(os.path.join(directorio_base, nombre_base, f"{nombre_base}_coordenadas.csv"))
+
+
+def guardar_pendientes(ruta, resultado):
+    # Puntos y cajas del detector, con todas las puntuaciones para poder cambiar el umbral al revisar
+    os.makedirs(os.path.dirname(ruta), exist_ok=True)
+    temporal = f"{ruta}.tmp"
+    with open(temporal, 'w', newline='') as archivo_csv:
+        escritor = csv.writer(archivo_csv)
+        escritor.writerow(CABECERA_PENDIENTES)
+        for (centro_x, centro_y), caja, puntuacion in zip(resultado.centros.tolist(), resultado.cajas.tolist(),
+                                                          resultado.puntuaciones.tolist()):
+            escritor.writerow([centro_x, centro_y] + [f"{valor:.1f}" for valor in caja] + [f"{puntuacion:.4f}"])
+    os.replace(temporal, ruta)
+
+
+def leer_pendientes(ruta):
+    # ResultadoDeteccion guardado por guardar_pendientes, o None si la imagen no tiene pendientes
+    try:
+        with open(ruta, 'r', newline='') as archivo_csv:
+            filas = [(float(fila['x1']), float(fila['y1']), float(fila['x2']), float(fila['y2']),
+                      float(fila['puntuacion'])) for fila in csv.DictReader(archivo_csv)]
+    except FileNotFoundError:
+        return None
+    datos = np.array(filas, dtype=np.float32).reshape(-1, 5)
+    return ResultadoDeteccion(datos[:, :4], datos[:, 4], np.zeros(len(datos), dtype=np.float32))
+
+
+def descartar_pendientes(ruta):
+    try:
+        os.remove(ruta)
+    except FileNotFoundError:
+        pass
+
+
+def _leer_bgr(ruta):
+    imagen = cv2.imread(ruta)
+    if imagen is None:
+        raise IOError(f"No se pudo leer la imagen {ruta}")
+    return imagen
+
+
+def detectar_carpeta(modelo, rutas, umbral_confianza, tamano_lote=8, hilos=2, lock=None, al_detectar=None,
+                     progreso=None, comprobar=None):
+    # Detecta las imágenes por lotes de tamano_lote en una sola llamada al modelo. Mientras se infiere
+    # un lote, los hilos de lectura ya decodifican el siguiente. al_detectar(ruta, resultado) recibe
+    # cada resultado; devuelve la lista de (ruta, error) de las imágenes que no se pudieron leer.
+    lotes = [rutas[i:i + tamano_lote] for i in range(0, len(rutas), tamano_lote)]
+    errores = []
+    hechos = 0
+    pool = ThreadPoolExecutor(max_workers=max(1, hilos), thread_name_prefix="lectura_carpeta")
+    try:
+        siguiente = [(ruta, pool.submit(_leer_bgr, ruta)) for ruta in lotes[0]] if lotes else []
+        for indice in range(len(lotes)):
+            actual = siguiente
+            if indice + 1 < len(lotes):
+                siguiente = [(ruta, pool.submit(_leer_bgr, ruta)) for ruta in lotes[indice + 1]]
+
+            imagenes, leidas = [], []
+            for ruta, futuro in actual:
+                try:
+                    imagenes.append(futuro.result())
+                    leidas.append(ruta)
+                except (IOError, OSError) as e:
+                    errores.append((ruta, str(e)))
+
+            if lock is not None:
+                with lock:
+                    resultados = detectar_lote(modelo, imagenes, umbral_confianza)
+            else:
+                resultados = detectar_lote(modelo, imagenes, umbral_confianza)
+            del imagenes
+            if al_detectar is not None:
+                for ruta, resultado in zip(leidas, resultados):
+                    al_detectar(ruta, resultado)
+
+            hechos += len(actual)
+            if progreso is not None:
+                progreso(hechos, len(rutas))
+            if comprobar is not None:
+                comprobar()
+    finally:
+        pool.shutdown(wait=True, cancel_futures=True)
+    return errores
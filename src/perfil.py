@@ -0,0 +1,200 @@
+import cProfile
+import io
+import json
+import logging
+import os
+import pstats
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime
+from logging.handlers import RotatingFileHandler
+
+DIRECTORIO_REGISTROS = "registros"
+
+# Evita activar dos perfiles cProfile a la vez en el mismo hilo (etapas anidadas)
+_hilo = threading.local()
+
+
+class Accion:
+    # Tiempos por etapa de una acción del usuario (abrir, detectar, guardar...). Las etapas se
+    # pueden medir desde cualquier hilo; la acción se cierra con terminar() en el hilo de Tk.
+    def __init__(self, registro, nombre, perfilar=False, automatica=False, **datos):
+        self.registro = registro
+        self.nombre = nombre
+        self.datos = dict(datos)
+        self.etapas = {}
+        self.perfilar = perfilar
+        self.automatica = automatica
+        self.inicio = time.perf_counter()
+        self.total = None
+        self.ruta_perfil = None
+        self._perfiles = []
+        self._lock = threading.Lock()
+
+    def sumar(self, etapa, milisegundos):
+        with self._lock:
+            self.etapas[etapa] = self.etapas.get(etapa, 0.0) + milisegundos
+
+    def agregar_tiempos(self, tiempos, prefijo):
+        # Tiempos ya medidos en otro sitio, p. ej. los de ResultadoDeteccion.tiempos
+        for etapa, milisegundos in tiempos.items():
+            if etapa != "total":
+                self.sumar(f"{prefijo}.{etapa}", milisegundos)
+
+    @contextmanager
+    def etapa(self, nombre):
+        perfil = None
+        if self.perfilar and not getattr(_hilo, "perfilando", False):
+            perfil = cProfile.Profile()
+            _hilo.perfilando = True
+            perfil.enable()
+        inicio = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.sumar(nombre, (time.perf_counter() - inicio) * 1000.0)
+            if perfil is not None:
+                perfil.disable()
+                _hilo.perfilando = False
+                with self._lock:
+                    self._perfiles.append(perfil)
+
+    def terminar(self, **datos):
+        if self.total is not None:
+            return
+        self.total = (time.perf_counter() - self.inicio) * 1000.0
+        self.datos.update(datos)
+        self.registro.terminar(self)
+
+    def resumen(self):
+        etapas = " · ".join(f"{etapa} {milisegundos:.0f} ms" for etapa, milisegundos in self.etapas.items()
+                            if "." not in etapa)
+        return f"{self.nombre}: {etapas} · total {self.total:.0f} ms"
+
+
+class RegistroTiempos:
+    # Escribe una línea JSON por acción en un registro rotativo y, si se pide, captura un perfil
+    # de cProfile y una instantánea de tracemalloc de la siguiente acción. Las acciones automáticas
+    # (p. ej. el renderizado al desplazar la vista) se acumulan y se escriben como una sola línea
+    # cada agrupar_veces acciones o agrupar_segundos segundos.
+    def __init__(self, directorio=DIRECTORIO_REGISTROS, max_bytes=5 * 1024 * 1024, copias=3, agrupar_veces=200,
+                 agrupar_segundos=60.0):
+        self.directorio = directorio
+        self.max_bytes = max_bytes
+        self.copias = copias
+        self.agrupar_veces = agrupar_veces
+        self.agrupar_segundos = agrupar_segundos
+        self.perfilar_siguiente = False
+        self.al_terminar = None  # Se llama como al_terminar(accion) al cerrar cada acción del usuario
+        self._logger = None
+        self._tracemalloc_propio = False
+        self._automaticas = {}
+        self._lock = threading.Lock()
+
+    @property
+    def logger(self):
+        if self._logger is None:
+            os.makedirs(self.directorio, exist_ok=True)
+            self._logger = logging.getLogger(f"uvas.tiempos.{id(self)}")
+            self._logger.setLevel(logging.INFO)
+            self._logger.propagate = False
+            manejador = RotatingFileHandler(os.path.join(self.directorio, "tiempos.jsonl"),
+                                            maxBytes=self.max_bytes, backupCount=self.copias, encoding="utf-8")
+            manejador.setFormatter(logging.Formatter("%(message)s"))
+            self._logger.addHandler(manejador)
+        return self._logger
+
+    def iniciar(self, nombre, automatica=False, **datos):
+        # Solo las acciones que lanza el usuario consumen perfilar_siguiente; las automáticas
+        # se miden pero no se perfilan, no se registran una a una ni llegan a al_terminar
+        perfilar = not automatica and self.perfilar_siguiente
+        if perfilar:
+            self.perfilar_siguiente = False
+        if perfilar and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._tracemalloc_propio = True
+        return Accion(self, nombre, perfilar, automatica, **datos)
+
+    def terminar(self, accion):
+        if accion.automatica:
+            self._acumular(accion)
+            return
+
+        entrada = {"fecha": datetime.now().isoformat(timespec="milliseconds"), "accion": accion.nombre,
+                   "total_ms": round(accion.total, 3),
+                   "etapas_ms": {etapa: round(ms, 3) for etapa, ms in accion.etapas.items()}}
+        entrada.update(accion.datos)
+        if accion.perfilar:
+            accion.ruta_perfil = self._guardar_perfil(accion)
+            entrada["perfil"] = accion.ruta_perfil
+
+        self._escribir(entrada)
+        if self.al_terminar is not None:
+            self.al_terminar(accion)
+
+    def _acumular(self, accion):
+        with self._lock:
+            grupo = self._automaticas.setdefault(accion.nombre, {
+                "desde": time.monotonic(), "fecha": datetime.now().isoformat(timespec="milliseconds"),
+                "veces": 0, "total_ms": 0.0, "max_ms": 0.0, "etapas_ms": {}})
+            grupo["veces"] += 1
+            grupo["total_ms"] += accion.total
+            grupo["max_ms"] = max(grupo["max_ms"], accion.total)
+            for etapa, milisegundos in accion.etapas.items():
+                grupo["etapas_ms"][etapa] = grupo["etapas_ms"].get(etapa, 0.0) + milisegundos
+            completo = (grupo["veces"] >= self.agrupar_veces
+                        or time.monotonic() - grupo["desde"] >= self.agrupar_segundos)
+            if completo:
+                del self._automaticas[accion.nombre]
+        if completo:
+            self._escribir_grupo(accion.nombre, grupo)
+
+    def _escribir_grupo(self, nombre, grupo):
+        # Una línea por grupo con la suma de los tiempos; "fecha" es la de la primera acción del grupo
+        self._escribir({"fecha": grupo["fecha"], "accion": nombre, "automatica": True, "veces": grupo["veces"],
+                        "total_ms": round(grupo["total_ms"], 3),
+                        "media_ms": round(grupo["total_ms"] / grupo["veces"], 3),
+                        "max_ms": round(grupo["max_ms"], 3),
+                        "etapas_ms": {etapa: round(ms, 3) for etapa, ms in grupo["etapas_ms"].items()}})
+
+    def _escribir(self, entrada):
+        try:
+            self.logger.info(json.dumps(entrada, ensure_ascii=False, default=str))
+        except OSError as e:
+            print(f"No se pudo escribir el registro de tiempos: {str(e)}")
+
+    def cerrar(self):
+        # Escribe los grupos de acciones automáticas que aún no estaban completos
+        with self._lock:
+            grupos = list(self._automaticas.items())
+            self._automaticas.clear()
+        for nombre, grupo in grupos:
+            self._escribir_grupo(nombre, grupo)
+
+    def _guardar_perfil(self, accion):
+        os.makedirs(self.directorio, exist_ok=True)
+        base = os.path.join(self.directorio, f"perfil_{accion.nombre}_{datetime.now():%Y%m%d_%H%M%S}")
+
+        # La instantánea de memoria se toma antes de procesar el perfil para no medir ese trabajo
+        memoria = []
+        if tracemalloc.is_tracing():
+            actual, pico = tracemalloc.get_traced_memory()
+            memoria.append(f"\nMemoria Python: actual {actual / 1e6:.1f} MB, pico {pico / 1e6:.1f} MB\n")
+            estadisticas = tracemalloc.take_snapshot().statistics("lineno")[:20]
+            memoria.extend(f"{estadistica}\n" for estadistica in estadisticas)
+            if self._tracemalloc_propio:
+                tracemalloc.stop()
+                self._tracemalloc_propio = False
+
+        resumen = io.StringIO()
+        if accion._perfiles:
+            estadisticas = pstats.Stats(*accion._perfiles, stream=resumen)
+            estadisticas.dump_stats(f"{base}.prof")
+            estadisticas.sort_stats("cumulative").print_stats(30)
+        resumen.writelines(memoria)
+
+        with open(f"{base}.txt", 'w', encoding="utf-8") as archivo:
+            archivo.write(resumen.getvalue())
+        return f"{base}.txt"
@@ -0,0 +1,133 @@
+import itertools
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+class TareaCancelada(Exception):
+    pass
+
+
+class Tarea:
+    # Estado compartido entre el hilo de trabajo y la interfaz
+    _contador = itertools.count(1)
+
+    def __init__(self, nombre, grupo, eventos):
+        self.id = next(self._contador)
+        self.nombre = nombre
+        self.grupo = grupo
+        self._eventos = eventos
+        self._cancelar = threading.Event()
+
+    def cancelar(self):
+        self._cancelar.set()
+
+    def cancelada(self):
+        return self._cancelar.is_set()
+
+    def comprobar(self):
+        # Los trabajos largos la llaman entre pasos para detenerse si se pidió cancelar
+        if self._cancelar.is_set():
+            raise TareaCancelada(self.nombre)
+
+    def informar(self, hechos, total, mensaje=None):
+        self._eventos.put(("progreso", self, (hechos, total, mensaje)))
+
+
+class EjecutorTareas:
+    # Ejecuta trabajos en un pool de hilos y entrega progreso y resultados en el hilo de Tk
+    # sondeando una cola con root.after. Solo se permite una tarea a la vez por grupo, de modo
+    # que dos trabajos que tocan el mismo estado (p. ej. las anotaciones) no se solapan.
+    def __init__(self, root, hilos=2, intervalo=50):
+        self.root = root
+        self.intervalo = intervalo
+        self._pool = ThreadPoolExecutor(max_workers=hilos, thread_name_prefix="tarea")
+        self._eventos = queue.Queue()
+        self._activas = {}
+        self._callbacks = {}
+        self.al_cambiar = None  # Se llama como al_cambiar(tarea, hechos, total, mensaje) o al_cambiar(None, ...)
+        self._sondeando = False
+
+    def ocupado(self, grupo=None):
+        if grupo is None:
+            return bool(self._activas)
+        return grupo in self._activas
+
+    def ejecutar(self, nombre, funcion, *args, grupo=None, al_terminar=None, al_fallar=None,
+                 al_cancelar=None, **kwargs):
+        # funcion(tarea, *args, **kwargs) se ejecuta fuera del hilo de la interfaz; los callbacks
+        # se llaman siempre en el hilo de Tk. Devuelve None si el grupo ya tiene una tarea activa.
+        grupo = grupo or nombre
+        if grupo in self._activas:
+            return None
+
+        tarea = Tarea(nombre, grupo, self._eventos)
+        self._activas[grupo] = tarea
+        self._callbacks[tarea.id] = (al_terminar, al_fallar, al_cancelar)
+
+        def trabajo():
+            try:
+                resultado = funcion(tarea, *args, **kwargs)
+                if tarea.cancelada():
+                    raise TareaCancelada(nombre)
+                self._eventos.put(("terminada", tarea, resultado))
+            except TareaCancelada:
+                self._eventos.put(("cancelada", tarea, None))
+            except Exception as e:
+                self._eventos.put(("error", tarea, e))
+
+        self._pool.submit(trabajo)
+        self._notificar(tarea, 0, 0, nombre)
+        if not self._sondeando:
+            self._sondeando = True
+            self.root.after(self.intervalo, self._revisar)
+        return tarea
+
+    def cancelar(self, grupo=None):
+        for clave, tarea in list(self._activas.items()):
+            if grupo is None or clave == grupo:
+                tarea.cancelar()
+
+    def _notificar(self, tarea, hechos, total, mensaje):
+        if self.al_cambiar is not None:
+            self.al_cambiar(tarea, hechos, total, mensaje)
+
+    def _revisar(self):
+        while True:
+            try:
+                tipo, tarea, dato = self._eventos.get_nowait()
+            except queue.Empty:
+                break
+
+            if tipo == "progreso":
+                hechos, total, mensaje = dato
+                self._notificar(tarea, hechos, total, mensaje)
+                continue
+
+            # La tarea terminó: liberar su grupo antes de llamar al callback, que puede lanzar otra
+            if self._activas.get(tarea.grupo) is tarea:
+                del self._activas[tarea.grupo]
+            al_terminar, al_fallar, al_cancelar = self._callbacks.pop(tarea.id, (None, None, None))
+
+            try:
+                if tipo == "terminada" and al_terminar is not None:
+                    al_terminar(dato)
+                elif tipo == "cancelada" and al_cancelar is not None:
+                    al_cancelar()
+                elif tipo == "error":
+                    if al_fallar is not None:
+                        al_fallar(dato)
+                    else:
+                        print(f"Error en la tarea {tarea.nombre}: {str(dato)}")
+            finally:
+                self._notificar(None, 0, 0, None)
+
+        if self._activas or not self._eventos.empty():
+            self.root.after(self.intervalo, self._revisar)
+        else:
+            self._sondeando = False
+
+    def cerrar(self):
+        # Los trabajos en curso terminan en su siguiente comprobar(); los que esperaban no empiezan
+        self.cancelar()
+        self._pool.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,169 @@
+import math
+from collections import OrderedDict
+
+import cv2
+import tkinter as tk
+from PIL import Image, ImageTk
+
+from imagen import leer_reducida
+
+
+class PiramideImagen:
+    # Niveles de resolución decreciente (1, 1/2, 1/4, ...) calculados una sola vez por imagen.
+    # El nivel 0 es la propia imagen original, sin copia. Si la fuente (ImagenOriginal) no cabe en
+    # su presupuesto de memoria, el nivel 0 no se guarda aquí: se pide a la fuente solo cuando el
+    # zoom lo necesita, y el nivel 1 sale de una decodificación reducida del archivo.
+    def __init__(self, imagen, lado_minimo=512, fuente=None):
+        self.fuente = fuente
+        if imagen is None:
+            self.niveles = [None, leer_reducida(fuente.ruta, 2)]
+        else:
+            self.niveles = [imagen]
+        while max(self.niveles[-1].shape[:2]) > lado_minimo:
+            anterior = self.niveles[-1]
+            alto, ancho = anterior.shape[:2]
+            self.niveles.append(cv2.resize(anterior, ((ancho + 1) // 2, (alto + 1) // 2),
+                                           interpolation=cv2.INTER_AREA))
+        if fuente is not None and fuente.excede_presupuesto():
+            self.niveles[0] = None
+
+    @classmethod
+    def desde_fuente(cls, fuente, lado_minimo=512):
+        # Si la imagen completa ya está en memoria se reduce desde ella; si no, y no hace falta, no se lee
+        if fuente.excede_presupuesto() and not fuente.cargada:
+            return cls(None, lado_minimo, fuente)
+        return cls(fuente.datos(), lado_minimo, fuente)
+
+    @property
+    def alto(self):
+        return self.fuente.alto if self.fuente is not None else self.niveles[0].shape[0]
+
+    @property
+    def ancho(self):
+        return self.fuente.ancho if self.fuente is not None else self.niveles[0].shape[1]
+
+    @property
+    def bytes(self):
+        return sum(nivel.nbytes for nivel in self.niveles if nivel is not None)
+
+    def nivel(self, indice):
+        if self.niveles[indice] is None:
+            return self.fuente.datos()
+        return self.niveles[indice]
+
+    def nivel_para(self, escala):
+        # Nivel más pequeño cuya resolución sigue siendo mayor o igual que la que se muestra
+        if escala >= 1:
+            return 0
+        nivel = int(math.floor(math.log2(1.0 / escala)))
+        return max(0, min(nivel, len(self.niveles) - 1))
+
+
+class VisorTeselas:
+    # Dibuja en el canvas solo las teselas visibles de la imagen al factor de escala actual.
+    # Las teselas se alinean a una rejilla en coordenadas del canvas (imagen original * escala)
+    # y sus PhotoImage se guardan en una caché LRU.
+    def __init__(self, canvas, tamano_tesela=256, max_teselas=192):
+        self.canvas = canvas
+        self.tamano_tesela = tamano_tesela
+        self.max_teselas = max_teselas
+        self.piramide = None
+        self._cache = OrderedDict()
+        self._items = {}
+        self._escala_items = None
+
+    def establecer_imagen(self, imagen, piramide=None):
+        # Se puede pasar una pirámide ya construida (p. ej. por el precargador de la carpeta)
+        self.limpiar()
+        if piramide is None and imagen is not None:
+            piramide = PiramideImagen(imagen)
+        self.piramide = piramide
+
+    def limpiar(self):
+        self.canvas.delete("imagen")
+        self._cache.clear()
+        self._items = {}
+        self._escala_items = None
+
+    def region_visible(self):
+        # Región visible en coordenadas del canvas
+        x0 = self.canvas.canvasx(0)
+        y0 = self.canvas.canvasy(0)
+        return x0, y0, x0 + self.canvas.winfo_width(), y0 + self.canvas.winfo_height()
+
+    def _tesela(self, escala, tx, ty):
+        clave = (escala, tx, ty)
+        foto = self._cache.get(clave)
+        if foto is not None:
+            self._cache.move_to_end(clave)
+            return foto
+
+        # Las imágenes se guardan en BGR; solo la tesela se pasa a RGB para Tk
+        pixeles = cv2.cvtColor(self.pixeles_tesela(escala, tx, ty), cv2.COLOR_BGR2RGB)
+        foto = ImageTk.PhotoImage(image=Image.fromarray(pixeles))
+
+        self._cache[clave] = foto
+        while len(self._cache) > self.max_teselas:
+            # Las teselas en pantalla siguen referenciadas desde self._items
+            self._cache.popitem(last=False)
+        return foto
+
+    def pixeles_tesela(self, escala, tx, ty):
+        # Píxeles de la tesela (tx, ty) a la escala dada, sin crear la PhotoImage
+        piramide = self.piramide
+        nivel = piramide.nivel_para(escala)
+        imagen_nivel = piramide.nivel(nivel)
+        escala_x = imagen_nivel.shape[1] / piramide.ancho
+        escala_y = imagen_nivel.shape[0] / piramide.alto
+
+        # Región de la tesela en el canvas, limitada al tamaño de la imagen escalada
+        ancho_canvas = int(piramide.ancho * escala)
+        alto_canvas = int(piramide.alto * escala)
+        cx0, cy0 = tx * self.tamano_tesela, ty * self.tamano_tesela
+        cx1 = min(cx0 + self.tamano_tesela, ancho_canvas)
+        cy1 = min(cy0 + self.tamano_tesela, alto_canvas)
+
+        # Misma región en el nivel de la pirámide
+        x0 = int(cx0 / escala * escala_x)
+        y0 = int(cy0 / escala * escala_y)
+        x1 = max(x0 + 1, min(imagen_nivel.shape[1], int(math.ceil(cx1 / escala * escala_x))))
+        y1 = max(y0 + 1, min(imagen_nivel.shape[0], int(math.ceil(cy1 / escala * escala_y))))
+
+        recorte = imagen_nivel[y0:y1, x0:x1]
+        interpolacion = cv2.INTER_AREA if recorte.shape[1] > (cx1 - cx0) else cv2.INTER_NEAREST
+        return cv2.resize(recorte, (cx1 - cx0, cy1 - cy0), interpolation=interpolacion)
+
+    def teselas_visibles(self, escala, region):
+        # Índices (tx, ty) de las teselas que cortan la región (x0, y0, x1, y1) del canvas
+        ancho_canvas = int(self.piramide.ancho * escala)
+        alto_canvas = int(self.piramide.alto * escala)
+        vx0, vy0, vx1, vy1 = region
+        tx0 = max(0, int(vx0 // self.tamano_tesela))
+        ty0 = max(0, int(vy0 // self.tamano_tesela))
+        tx1 = min((ancho_canvas - 1) // self.tamano_tesela, int(vx1 // self.tamano_tesela))
+        ty1 = min((alto_canvas - 1) // self.tamano_tesela, int(vy1 // self.tamano_tesela))
+        return {(tx, ty) for ty in range(ty0, ty1 + 1) for tx in range(tx0, tx1 + 1)}
+
+    def renderizar(self, escala):
+        if self.piramide is None:
+            return
+
+        if escala != self._escala_items:
+            self.canvas.delete("imagen")
+            self._items = {}
+            self._escala_items = escala
+
+        visibles = self.teselas_visibles(escala, self.region_visible())
+
+        # Quitar las teselas que salieron de la vista y crear solo las nuevas
+        for clave in list(self._items):
+            if clave not in visibles:
+                item, _ = self._items.pop(clave)
+                self.canvas.delete(item)
+        for tx, ty in sorted(visibles - set(self._items)):
+            foto = self._tesela(escala, tx, ty)
+            item = self.canvas.create_image(tx * self.tamano_tesela, ty * self.tamano_tesela,
+                                            image=foto, anchor=tk.NW, tags="imagen")
+            self._items[(tx, ty)] = (item, foto)
+
+        self.canvas.tag_lower("imagen")